@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the matcher and parser hot paths.
+
+    python benchmarks.py --out before.json
+    ... change the engine ...
+    python benchmarks.py --out after.json
+    python benchmarks.py --compare before.json after.json
+
+Every benchmark is timed best-of-repeat, and reported as seconds per call.
+--compare lists every benchmark with the ratio new/old,
+    and exits with status 1 if any got slower by more than --threshold (10% by default).
+
+The inputs come from generators with controlled shape:
+    make_ast (width, depth, and whether equal subtrees are shared objects),
+    make_rules (number of rules), and make_tokens (number of operands).
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import pypm
+import pyparse
+import pyvector
+from pypm import patternmatch,recurse_ast,traverse_ast,anynode,starargs,a,b
+
+
+def make_ast(width, depth, shared=False):
+    """Accepts the number of children per node, the number of levels, and whether to share subtrees.
+        Returns a complete tree of ('Node', child, ...) with ('Num', 0) leaves,
+            where shared=True makes all the children of a node one and the same object.
+    """
+    node = ('Num', 0)
+    for d in xrange(depth):
+        if shared:
+            node = ('Node',) + (node,) * width
+        else:
+            node = ('Node',) + tuple(_copy(node) for i in xrange(width))
+    return node
+
+def _copy(ast):
+    # a fresh, unshared copy of a tree
+    if isinstance(ast, tuple):
+        return tuple(_copy(x) for x in ast)
+    return ast
+
+def make_rules(n):
+    """Accepts a number of rules. Returns n patterns ('R<i>', a, b) => ('Num', i), and one for Num."""
+    rules = [{('R%d' % i, a, b): (lambda i: lambda a,b: ('Num', i))(i)} for i in xrange(n)]
+    rules.append({('Num', a): lambda a: ('Num', a)})
+    return rules
+
+def make_tokens(n):
+    """Accepts a number of operands. Returns the tokens of 1+2*3-4... for pyparse."""
+    ops = '+*-'
+    s = ''.join('{0}{1}'.format(i, ops[(i - 1) % 3]) for i in xrange(1, n)) + str(n)
+    return pyparse.whitespace_tokenize(s)
+
+
+"""
+The benchmarks. Each is a function of its parameters,
+    which sets up its input and returns the function to time.
+"""
+
+def bench_match_interpreter(width, depth):
+    pattern = ('Node', ('Node', a, starargs), b)
+    ast = make_ast(width, depth)
+    match = pypm.match_and_extract_matched_vars
+    return lambda: match(pattern, ast)
+
+def bench_dispatch(nrules, compiled):
+    rules = make_rules(nrules)
+    @patternmatch(rules, compiled=compiled)
+    def f(ast):
+        pass
+    # the last of the R rules, the worst case for trying rules in order
+    ast = ('R%d' % (nrules - 1), ('Num', 1), ('Num', 2))
+    return lambda: f(ast)
+
+def bench_recurse_ast(width, depth, shared):
+    @patternmatch([
+        {('Num', a): lambda a: (('Num', a),)},
+        {(anynode, starargs): lambda anynode,starargs: recurse_ast(walk, anynode, starargs)},
+    ])
+    def walk(ast):
+        pass
+    ast = make_ast(width, depth, shared)
+    return lambda: walk(ast)
+
+def bench_traverse_ast(width, depth, shared, memoize):
+    @patternmatch([{('Num', a): lambda a: ('Num', a + 1)}], run_func=True, memoize=memoize)
+    def walk(ast):
+        return traverse_ast(walk, ast)[0]
+    ast = make_ast(width, depth, shared)
+    if memoize:
+        def run():
+            walk.cache_clear()
+            return walk(ast)
+        return run
+    return lambda: walk(ast)
+
+def bench_parse(noperands, packrat):
+    tokens = make_tokens(noperands)
+    return lambda: pyparse.parse(pyparse.simple_expression, tokens, whole=True, packrat=packrat)
+
+def bench_batch_apply(n, vectorized):
+    @patternmatch([
+        {('Sum', a, b):     lambda a,b: ('Num', evalNumeric(a)[1] + evalNumeric(b)[1])},
+        {('Mult', a, b):    lambda a,b: ('Num', evalNumeric(a)[1] * evalNumeric(b)[1])},
+        {('Num', a):        lambda a: ('Num', a)},
+    ])
+    def evalNumeric(ast):
+        pass
+    asts = [('Sum', ('Num', i), ('Mult', ('Num', i + 1), ('Num', 3))) for i in xrange(n)]
+    if vectorized:
+        return lambda: pyvector.batch_apply(evalNumeric, asts)
+    return lambda: [evalNumeric(ast) for ast in asts]
+
+def suite(quick=False):
+    """Returns a list of (name, benchmark, parameters).
+        quick=True shrinks the inputs, to check that everything runs.
+    """
+    s = 0.1 if quick else 1
+    width = 3
+    depth = 6 if quick else 8
+    cases = [
+        ('match_interpreter', bench_match_interpreter, dict(width=width, depth=depth)),
+        ('dispatch_compiled_r10', bench_dispatch, dict(nrules=10, compiled=True)),
+        ('dispatch_compiled_r100', bench_dispatch, dict(nrules=int(100 * s), compiled=True)),
+        ('dispatch_interpreted_r10', bench_dispatch, dict(nrules=10, compiled=False)),
+        ('dispatch_interpreted_r100', bench_dispatch, dict(nrules=int(100 * s), compiled=False)),
+        ('recurse_ast', bench_recurse_ast, dict(width=width, depth=depth, shared=False)),
+        ('recurse_ast_shared', bench_recurse_ast, dict(width=width, depth=depth, shared=True)),
+        ('traverse_ast', bench_traverse_ast, dict(width=width, depth=depth, shared=False, memoize=False)),
+        ('traverse_ast_shared_memoized', bench_traverse_ast, dict(width=width, depth=depth, shared=True, memoize=True)),
+        ('parse_simple_expression', bench_parse, dict(noperands=int(200 * s), packrat=False)),
+        ('parse_simple_expression_packrat', bench_parse, dict(noperands=int(200 * s), packrat=True)),
+        ('batch_per_item', bench_batch_apply, dict(n=int(10000 * s), vectorized=False)),
+        ('batch_vectorized', bench_batch_apply, dict(n=int(10000 * s), vectorized=True)),
+    ]
+    return cases
+
+def measure(f, repeat=5, mintime=0.05):
+    """Accepts a function of no arguments.
+        Returns the best seconds per call over repeat runs,
+            each of enough calls to take at least mintime.
+    """
+    # not timed: patternmatch compiles its rules on the first call
+    f()
+    number = 1
+    while True:
+        start = time.time()
+        for i in xrange(number):
+            f()
+        elapsed = time.time() - start
+        if elapsed >= mintime:
+            break
+        number *= 2 if elapsed * 10 >= mintime else 10
+    best = elapsed / number
+    for r in xrange(repeat - 1):
+        start = time.time()
+        for i in xrange(number):
+            f()
+        best = min(best, (time.time() - start) / number)
+    return best
+
+def run(only=None, quick=False, repeat=5, mintime=0.05):
+    """Accepts a substring to select benchmarks by name.
+        Returns the results: {'python': ..., 'benchmarks': {name: {'seconds': ..., 'params': ...}}}.
+    """
+    # simple_expression nests a few frames per operand
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+    results = {}
+    for name,bench,params in suite(quick):
+        if only is not None and only not in name:
+            continue
+        seconds = measure(bench(**params), repeat, mintime)
+        results[name] = {'seconds': seconds, 'params': params}
+    return {'python': platform.python_version(), 'benchmarks': results}
+
+def compare(old, new, threshold=0.1):
+    """Accepts two results of run(), and the allowed slowdown.
+        Returns a list of (name, old seconds, new seconds, new/old, regressed),
+            for the benchmarks in both.
+    """
+    rows = []
+    for name in sorted(set(old['benchmarks']) & set(new['benchmarks'])):
+        o = old['benchmarks'][name]['seconds']
+        n = new['benchmarks'][name]['seconds']
+        ratio = n / o if o > 0 else float('inf')
+        rows.append((name, o, n, ratio, ratio > 1 + threshold))
+    return rows
+
+def main(argv, stdout=sys.stdout):
+    parser = argparse.ArgumentParser(prog='benchmarks.py', description='Time the pypm and pyparse hot paths.')
+    parser.add_argument('--out', help='write the results to this JSON file')
+    parser.add_argument('--only', help='run the benchmarks whose name contains this')
+    parser.add_argument('--quick', action='store_true', help='small inputs and few repeats')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.1, help='slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        rows = compare(old, new, args.threshold)
+        for name,o,n,ratio,regressed in rows:
+            stdout.write('{0:<36} {1:12.3e} {2:12.3e} {3:7.2f}x{4}\n'.format(
+                            name, o, n, ratio, '  REGRESSION' if regressed else ''))
+        return 1 if any(r[4] for r in rows) else 0
+
+    if args.quick:
+        results = run(args.only, quick=True, repeat=1, mintime=0.001)
+    else:
+        results = run(args.only)
+    for name,r in sorted(results['benchmarks'].items()):
+        stdout.write('{0:<36} {1:12.3e} s\n'.format(name, r['seconds']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
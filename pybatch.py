@@ -0,0 +1,138 @@
+"""
+Batch pipeline: tokenize, parse and rewrite many source files.
+
+    python -m pypm mymodule:evalSimpleExpression a.txt b.txt ...
+    find src -name '*.expr' | python -m pypm mymodule:evalSimpleExpression --workers 8
+
+RULES is module:name of a @patternmatch function (called on every AST),
+    or of a pattern list (applied with pyrewrite.rewrite).
+The grammar is module:name of a pyparse parser, pyparse:simple_expression by default.
+
+Files go to a pool of worker processes, which import the grammar and rules once,
+    and take the files in chunks. Results come back in input order, one line per file:
+    path<TAB>repr(result) on stdout, or path<TAB>ERROR ... on stderr.
+A failing file does not stop the run. Throughput is reported on stderr at the end.
+Rules or a grammar which do not load stop it before any file, with exit status 2.
+"""
+import argparse
+import multiprocessing
+import sys
+import time
+
+import pyparse
+import pyrewrite
+
+
+def load(spec):
+    """Accepts module:name. Returns the named object."""
+    if ':' not in spec:
+        raise ValueError('expected module:name, got {0}'.format(spec))
+    module,name = spec.split(':', 1)
+    m = __import__(module, fromlist=[name])
+    return getattr(m, name)
+
+def make_pipeline(rules_spec, grammar_spec):
+    """Accepts the rules and grammar specs.
+        Returns a function from a file's text to (result, number of tokens).
+    """
+    rules = load(rules_spec)
+    grammar = load(grammar_spec)
+    if callable(rules):
+        run = rules
+    else:
+        rules = pyrewrite.compile_rewrite_rules(rules)
+        run = lambda ast: pyrewrite.rewrite(rules, ast)
+
+    def pipeline(text):
+        tokens = pyparse.whitespace_tokenize(text)
+        ast,remaining = pyparse.parse(grammar, tokens, whole=True)
+        if ast is None:
+            raise pyparse.ParseException('does not parse, {0} tokens left'.format(len(remaining)))
+        return run(ast), len(tokens)
+    return pipeline
+
+_pipeline = None
+# why the worker has no pipeline, if make_pipeline failed there
+_pipeline_error = None
+
+def _init_worker(rules_spec, grammar_spec):
+    # an initializer which raises kills the worker, and the pool starts another one, forever,
+    #   so the error is kept and reported for every file instead
+    global _pipeline, _pipeline_error
+    try:
+        _pipeline = make_pipeline(rules_spec, grammar_spec)
+    except Exception,e:
+        _pipeline_error = '{0}: {1}'.format(type(e).__name__, e)
+
+def process_file(path):
+    """Accepts a path. Runs the worker's pipeline on the file.
+        Returns (path, ok, repr of the result or error message, number of tokens).
+    """
+    if _pipeline is None:
+        return path, False, 'cannot load the pipeline: {0}'.format(_pipeline_error), 0
+    try:
+        with open(path) as f:
+            text = f.read()
+        result,ntokens = _pipeline(text)
+        return path, True, repr(result), ntokens
+    except Exception,e:
+        return path, False, '{0}: {1}'.format(type(e).__name__, e), 0
+
+def run_batch(paths, rules_spec, grammar_spec='pyparse:simple_expression', workers=None, chunksize=16):
+    """Accepts an iterable of paths and the specs.
+        Yields the process_file results in input order, as they become available.
+        workers=1 runs everything in this process.
+        The rules and grammar are loaded here first, so they raise before any worker starts.
+    """
+    global _pipeline
+    pipeline = make_pipeline(rules_spec, grammar_spec)
+    if workers == 1:
+        _pipeline = pipeline
+        for path in paths:
+            yield process_file(path)
+    else:
+        pool = multiprocessing.Pool(workers, _init_worker, (rules_spec, grammar_spec))
+        try:
+            for r in pool.imap(process_file, paths, chunksize):
+                yield r
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+def main(argv, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
+    parser = argparse.ArgumentParser(prog='python -m pypm',
+                                     description='Tokenize, parse and rewrite files with a pypm rule set.')
+    parser.add_argument('rules', help='module:name of a @patternmatch function or a pattern list')
+    parser.add_argument('files', nargs='*', help='input files (default: read paths from stdin, one per line)')
+    parser.add_argument('--grammar', default='pyparse:simple_expression', help='module:name of a pyparse parser')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per CPU)')
+    parser.add_argument('--chunksize', type=int, default=16, help='files handed to a worker at a time')
+    args = parser.parse_args(argv)
+
+    if args.files:
+        paths = iter(args.files)
+    else:
+        paths = (line.rstrip('\n') for line in stdin if line.strip())
+
+    try:
+        make_pipeline(args.rules, args.grammar)
+    except Exception,e:
+        stderr.write('error: cannot load rules {0} or grammar {1}: {2}: {3}\n'.format(
+                        args.rules, args.grammar, type(e).__name__, e))
+        return 2
+
+    start = time.time()
+    nfiles,nfailed,ntokens = 0, 0, 0
+    for path,ok,out,n in run_batch(paths, args.rules, args.grammar, args.workers, args.chunksize):
+        nfiles += 1
+        ntokens += n
+        if ok:
+            stdout.write('{0}\t{1}\n'.format(path, out))
+        else:
+            nfailed += 1
+            stderr.write('{0}\tERROR {1}\n'.format(path, out))
+    elapsed = max(time.time() - start, 1e-9)
+    stderr.write('{0} files, {1} failed, {2:.3f}s, {3:.1f} files/s, {4:.1f} tokens/s\n'.format(
+                    nfiles, nfailed, elapsed, nfiles / elapsed, ntokens / elapsed))
+    return 1 if nfailed else 0
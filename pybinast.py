@@ -0,0 +1,256 @@
+"""
+A compact binary AST format, read lazily through memory maps.
+
+    pybinast.dump(ast, 'tree.bin')
+    tree = pybinast.load('tree.bin')    # a NodeView of the root, nothing is decoded yet
+    evalNumeric(tree)                   # pypm matches NodeViews like tuples
+
+Strings (node names and string leaves) are interned into one table and stored once.
+A node is its number of elements, one tag byte per element, and one 8 byte value per element:
+    the offset of a child node, the id of a string, or the leaf itself.
+Leaves are strings, unicode, ints and longs (those past 64 bits as decimal strings), floats, bools and None;
+    dumps raises FormatError for any other leaf, and nothing is ever unpickled,
+    so loading a file from another process runs no code from it.
+Children are written before their parents, so a file is written in one pass
+    and subtrees shared by identity are written once.
+
+A NodeView decodes an element only when it is asked for, and a child only becomes a NodeView then,
+    so matching touches only the parts of the tree the patterns look at.
+to_tuple converts a view (or any part of it) into plain tuples.
+
+File layout, little endian:
+    'PYBA', version (I), root offset (Q), string table offset (Q),
+    the nodes: n (I), n tags (B), n values (q),
+    the string table: count (I), count + 1 offsets (Q) into the string bytes, the string bytes.
+"""
+import mmap
+import os
+import struct
+from itertools import izip
+
+import pypm
+
+
+MAGIC = 'PYBA'
+VERSION = 2
+_HEADER = struct.Struct('<4sIQQ')
+
+_NODE, _STR, _INT, _NONE, _BOOL, _FLOAT, _UNICODE, _LONG = range(8)
+_INT_MIN, _INT_MAX = -(1 << 63), (1 << 63) - 1
+
+class FormatError(Exception):
+    pass
+
+
+class _Writer(object):
+    def __init__(self):
+        self.chunks = [_HEADER.pack(MAGIC, VERSION, 0, 0)]
+        self.size = _HEADER.size
+        self.strings = {}
+        self.string_list = []
+
+    def intern(self, s):
+        i = self.strings.get(s)
+        if i is None:
+            i = self.strings[s] = len(self.string_list)
+            self.string_list.append(s)
+        return i
+
+    def leaf(self, x):
+        """Returns (tag, value) for a leaf."""
+        if isinstance(x, bool):
+            return _BOOL, int(x)
+        elif isinstance(x, str):
+            return _STR, self.intern(x)
+        elif isinstance(x, unicode):
+            return _UNICODE, self.intern(x.encode('utf-8'))
+        elif isinstance(x, (int, long)):
+            if _INT_MIN <= x <= _INT_MAX:
+                return _INT, x
+            return _LONG, self.intern(str(x))
+        elif x is None:
+            return _NONE, 0
+        elif isinstance(x, float):
+            return _FLOAT, struct.unpack('<q', struct.pack('<d', x))[0]
+        else:
+            raise FormatError('cannot encode leaf {0!r} of type {1}'.format(x, type(x).__name__))
+
+    def node(self, elements):
+        """Accepts (tag, value) pairs. Writes the node, returns its offset."""
+        n = len(elements)
+        offset = self.size
+        data = struct.pack('<I%dB%dq' % (n, n), n, *([t for t,v in elements] + [v for t,v in elements]))
+        self.chunks.append(data)
+        self.size += len(data)
+        return offset
+
+    def finish(self, root):
+        table = self.size
+        offsets = [0]
+        for s in self.string_list:
+            offsets.append(offsets[-1] + len(s))
+        self.chunks.append(struct.pack('<I%dQ' % len(offsets), len(self.string_list), *offsets))
+        self.chunks.extend(self.string_list)
+        self.chunks[0] = _HEADER.pack(MAGIC, VERSION, root, table)
+        return ''.join(self.chunks)
+
+def dumps(ast):
+    """Accepts an AST. Returns its binary encoding, a string.
+        Raises FormatError if a leaf is of a type the format does not have.
+    """
+    pypm.check_ast(ast)
+    w = _Writer()
+    # node id => (node, offset), the node kept alive so its id is not reused
+    written = {}
+    stack = [ast]
+    while stack:
+        t = stack[-1]
+        if id(t) in written:
+            stack.pop()
+            continue
+        pending = [x for x in t if pypm.is_node(x) and id(x) not in written]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        elements = [(_NODE, written[id(x)][1]) if pypm.is_node(x) else w.leaf(x) for x in t]
+        written[id(t)] = (t, w.node(elements))
+    return w.finish(written[id(ast)][1])
+
+def dump(ast, path):
+    """Accepts an AST and a path. Writes the AST's binary encoding to the file."""
+    with open(path, 'wb') as f:
+        f.write(dumps(ast))
+
+
+class _Strings(object):
+    """The string table of an encoded tree, decoding each string on first use."""
+    def __init__(self, buf, offset):
+        self.buf = buf
+        self.count, = struct.unpack_from('<I', buf, offset)
+        self.offsets = offset + 4
+        self.data = self.offsets + 8 * (self.count + 1)
+        self.cache = {}
+
+    def __getitem__(self, i):
+        s = self.cache.get(i)
+        if s is None:
+            start,end = struct.unpack_from('<QQ', self.buf, self.offsets + 8 * i)
+            s = self.cache[i] = self.buf[self.data + start:self.data + end]
+        return s
+
+class NodeView(object):
+    """A node of an encoded tree, decoded on demand.
+        Indexes, slices (into tuples), iterates, compares and hashes like the tuple it stands for.
+    """
+    __slots__ = ('buf', 'offset', 'strings', 'n', '_hash')
+
+    def __init__(self, buf, offset, strings):
+        self.buf = buf
+        self.offset = offset
+        self.strings = strings
+        self.n, = struct.unpack_from('<I', buf, offset)
+        self._hash = None
+
+    def _element(self, i):
+        tag, = struct.unpack_from('<B', self.buf, self.offset + 4 + i)
+        value, = struct.unpack_from('<q', self.buf, self.offset + 4 + self.n + 8 * i)
+        if tag == _NODE:
+            return NodeView(self.buf, value, self.strings)
+        elif tag == _STR:
+            return self.strings[value]
+        elif tag == _INT:
+            return value
+        elif tag == _NONE:
+            return None
+        elif tag == _BOOL:
+            return bool(value)
+        elif tag == _FLOAT:
+            return struct.unpack('<d', struct.pack('<q', value))[0]
+        elif tag == _UNICODE:
+            return self.strings[value].decode('utf-8')
+        elif tag == _LONG:
+            return long(self.strings[value])
+        else:
+            raise FormatError('bad tag {0} at offset {1}'.format(tag, self.offset))
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return tuple(self._element(j) for j in xrange(*i.indices(self.n)))
+        if i < 0:
+            i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError('node index out of range')
+        return self._element(i)
+
+    def __iter__(self):
+        for i in xrange(self.n):
+            yield self._element(i)
+
+    def __eq__(self, other):
+        if isinstance(other, NodeView):
+            if other.buf is self.buf and other.offset == self.offset:
+                return True
+        elif not isinstance(other, tuple):
+            return NotImplemented
+        return self.n == len(other) and all(a == b for a,b in izip(self, other))
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(to_tuple(self))
+        return self._hash
+
+    def __repr__(self):
+        return repr(to_tuple(self))
+
+pypm.register_node_type(NodeView)
+
+def loads(data):
+    """Accepts an encoded tree (a string, or a buffer like an mmap). Returns the NodeView of its root."""
+    if len(data) < _HEADER.size:
+        raise FormatError('too short for a header')
+    magic,version,root,table = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise FormatError('not a binary AST')
+    if version != VERSION:
+        raise FormatError('unknown version {0}'.format(version))
+    return NodeView(data, root, _Strings(data, table))
+
+def load(path):
+    """Accepts a path written by dump. Returns the NodeView of its root, over a memory map of the file.
+        The map stays open as long as a view of it is alive.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise FormatError('empty file')
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(m)
+
+def to_tuple(node):
+    """Accepts a NodeView (or any AST). Returns the equivalent plain recursive n-tuple."""
+    if not pypm.is_node(node):
+        return node
+    # (node, its elements so far)
+    stack = [(node, [])]
+    while stack:
+        t,items = stack[-1]
+        if len(items) == len(t):
+            stack.pop()
+            built = tuple(items)
+            if stack:
+                stack[-1][1].append(built)
+            else:
+                return built
+            continue
+        x = t[len(items)]
+        if pypm.is_node(x):
+            stack.append((x, []))
+        else:
+            items.append(x)
@@ -0,0 +1,342 @@
+"""
+Incremental reparsing.
+
+An IncrementalParse keeps, for every parser at every token position, the value it parsed,
+    how many tokens it took (so its span), and how far into the tokens it looked.
+After an edit replaces a range of tokens, only the entries which looked at the edited range are forgotten,
+    the rest move with their tokens, and the next parse takes every untouched subtree from there,
+    the very same object as before, so memoized patternmatch passes skip it too:
+
+    doc = IncrementalParse(pyparse.arith_expression, pyparse.whitespace_tokenize('1 + 2 * 3'), whole=True)
+    ast,remaining = doc.parse()
+    ast,remaining = doc.edit(4, 5, ['7'])   # 1 + 7 * 3
+
+An edit finds the entries which looked at it through an index of how far every column looked,
+    so forgetting them costs the entries forgotten and the log of the document, not the document.
+The next parse still starts at the root and runs every node enclosing the edit in full,
+    taking their untouched children from the memo: a flat chain of operators is one node,
+    whose operands are all looked up again and whose spine above the edit is rebuilt,
+    and a Nested scans its tokens for the close bracket.
+So a reparse grows with the edit and with the size of the nodes enclosing it:
+    for a document which nests, that is far less than the document; for one long chain, it is the chain.
+Combinator grammars reparse incrementally; a compile_grammar parser is opaque, and reparses whole.
+"""
+import random
+
+import pyparse
+
+
+class _End(int):
+    """The end of the document, which notes every position a parser compares against it,
+        since the result at that position depends on where the document ends.
+    """
+    def __new__(cls, n, memo):
+        e = int.__new__(cls, n)
+        e.memo = memo
+        return e
+
+    def _seen(self, pos):
+        memo = self.memo
+        if pos + 1 > memo.hi:
+            memo.hi = pos + 1
+
+    def __lt__(self, pos):
+        self._seen(pos)
+        return int(self) < pos
+
+    def __le__(self, pos):
+        self._seen(pos)
+        return int(self) <= pos
+
+    def __gt__(self, pos):
+        self._seen(pos)
+        return int(self) > pos
+
+    def __ge__(self, pos):
+        self._seen(pos)
+        return int(self) >= pos
+
+    def __eq__(self, pos):
+        self._seen(pos)
+        return int(self) == pos
+
+    def __ne__(self, pos):
+        self._seen(pos)
+        return int(self) != pos
+
+    __hash__ = int.__hash__
+
+class _Tokens(object):
+    """The token list, noting the furthest position any parser reads."""
+    def __init__(self, tokens, memo):
+        self.tokens = tokens
+        self.memo = memo
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def __getitem__(self, i):
+        memo = self.memo
+        if isinstance(i, slice):
+            last = len(self.tokens) if i.stop is None else i.stop
+        else:
+            last = i + 1
+        if last > memo.hi:
+            memo.hi = last
+        return self.tokens[i]
+
+
+class _Column(object):
+    """A column in a _Reaches treap."""
+    __slots__ = ('left', 'right', 'priority', 'size', 'reach', 'far')
+
+    def __init__(self, priority):
+        self.left = self.right = None
+        self.priority = priority
+        self.size = 1
+        self.reach = 0
+        self.far = 0
+
+def _update(c):
+    """Recomputes c's size, and far: the furthest any column under c looked, from c's first column."""
+    left,right = c.left, c.right
+    before = left.size if left is not None else 0
+    size = before + 1
+    far = before + c.reach
+    if left is not None and left.far > far:
+        far = left.far
+    if right is not None:
+        size += right.size
+        if before + 1 + right.far > far:
+            far = before + 1 + right.far
+    c.size = size
+    c.far = far
+
+def _split(c, k):
+    """Returns the treap c split into its first k columns and the rest."""
+    if c is None:
+        return None, None
+    before = c.left.size if c.left is not None else 0
+    if k <= before:
+        first,c.left = _split(c.left, k)
+        _update(c)
+        return first, c
+    else:
+        c.right,rest = _split(c.right, k - before - 1)
+        _update(c)
+        return c, rest
+
+def _merge(a, b):
+    """Returns the treap of the columns of a followed by those of b."""
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        _update(a)
+        return a
+    else:
+        b.left = _merge(a, b.left)
+        _update(b)
+        return b
+
+def _build(reach):
+    """Accepts how far every column looked. Returns a treap of the columns, in time linear in their number."""
+    # the right spine of the Cartesian tree on random priorities built so far
+    spine = []
+    for r in reach:
+        c = _Column(random.random())
+        c.reach = r
+        last = None
+        while spine and spine[-1].priority < c.priority:
+            last = spine.pop()
+            _update(last)
+        c.left = last
+        if spine:
+            spine[-1].right = c
+        spine.append(c)
+    root = spine[0] if spine else None
+    while spine:
+        _update(spine.pop())
+    return root
+
+class _Reaches(object):
+    """How far the entries of every column looked, relative to the column,
+        kept in an implicit treap so columns can be spliced in and out by position,
+        and crossing() finds the columns which looked past a position without visiting the others.
+    """
+    def __init__(self, reach):
+        self.root = _build(reach)
+
+    def set(self, pos, reach):
+        path = []
+        c = self.root
+        while True:
+            path.append(c)
+            before = c.left.size if c.left is not None else 0
+            if pos < before:
+                c = c.left
+            elif pos == before:
+                break
+            else:
+                pos -= before + 1
+                c = c.right
+        c.reach = reach
+        for c in reversed(path):
+            _update(c)
+
+    def crossing(self, start):
+        """Returns the columns before start whose entries looked past start."""
+        found = []
+        stack = [(self.root, 0)]
+        while stack:
+            c,base = stack.pop()
+            if c is None or base >= start or base + c.far <= start:
+                continue
+            before = c.left.size if c.left is not None else 0
+            p = base + before
+            if p < start and p + c.reach > start:
+                found.append(p)
+            stack.append((c.left, base))
+            stack.append((c.right, p + 1))
+        return found
+
+    def splice(self, start, stop, n):
+        """Replaces the columns [start, stop) by n columns which looked nowhere."""
+        first,rest = _split(self.root, start)
+        removed,rest = _split(rest, stop - start)
+        self.root = _merge(_merge(first, _build([0] * n)), rest)
+
+
+class IncrementalParse(object):
+    """Accepts a parser, a list of tokens, and whether the parse must take all of them.
+        parse() parses the tokens, and edit() changes them and parses again.
+
+        Memo entries live in one column per token position, keyed by (parser, end, whole),
+            where end is None for the end of the document, and positions are relative to the column,
+            so entries after an edit move with their column and are never rewritten.
+        An entry is (value, tokens taken, tokens looked at).
+    """
+    def __init__(self, parser, tokens, whole=False):
+        self.parser = parser
+        self.whole = whole
+        self.tokens = list(tokens)
+        self.columns = [{} for i in xrange(len(self.tokens) + 1)]
+        # per column, the furthest any of its entries looked, and the same in a treap for edit(),
+        #   which gets the columns changed since the last edit at the next one
+        self.reach = [0] * (len(self.tokens) + 1)
+        self.reaches = _Reaches(self.reach)
+        self.changed = set()
+        # examined counts the columns edit() looked through for entries to forget
+        self.counts = {'hits': 0, 'misses': 0, 'invalidated': 0, 'examined': 0}
+        self.hi = 0
+        self.pending = []
+        self.end = None
+
+    def stats(self):
+        counts = dict(self.counts)
+        counts['entries'] = sum(len(c) for c in self.columns)
+        return counts
+
+    def parse(self):
+        """Returns (ast, remaining tokens), like pyparse.parse, reusing what it can from earlier parses."""
+        self.hi = 0
+        self.pending = []
+        self.end = _End(len(self.tokens), self)
+        buf = _Tokens(self.tokens, self)
+        previous = getattr(pyparse._state, 'memo', None)
+        pyparse._state.memo = self
+        try:
+            value,i = self.parser.parse_at(buf, 0, self.end, self.whole)
+        finally:
+            pyparse._state.memo = previous
+        if value is not None:
+            return value, self.tokens[i:]
+        else:
+            return None, list(self.tokens)
+
+    def edit(self, start, stop, tokens):
+        """Accepts a token range [start, stop) and the tokens which replace it.
+            Forgets what depended on the range, and returns parse().
+        """
+        if not 0 <= start <= stop <= len(self.tokens):
+            raise IndexError('bad token range [{0}, {1}) of {2}'.format(start, stop, len(self.tokens)))
+        tokens = list(tokens)
+        columns,reach,reaches = self.columns, self.reach, self.reaches
+        if len(self.changed) * 8 > len(reach):
+            # after a parse which filled many columns, like the first, building anew is cheaper
+            reaches = self.reaches = _Reaches(reach)
+        else:
+            for p in self.changed:
+                reaches.set(p, reach[p])
+        self.changed = set()
+        for p in reaches.crossing(start):
+            column = columns[p]
+            r = 0
+            for key,entry in column.items():
+                if p + entry[2] > start:
+                    del column[key]
+                    self.counts['invalidated'] += 1
+                elif entry[2] > r:
+                    r = entry[2]
+            reach[p] = r
+            reaches.set(p, r)
+            self.counts['examined'] += 1
+        for p in xrange(start, stop):
+            self.counts['invalidated'] += len(columns[p])
+        columns[start:stop] = [{} for t in tokens]
+        reach[start:stop] = [0] * len(tokens)
+        reaches.splice(start, stop, len(tokens))
+        self.tokens[start:stop] = tokens
+        return self.parse()
+
+    def span(self, node):
+        """Accepts a subtree of the last parse.
+            Returns its token range (start, stop), the widest if several parsers returned it, or None.
+        """
+        for p,column in enumerate(self.columns):
+            for value,length,looked in column.itervalues():
+                if value is node:
+                    return p, p + length
+        return None
+
+    # the memo protocol of pyparse.ASTNode.parse_at
+
+    def get(self, key):
+        memo_key,pos,end,whole = key
+        if end is self.end:
+            end = None
+        else:
+            end = end - pos
+        found = self.columns[pos].get((memo_key, end, whole))
+        if found is None:
+            self.counts['misses'] += 1
+            # start measuring how far this parser looks
+            self.pending.append(self.hi)
+            self.hi = pos
+            return None
+        self.counts['hits'] += 1
+        value,length,looked = found
+        if pos + looked > self.hi:
+            self.hi = pos + looked
+        return value, pos + length
+
+    def put(self, key, result):
+        memo_key,pos,end,whole = key
+        value,i = result
+        looked = self.hi - pos
+        if end is self.end:
+            end = None
+        else:
+            # comparisons against an inner end (like Nested's) are not noted, so count all of it as looked at
+            end = end - pos
+            if end > looked:
+                looked = end
+        self.columns[pos][(memo_key, end, whole)] = (value, i - pos, looked)
+        if looked > self.reach[pos]:
+            self.reach[pos] = looked
+            self.changed.add(pos)
+        saved = self.pending.pop()
+        if saved > self.hi:
+            self.hi = saved
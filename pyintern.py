@@ -0,0 +1,154 @@
+"""
+Hash-consed AST nodes.
+
+A NodeStore turns recursive n-tuples into Nodes,
+    where structurally equal subtrees are one and the same object.
+Every Node remembers its hash, size (number of nodes) and depth,
+    so hashing a subtree, or comparing two subtrees from one store, is O(1).
+
+Nodes index, slice, iterate and compare like the tuples they stand for,
+    so pypm patterns match them unchanged.
+"""
+import weakref
+
+import pypm
+
+
+class Node(object):
+    """An interned AST node. Do not create these directly, use NodeStore.node or hashcons.
+        items is the tuple of the node name and arguments,
+            where argument subtrees are Nodes of the same store.
+    """
+    __slots__ = ('items', 'hash', 'size', 'depth', '__weakref__')
+
+    def __init__(self, items):
+        self.items = items
+        # equal to hash() of the plain tuple, since child Nodes hash like their tuples
+        self.hash = hash(items)
+        size,depth = 1, 0
+        for i in items:
+            if isinstance(i, Node):
+                size += i.size
+                if i.depth > depth:
+                    depth = i.depth
+        self.size = size
+        self.depth = depth + 1
+
+    def __getitem__(self, i):
+        return self.items[i]
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __contains__(self, x):
+        return x in self.items
+
+    def __hash__(self):
+        return self.hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        elif isinstance(other, Node):
+            # within one store equal nodes are identical, so this is almost always
+            # decided by the hashes
+            return self.hash == other.hash and self.items == other.items
+        elif isinstance(other, tuple):
+            return self.items == other
+        else:
+            return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __repr__(self):
+        return repr(self.items)
+
+pypm.register_node_type(Node)
+
+
+class NodeStore(object):
+    """The interning table. Holds on to every node it made until clear(),
+        or with weak=True, only as long as something else does.
+    """
+    def __init__(self, weak=False):
+        self.weak = weak
+        self.clear()
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def clear(self):
+        self.nodes = weakref.WeakValueDictionary() if self.weak else {}
+
+    def node(self, *items):
+        """Accepts a node name and arguments, where argument subtrees are already Nodes of this store.
+            Returns the one Node of this store with those items.
+        """
+        # leaves are keyed with their types, since 1, 1L, 1.0 and True are equal but not the same value,
+        #   and children by identity, since ('Num', 1) and ('Num', 1.0) are equal Nodes too
+        #   (a child lives at least as long as the entries of its parents)
+        key = tuple(id(x) if isinstance(x, Node) else (type(x), x) for x in items)
+        n = self.nodes.get(key)
+        if n is None:
+            n = Node(items)
+            self.nodes[key] = n
+        return n
+
+    def hashcons(self, ast):
+        """Accepts an ast, a recursive n-tuple (possibly with some Nodes in it).
+            Returns the equivalent Node of this store.
+
+            Iterative, so deep trees are fine;
+                subtrees shared by identity in the input are only visited once.
+        """
+        if not pypm.is_node(ast):
+            raise pypm.ASTException('AST must be a recursive n-tuple: {0}'.format(ast))
+        done = {}
+        stack = [ast]
+        while stack:
+            t = stack[-1]
+            if id(t) in done:
+                stack.pop()
+                continue
+            pending = [a for a in t if pypm.is_node(a) and id(a) not in done]
+            if pending:
+                stack.extend(pending)
+            else:
+                stack.pop()
+                items = tuple(done[id(a)][1] if pypm.is_node(a) else a for a in t)
+                # keep t alive alongside, so its id is not reused while we are working
+                done[id(t)] = (t, self.node(*items))
+        return done[id(ast)][1]
+
+# weak, so the trees interned by a long running process are freed once it drops them
+default_store = NodeStore(weak=True)
+
+def hashcons(ast, store=None):
+    """Accepts an ast. Returns its interned Node in store (default_store, which keeps no node alive, by default)."""
+    if store is None:
+        store = default_store
+    return store.hashcons(ast)
+
+def to_tuple(node):
+    """Accepts a Node (or any ast). Returns the equivalent plain recursive n-tuple."""
+    if not pypm.is_node(node):
+        return node
+    done = {}
+    stack = [node]
+    while stack:
+        t = stack[-1]
+        if id(t) in done:
+            stack.pop()
+            continue
+        pending = [a for a in t if pypm.is_node(a) and id(a) not in done]
+        if pending:
+            stack.extend(pending)
+        else:
+            stack.pop()
+            done[id(t)] = (t, tuple(done[id(a)][1] if pypm.is_node(a) else a for a in t))
+    return done[id(node)][1]
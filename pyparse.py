@@ -1,32 +1,184 @@
 import string
+import threading
+from collections import OrderedDict
 
 class ParseException(Exception):
     pass
 
+
+class Packrat(object):
+    """Memo table for one parse() call, keyed by (parser, position, end, whole).
+        Holds at most maxsize results, forgetting the oldest first.
+    """
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.clear()
+
+    def clear(self):
+        self.table = OrderedDict()
+        self.counts = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def stats(self):
+        return dict(self.counts)
+
+    def get(self, key):
+        found = self.table.get(key)
+        if found is None:
+            self.counts['misses'] += 1
+        else:
+            self.counts['hits'] += 1
+        return found
+
+    def put(self, key, result):
+        self.table[key] = result
+        if self.maxsize is not None and len(self.table) > self.maxsize:
+            self.table.popitem(last=False)
+            self.counts['evictions'] += 1
+
+_state = threading.local()
+
+def bracket_table(tokens, pairs=(('(', ')'),)):
+    """Accepts tokens and a list of (open, close) bracket pairs, each with its own open token.
+        Returns {index of an open token: index of its matching close}, in one pass over the tokens.
+            Every pair nests on its own, like Nested: other brackets in between do not matter.
+            Opens that never close are left out, closes with nothing open are skipped.
+    """
+    # open token => its stack of open indices, and close token => those stacks
+    opens = {}
+    closes = {}
+    for open_,close in pairs:
+        if open_ in opens:
+            raise ValueError('two bracket pairs open with {0!r}'.format(open_))
+        opens[open_] = []
+        if close != open_:
+            closes.setdefault(close, []).append(opens[open_])
+    table = {}
+    for i,t in enumerate(tokens):
+        try:
+            stack = opens.get(t)
+            closing = closes.get(t)
+        except TypeError:
+            # unhashable token, not a bracket
+            continue
+        if closing is not None:
+            for stacked in closing:
+                if stacked:
+                    table[stacked.pop()] = i
+        if stack is not None:
+            stack.append(i)
+    return table
+
+class Brackets(object):
+    """The bracket tables of one token buffer, for the length of a parse() call,
+        made by bracket_table the first time a Nested asks for its pair.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.tables = {}
+
+    def table(self, open_, close):
+        table = self.tables.get((open_, close))
+        if table is None:
+            table = self.tables[(open_, close)] = bracket_table(self.buf, [(open_, close)])
+        return table
+
+def find_close(buf, pos, end, open_, close):
+    """Accepts a buffer with open_ at pos.
+        Returns the index of the matching close, if it comes before end, otherwise None.
+        Looks it up in the parse's Brackets, or scans when there are none (see ASTNode.parse).
+    """
+    brackets = getattr(_state, 'brackets', None)
+    if brackets is not None and brackets.buf is buf:
+        i = brackets.table(open_, close).get(pos)
+        return i if i is not None and i < end else None
+    depth = 1
+    i = pos + 1
+    while i < end:
+        t = buf[i]
+        if t == open_:
+            depth += 1
+        elif t == close:
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return None
+
 class ASTNode(object):
-    pass
+    """Base of all parsers.
+        Parsers work on one shared token buffer and integer positions, nothing is sliced:
+            subclasses implement _parse_at(buf, pos, end, whole), which parses buf[pos:end]
+            and returns (value, new position), or (None, pos) if it does not parse.
+        parse_at() adds packrat memoization when parse(..., packrat=...) asked for it.
+        parse(s, whole) is the list-in, remaining-list-out interface on top.
+            It gives the call a Brackets for s, so every Nested finds its close bracket in constant time
+            (not for buffers that fill on demand, which the table would read to the end,
+            nor for callers of parse_at, like pyincremental, which then scan).
+    """
+    @property
+    def memo_key(self):
+        """Parsers with equal memo_keys give equal results, and share memo entries."""
+        return self
+
+    def parse(self, s, whole=False):
+        # a pytokenize.TokenBuffer is not filled yet, it has an end which fills it on demand
+        end = getattr(s, 'lazy_end', None)
+        previous = getattr(_state, 'brackets', None)
+        if end is None:
+            end = len(s)
+            if previous is None or previous.buf is not s:
+                _state.brackets = Brackets(s)
+        try:
+            value,i = self.parse_at(s, 0, end, whole)
+        finally:
+            _state.brackets = previous
+        if value is not None:
+            return value, s[i:]
+        else:
+            return None, s
+
+    def parse_at(self, buf, pos, end, whole=False):
+        memo = getattr(_state, 'memo', None)
+        if memo is None:
+            return self._parse_at(buf, pos, end, whole)
+        key = (self.memo_key, pos, end, whole)
+        found = memo.get(key)
+        if found is None:
+            found = self._parse_at(buf, pos, end, whole)
+            memo.put(key, found)
+        return found
+
+    def _parse_at(self, buf, pos, end, whole=False):
+        # parsers written against the old interface override parse(s, whole) instead
+        if type(self).parse.im_func is ASTNode.parse.im_func:
+            raise NotImplementedError('{0} must implement _parse_at'.format(type(self).__name__))
+        value,remaining = self.parse(list(buf[pos:end]), whole)
+        if value is not None:
+            return value, end - len(remaining)
+        else:
+            return None, pos
 
 class Join(ASTNode):
     def __init__(self, name, *nodes):
         self.name = name
         self.nodes = nodes
 
-    def parse(self, s, whole=False):
+    def _parse_at(self, buf, pos, end, whole=False):
         values = []
-        remaining = s
+        i = pos
         for n in self.nodes:
-            value,remaining = n.parse(remaining)
+            value,i = n.parse_at(buf, i, end)
             if value is not None:
                 values.append(value)
             else:
-                return None, s
-        if len(remaining) == 0 or not whole:
+                return None, pos
+        if i == end or not whole:
             if self.name is not None:
-                return ((self.name,) + tuple(values)), remaining
+                return ((self.name,) + tuple(values)), i
             else:
-                return tuple(values), remaining
+                return tuple(values), i
         else:
-            return None, s
+            return None, pos
 
 
 class Keyword(ASTNode):
@@ -34,68 +186,103 @@ class Keyword(ASTNode):
         self.keyword = keyword
         self.name = name
 
-    def parse(self, s, whole=False):
+    @property
+    def memo_key(self):
+        return (type(self), self.keyword, self.name)
+
+    def _parse_at(self, buf, pos, end, whole=False):
         #TODO: jperla: make whole decorator
-        if s[:len(self.keyword)] == list(self.keyword):
-            remaining = s[len(self.keyword):]
-            if self.name is None:
-                return self.keyword, remaining
-            else:
-                return (self.name, self.keyword), remaining
+        k = len(self.keyword)
+        if pos + k > end:
+            return None, pos
+        for j,c in enumerate(self.keyword):
+            if buf[pos + j] != c:
+                return None, pos
+        if self.name is None:
+            return self.keyword, pos + k
         else:
-            return None, s
+            return (self.name, self.keyword), pos + k
 
 class Symbol(ASTNode):
     def __init__(self, value):
         self.name = value
 
-    def parse(self, s, whole=False):
-        if len(s) != 1:
-            return None, s
+    @property
+    def memo_key(self):
+        return (type(self), self.name)
+
+    def _parse_at(self, buf, pos, end, whole=False):
+        if pos < end and buf[pos] == self.name:
+            return self.name, pos + 1
         else:
-            if len(s) > 0 and s[0] == self.name:
-                return self.name, s[1:]
-            else:
-                return None, s
+            return None, pos
 
 class ContiguousSymbols(ASTNode):
     def __init__(self, name, symbols):
         self.name = name
         self.symbols = symbols
 
-    def parse(self, s, whole=False):
+    @property
+    def memo_key(self):
+        return (type(self), self.name, self.symbols)
+
+    def _parse_at(self, buf, pos, end, whole=False):
         #TODO: jperla: ignores whole argument
-        i = 0
-        while i < len(s) and s[i] in self.symbols:
+        i = pos
+        while i < end and buf[i] in self.symbols:
             i += 1
-        if i == 0:
-            return None, s
+        if i == pos:
+            return None, pos
         else:
-            return (self.name, ''.join(s[:i])), s[i:]
+            return (self.name, ''.join(buf[pos:i])), i
+
+class Kind(ASTNode):
+    """Matches one token of the given kind, for multi-character tokens from pytokenize.
+        Returns the token text, or convert(text), as (name, value) if name is given.
+    """
+    def __init__(self, kind, name=None, convert=None):
+        self.kind = kind
+        self.name = name
+        self.convert = convert
+
+    @property
+    def memo_key(self):
+        return (type(self), self.kind, self.name, self.convert)
+
+    def _parse_at(self, buf, pos, end, whole=False):
+        if pos < end and getattr(buf[pos], 'kind', None) == self.kind:
+            value = str(buf[pos])
+            if self.convert is not None:
+                value = self.convert(value)
+            if self.name is not None:
+                value = (self.name, value)
+            return value, pos + 1
+        else:
+            return None, pos
 
 class AlphaWord(ContiguousSymbols):
     def __init__(self):
         ContiguousSymbols.__init__(self, 'WORD', string.ascii_letters + '.')
 
-    def parse(self, s, whole=False):
-        value,remaining = ContiguousSymbols.parse(self, s)
-        if value is not None and (len(remaining) == 0 or not whole):
+    def _parse_at(self, buf, pos, end, whole=False):
+        value,i = ContiguousSymbols._parse_at(self, buf, pos, end)
+        if value is not None and (i == end or not whole):
             n,v = value
-            return v, remaining
+            return v, i
         else:
-            return None, s
+            return None, pos
 
 class Int(ContiguousSymbols):
     def __init__(self):
         ContiguousSymbols.__init__(self, 'Num', '0123456789')
 
-    def parse(self, s, whole=False):
-        value,remaining = ContiguousSymbols.parse(self, s)
+    def _parse_at(self, buf, pos, end, whole=False):
+        value,i = ContiguousSymbols._parse_at(self, buf, pos, end)
         if value is not None:
             n,v = value
-            return (n, int(v)), remaining
+            return (n, int(v)), i
         else:
-            return None, s
+            return None, pos
 
 class Nested(ASTNode):
     def __init__(self, open_='(', close=')', content=None, ignore=None):
@@ -104,44 +291,35 @@ class Nested(ASTNode):
         self.content = content
         self.ignore = ignore
 
-    def parse(self, s, whole=False):
+    def _parse_at(self, buf, pos, end, whole=False):
         # do not do content ignoring (doesn't support parentheses in quotes)
         assert self.ignore == None
-        stack = []
-        if len(s) > 0 and s[0] == self.open_:
-            stack = [s[0]]
-            i = 1
-
+        if pos < end and buf[pos] == self.open_:
             # nested expression, (e.g. look for matching parenthesis)
-            while len(stack) > 0 and i < len(s):
-                if s[i] == self.open_:
-                    stack.append(s[i])
-                elif s[i] == self.close:
-                    stack.pop()
-                i += 1
+            after = find_close(buf, pos, end, self.open_, self.close)
 
-            if len(stack) == 0:
-                inner_tokens, remaining = s[1:i-1], s[i:]
+            if after is not None:
+                inner,i = pos + 1, after + 1
                 if self.content is not None:
-                    inner_ast, r = self.content.parse(inner_tokens, whole=False)
-                    if len(r) == 0:
+                    inner_ast, r = self.content.parse_at(buf, inner, after, whole=False)
+                    if inner_ast is not None and r == after:
                         # nested expression found, and 
                         # inner content parsed
-                        return inner_ast, remaining
+                        return inner_ast, i
                     else:
                         # inner content of nested expression
                         # does not parse to self.content
-                        return None, s
+                        return None, pos
                 else:
                     # no content parser, just return raw string/tokens
-                    return inner_tokens, remaining
+                    return list(buf[inner:after]), i
             else:
                 # nested expression did not close (e.g. no close parenthesis)
-                return None, s
+                return None, pos
         else:
             # empty string, or first character doesn't open nested expression
             # (e.g. no open parenthesis at beginning)
-            return None, s
+            return None, pos
             
         
 
@@ -149,29 +327,29 @@ class Any(ASTNode):
     def __init__(self, *nodes):
         self.nodes = nodes
 
-    def parse(self, s, whole=False):
+    def _parse_at(self, buf, pos, end, whole=False):
         for n in self.nodes:
-            value,remaining = n.parse(s)
+            value,i = n.parse_at(buf, pos, end)
             if value is not None:
-                if not whole or remaining == []:
-                    return value, remaining
+                if not whole or i == end:
+                    return value, i
         else:
-            return None, s
+            return None, pos
 
 class Repeat(ASTNode):
     def __init__(self, parser):
         self.parser = parser
 
-    def parse(self, s, whole=False):
+    def _parse_at(self, buf, pos, end, whole=False):
         parsed = []
-        remaining = s
-        while remaining is None or len(remaining) > 0:
-            ast, remaining = self.parser.parse(remaining, whole=False)
+        i = pos
+        while i < end:
+            ast,i = self.parser.parse_at(buf, i, end, whole=False)
             if ast is not None:
                 parsed.append(ast)
             else:
                 break
-        return tuple(parsed), remaining
+        return tuple(parsed), i
 
 
 class Recursive(ASTNode):
@@ -179,18 +357,107 @@ class Recursive(ASTNode):
         self.name = name
         self.parser = p
 
-    def parse(self, s, whole=False):
-        value,remaining = self.parser.parse(s, whole)
+    def _parse_at(self, buf, pos, end, whole=False):
+        value,i = self.parser.parse_at(buf, pos, end, whole)
         if value is not None:
             if self.name is not None:
-                return (self.name, value), remaining
+                return (self.name, value), i
             else:
-                return value, remaining
+                return value, i
         else:
-            return None, s
+            return None, pos
+
+class Precedence(ASTNode):
+    """Operator-precedence (Pratt) expressions: operand (operator operand)*,
+            parsed in a loop and grouped by binding power, into (name, lhs, operator, rhs) nodes.
+        operators is a list of (operator, binding power, 'left' or 'right'),
+            where operator is a parser, or a token for Symbol(token). The first operator that parses wins.
+        Higher binding power groups tighter:
+            Precedence(Int(), [('*', 20, 'left'), ('+', 10, 'left')]) parses 1+2*3
+            as ('OP', ('Num', 1), '+', ('OP', ('Num', 2), '*', ('Num', 3))).
+    """
+    def __init__(self, operand, operators, name='OP'):
+        self.operand = operand
+        self.operators = []
+        for op,power,assoc in operators:
+            if assoc not in ('left', 'right'):
+                raise ValueError('associativity must be "left" or "right": {0}'.format(assoc))
+            if not isinstance(op, ASTNode):
+                op = Symbol(op)
+            self.operators.append((op, power, assoc))
+        self.name = name
 
-def parse(p, s, whole=False):
-    return p.parse(s, whole)
+    def _parse_at(self, buf, pos, end, whole=False):
+        return _climb(self.operand.parse_at,
+                      [(op.parse_at, power, assoc == 'left') for op,power,assoc in self.operators],
+                      self.name, buf, pos, end, whole)
+
+def _climb(operand, operators, name, buf, pos, end, whole):
+    """Shunting-yard over an operand parser and (operator parser, power, left) triples.
+        Keeps its own stacks, so long chains cost no Python frames.
+    """
+    value,i = operand(buf, pos, end, False)
+    if value is None:
+        return None, pos
+    values,ops = [value], []
+    while True:
+        for op,power,left in operators:
+            opvalue,j = op(buf, i, end, False)
+            if opvalue is not None:
+                break
+        else:
+            break
+        rhs,k = operand(buf, j, end, False)
+        if rhs is None:
+            # leave the dangling operator to whoever comes next
+            break
+        while ops and (ops[-1][1] > power or (ops[-1][1] == power and left)):
+            o = ops.pop()
+            r = values.pop()
+            values[-1] = (name, values[-1], o[0], r)
+        ops.append((opvalue, power))
+        values.append(rhs)
+        i = k
+    while ops:
+        o = ops.pop()
+        r = values.pop()
+        values[-1] = (name, values[-1], o[0], r)
+    if whole and i != end:
+        return None, pos
+    return values[0], i
+
+def parse(p, s, whole=False, packrat=None, events=False):
+    """Accepts a parser and a list of tokens.
+        Returns (ast, remaining tokens), ast is None if it does not parse.
+
+        packrat=True, or a Packrat instance, remembers the result of every parser 
+            at every position for the length of this call, so no parser runs twice at one place.
+            Pass in a Packrat to read its stats() afterwards.
+        events=True returns the ast as pystream events instead (for pystream.match_events),
+            an iterator of (kind, value), or None if it does not parse.
+            The parsers backtrack, so no node is known to be part of the result before the parse is done:
+            the ast is still built, and the events are read off it, without recursion.
+    """
+    if not packrat:
+        ast,remaining = p.parse(s, whole)
+    else:
+        if packrat is True:
+            packrat = Packrat()
+        else:
+            packrat.clear()
+        previous = getattr(_state, 'memo', None)
+        _state.memo = packrat
+        try:
+            ast,remaining = p.parse(s, whole)
+        finally:
+            _state.memo = previous
+            # only the statistics outlive the call
+            packrat.table = OrderedDict()
+    if events and ast is not None:
+        # imported here, pystream needs pypm, which the parsers do not
+        import pystream
+        return pystream.events_from_ast(ast), remaining
+    return ast, remaining
     
 
 def whitespace_tokenize(s):
@@ -201,6 +468,284 @@ def whitespace_tokenize(s):
     """
     return [c for c in s if c not in ' \r\n']
 
+
+"""
+Grammar compilation.
+
+compile_grammar(p) analyzes the parser graph under p and computes, for every parser,
+    its FIRST set (the tokens it can start with) and whether it can succeed on no input.
+Every Any then looks at the next token and only tries the alternatives that can start with it.
+The graph is also flattened into plain closures, one per parser, which call each other directly
+    instead of going through parse_at (so packrat memoization does not apply inside).
+The compiled parser returns the same ASTs as the combinators it was made from.
+"""
+_ANYTOKEN = None
+
+def _union(a, b):
+    if a is _ANYTOKEN or b is _ANYTOKEN:
+        return _ANYTOKEN
+    return a | b
+
+def _children(p):
+    if isinstance(p, (Join, Any)):
+        return list(p.nodes)
+    elif isinstance(p, (Repeat, Recursive)):
+        return [p.parser]
+    elif isinstance(p, Nested) and p.content is not None:
+        return [p.content]
+    elif isinstance(p, Precedence):
+        return [p.operand] + [op for op,power,assoc in p.operators]
+    else:
+        return []
+
+def _all_parsers(p):
+    seen,order,stack = set(), [], [p]
+    while stack:
+        q = stack.pop()
+        if id(q) not in seen:
+            seen.add(id(q))
+            order.append(q)
+            stack.extend(_children(q))
+    return order
+
+def first_sets(p):
+    """Accepts a parser.
+        Returns a dictionary from id() of every parser in its graph to (FIRST, nullable):
+            FIRST is a frozenset of tokens, or None if any token may do;
+            nullable is whether it can succeed without consuming a token.
+    """
+    parsers = _all_parsers(p)
+    first = dict((id(q), (frozenset(), False)) for q in parsers)
+
+    def compute(q):
+        t = type(q)
+        if t is Symbol:
+            return frozenset([q.name]), False
+        elif t is Keyword:
+            if len(q.keyword) == 0:
+                return frozenset(), True
+            return frozenset([list(q.keyword)[0]]), False
+        elif t in (ContiguousSymbols, Int, AlphaWord):
+            return frozenset(q.symbols), False
+        elif t is Nested:
+            return frozenset([q.open_]), False
+        elif t is Join:
+            tokens,nullable = frozenset(), True
+            for n in q.nodes:
+                f,e = first[id(n)]
+                tokens = _union(tokens, f)
+                if not e:
+                    nullable = False
+                    break
+            return tokens, nullable
+        elif t is Any:
+            tokens,nullable = frozenset(), False
+            for n in q.nodes:
+                f,e = first[id(n)]
+                tokens = _union(tokens, f)
+                nullable = nullable or e
+            return tokens, nullable
+        elif t is Repeat:
+            return first[id(q.parser)][0], True
+        elif t is Recursive:
+            return first[id(q.parser)]
+        elif t is Precedence:
+            return first[id(q.operand)]
+        else:
+            # Kind, subclasses, or parsers we know nothing about
+            return _ANYTOKEN, True
+
+    changed = True
+    while changed:
+        changed = False
+        for q in parsers:
+            f = compute(q)
+            if f != first[id(q)]:
+                first[id(q)] = f
+                changed = True
+    return first
+
+class CompiledParser(ASTNode):
+    """A parser made by compile_grammar."""
+    def __init__(self, parser, run):
+        self.parser = parser
+        self.run = run
+
+    def _parse_at(self, buf, pos, end, whole=False):
+        return self.run(buf, pos, end, whole)
+
+def compile_grammar(p):
+    """Accepts a parser. Returns an equivalent CompiledParser."""
+    first = first_sets(p)
+    compiled = {}
+    # Recursive parsers may be reached before their closure exists, go through a cell
+    cells = {}
+
+    def closure(q):
+        if id(q) in compiled:
+            return compiled[id(q)]
+        if isinstance(q, Recursive):
+            if id(q) not in cells:
+                cells[id(q)] = [None]
+                cells[id(q)][0] = _compile_one(q, closure, first)
+            cell = cells[id(q)]
+            f = lambda buf, pos, end, whole=False: cell[0](buf, pos, end, whole)
+        else:
+            f = _compile_one(q, closure, first)
+        compiled[id(q)] = f
+        return f
+
+    return CompiledParser(p, closure(p))
+
+def _compile_one(q, closure, first):
+    if type(q) is Symbol:
+        name = q.name
+        def symbol(buf, pos, end, whole=False):
+            if pos < end and buf[pos] == name:
+                return name, pos + 1
+            return None, pos
+        return symbol
+
+    elif type(q) is Keyword:
+        keyword,name,k = q.keyword, q.name, len(q.keyword)
+        chars = list(keyword)
+        value = keyword if name is None else (name, keyword)
+        def keyword_(buf, pos, end, whole=False):
+            if pos + k > end:
+                return None, pos
+            for j,c in enumerate(chars):
+                if buf[pos + j] != c:
+                    return None, pos
+            return value, pos + k
+        return keyword_
+
+    elif type(q) in (ContiguousSymbols, Int, AlphaWord):
+        name,symbols = q.name, q.symbols
+        kind = 'int' if type(q) is Int else 'word' if type(q) is AlphaWord else None
+        def contiguous(buf, pos, end, whole=False):
+            i = pos
+            while i < end and buf[i] in symbols:
+                i += 1
+            if i == pos:
+                return None, pos
+            v = ''.join(buf[pos:i])
+            if kind == 'int':
+                return (name, int(v)), i
+            elif kind == 'word':
+                if i == end or not whole:
+                    return v, i
+                return None, pos
+            return (name, v), i
+        return contiguous
+
+    elif type(q) is Nested:
+        open_,close = q.open_, q.close
+        content = closure(q.content) if q.content is not None else None
+        assert q.ignore == None
+        def nested(buf, pos, end, whole=False):
+            if not (pos < end and buf[pos] == open_):
+                return None, pos
+            i = find_close(buf, pos, end, open_, close)
+            if i is None:
+                return None, pos
+            i += 1
+            if content is None:
+                return list(buf[pos+1:i-1]), i
+            inner_ast,r = content(buf, pos + 1, i - 1, False)
+            if inner_ast is not None and r == i - 1:
+                return inner_ast, i
+            return None, pos
+        return nested
+
+    elif type(q) is Join:
+        name = q.name
+        nodes = [closure(n) for n in q.nodes]
+        def join(buf, pos, end, whole=False):
+            values = []
+            i = pos
+            for n in nodes:
+                value,i = n(buf, i, end, False)
+                if value is None:
+                    return None, pos
+                values.append(value)
+            if i == end or not whole:
+                if name is not None:
+                    return (name,) + tuple(values), i
+                return tuple(values), i
+            return None, pos
+        return join
+
+    elif type(q) is Any:
+        alternatives = [(closure(n),) + first[id(n)] for n in q.nodes]
+        everything = [f for f,tokens,nullable in alternatives]
+        # tokens outside every FIRST set, and the end of the input
+        default = [f for f,tokens,nullable in alternatives if tokens is _ANYTOKEN or nullable]
+        at_end = [f for f,tokens,nullable in alternatives if nullable]
+        table = {}
+        for f,tokens,nullable in alternatives:
+            if tokens is not _ANYTOKEN:
+                for t in tokens:
+                    table[t] = None
+        for t in table:
+            table[t] = [f for f,tokens,nullable in alternatives
+                            if tokens is _ANYTOKEN or nullable or t in tokens]
+
+        def any_(buf, pos, end, whole=False):
+            if pos < end:
+                t = buf[pos]
+                try:
+                    alts = table.get(t)
+                except TypeError:
+                    alts = None
+                if alts is None:
+                    # a token which is not a single character could still be
+                    # "in" a ContiguousSymbols string, take the slow road
+                    alts = default if isinstance(t, basestring) and len(t) == 1 else everything
+            else:
+                alts = at_end
+            for f in alts:
+                value,i = f(buf, pos, end, False)
+                if value is not None and (not whole or i == end):
+                    return value, i
+            return None, pos
+        return any_
+
+    elif type(q) is Repeat:
+        parser = closure(q.parser)
+        def repeat(buf, pos, end, whole=False):
+            parsed = []
+            i = pos
+            while i < end:
+                ast,i = parser(buf, i, end, False)
+                if ast is None:
+                    break
+                parsed.append(ast)
+            return tuple(parsed), i
+        return repeat
+
+    elif type(q) is Recursive:
+        name = q.name
+        parser = closure(q.parser)
+        def recursive(buf, pos, end, whole=False):
+            value,i = parser(buf, pos, end, whole)
+            if value is None:
+                return None, pos
+            if name is not None:
+                return (name, value), i
+            return value, i
+        return recursive
+
+    elif type(q) is Precedence:
+        operand,name = closure(q.operand), q.name
+        operators = [(closure(op), power, assoc == 'left') for op,power,assoc in q.operators]
+        def precedence(buf, pos, end, whole=False):
+            return _climb(operand, operators, name, buf, pos, end, whole)
+        return precedence
+
+    else:
+        # Kind, subclasses, or parsers we know nothing about run as they are
+        return q.parse_at
+
 # todo: nested parentheses / brackets etc
 
 simple_expression = Recursive()
@@ -210,6 +755,9 @@ opsymbol = Any(Symbol('*'), Symbol('+'), Symbol('-'))
 operation = Join('OP', Int(), opsymbol, simple_expression)
 simple_expression.update('EXPR', Any(operation, Int()))
 
+# like simple_expression, but with precedence, left associative, and without EXPR wrappers
+arith_expression = Precedence(Int(), [('*', 20, 'left'), ('+', 10, 'left'), ('-', 10, 'left')])
+
 
 if __name__=='__main__':
     s = '5334'
@@ -0,0 +1,199 @@
+"""
+A pass manager, which runs a pipeline of rewrite passes in as few traversals as it can.
+
+    manager = PassManager([fold_constants, Pass(evalMinus, strategy='topdown'), simplify])
+    result = manager.run(tree)
+    print manager.report()
+
+A pass is a rule set (a pattern list or a @patternmatch function, like pyrewrite takes),
+    applied once to every node: pyrewrite.rewrite(rules, ast, strategy, fixpoint=False).
+Run one after the other, every pass walks and rebuilds the whole tree.
+
+Consecutive bottom up passes are fused into one traversal instead:
+    every node of the input is visited once, children first,
+    and all of the passes of the group run on it, each on the result of the one before.
+Every node keeps its chain, its result after each pass of the group,
+    so a pass finds the results for the children of its input already there.
+Only when a rule rewrote the node do the later passes walk into the new node,
+    with the children's chains as a memo (by identity) for the subtrees it kept.
+The result is the one the passes give one after the other, provided their functions are pure.
+
+A top down pass decides at a node whether to look at its children at all,
+    so it cannot run ahead on the children, and runs in its own traversal. So does a Pass(fusible=False),
+    for passes which should not be interleaved (like ones with side effects).
+"""
+import time
+from itertools import imap,izip
+from operator import is_not
+
+import pypm
+import pyrewrite
+
+
+class Pass(object):
+    """Accepts rules (a pattern list or a @patternmatch function), a name,
+        the strategy ('bottomup' or 'topdown', as for pyrewrite.rewrite)
+        and whether it may be fused with its neighbours.
+    """
+    def __init__(self, rules, name=None, strategy='bottomup', fusible=True):
+        if strategy not in ('bottomup', 'topdown'):
+            raise ValueError('strategy must be "bottomup" or "topdown": {0}'.format(strategy))
+        self.rules = rules
+        self.name = name
+        self.strategy = strategy
+        self.fusible = fusible and strategy == 'bottomup'
+        self.apply_rules = None
+
+    def compiled(self):
+        if self.apply_rules is None:
+            self.apply_rules = pyrewrite.compile_rewrite_rules(self.rules)
+        return self.apply_rules
+
+def _bottomup(apply_rules, ast, memo, counts):
+    """Accepts a pass's rules, an AST, the pass's memo (input id => (input, result)) and its counters.
+        Returns the AST rewritten bottom up, once per node, and adds every subtree it rewrote to the memo.
+    """
+    if not pypm.is_node(ast):
+        # an earlier pass made a leaf of it
+        return ast
+    if id(ast) in memo:
+        return memo[id(ast)][1]
+    r,steps = pyrewrite._rewrite(apply_rules, ast, False, False, memo=memo)
+    counts['rewrites'] += steps
+    return r
+
+class PassManager(object):
+    """Accepts the passes, in order: Pass objects, or rule sets (bottom up passes).
+        Passes without a name are called pass0, pass1, ... by their position.
+        run(ast) runs them all. stats() and report() add up the runs so far, clear() starts over.
+    """
+    def __init__(self, passes):
+        self.passes = [p if isinstance(p, Pass) else Pass(p) for p in passes]
+        for i,p in enumerate(self.passes):
+            if p.name is None:
+                p.name = 'pass{0}'.format(i)
+        self.clear()
+
+    def clear(self):
+        self.runs = 0
+        self.traversals = 0
+        self.counts = [{'seconds': 0.0, 'rewrites': 0} for p in self.passes]
+
+    def groups(self):
+        """Returns the traversals of a run: lists of pass indices, the fused ones together."""
+        groups = []
+        for i,p in enumerate(self.passes):
+            if p.fusible and groups and self.passes[groups[-1][-1]].fusible:
+                groups[-1].append(i)
+            else:
+                groups.append([i])
+        return groups
+
+    def run(self, ast):
+        """Accepts an AST. Returns it rewritten by every pass, in order."""
+        pypm.check_ast(ast)
+        timer = time.time
+        for group in self.groups():
+            if not pypm.is_node(ast):
+                # an earlier pass made a leaf of the whole tree, which rules do not apply to
+                break
+            self.traversals += 1
+            if len(group) == 1 and not self.passes[group[0]].fusible:
+                i = group[0]
+                p = self.passes[i]
+                start = timer()
+                ast = pyrewrite.rewrite(p.compiled(), ast, p.strategy, fixpoint=False)
+                self.counts[i]['seconds'] += timer() - start
+                continue
+            ast = self._fused(group, ast)
+        self.runs += 1
+        return ast
+
+    def _fused(self, group, ast):
+        """Runs the bottom up passes of the group over the AST, in one traversal of it.
+            Every node of the input gets its chain: its result after each of the passes.
+        """
+        timer = time.time
+        rules = [self.passes[i].compiled() for i in group]
+        counts = [self.counts[i] for i in group]
+        k = len(rules)
+        rewrites = [0] * k
+        seconds = [0.0] * k
+        is_node = pypm.is_node
+        NOT_MATCHED = pypm.NOT_MATCHED
+        # node id => (node, chain), so shared subtrees are done once
+        done = {}
+        # a frame is [node, next child index, chains of the children (None for leaves)]
+        stack = [[ast, 0, []]]
+        while True:
+            frame = stack[-1]
+            node,i,chains = frame
+            if i < len(node):
+                frame[1] = i + 1
+                a = node[i]
+                if not is_node(a):
+                    chains.append(None)
+                elif id(a) in done:
+                    chains.append(done[id(a)][1])
+                else:
+                    stack.append([a, 0, []])
+                continue
+
+            stack.pop()
+            chain = []
+            # while no rule fired on the node, its children after each pass are in their chains;
+            #   once one did, the later passes walk the new node, knowing the children's results
+            x = node
+            previous = node
+            fired = False
+            start = timer()
+            for p in xrange(k):
+                if not fired:
+                    items = [y if c is None else c[p] for y,c in izip(previous, chains)]
+                    rebuilt = tuple(items) if any(imap(is_not, items, previous)) else x
+                    previous = items
+                    r = rules[p](rebuilt)
+                    if r is NOT_MATCHED:
+                        x = rebuilt
+                    else:
+                        rewrites[p] += 1
+                        x = r
+                        fired = True
+                else:
+                    memo = dict((id(c[p - 1]), (c[p - 1], c[p])) for c in chains if c is not None)
+                    x = _bottomup(rules[p], x, memo, counts[p])
+                chain.append(x)
+                now = timer()
+                seconds[p] += now - start
+                start = now
+            done[id(node)] = (node, chain)
+            if not stack:
+                for c,n,t in izip(counts, rewrites, seconds):
+                    c['rewrites'] += n
+                    c['seconds'] += t
+                return chain[-1]
+            stack[-1][2].append(chain)
+
+    def stats(self):
+        """Returns {'runs': ..., 'traversals': ..., 'saved': traversals saved by fusing,
+            'passes': [per pass name, strategy, fused, seconds and rewrites, in order]}.
+        """
+        fused = set(i for group in self.groups() if len(group) > 1 for i in group)
+        passes = []
+        for i,(p,c) in enumerate(zip(self.passes, self.counts)):
+            passes.append({'name': p.name, 'strategy': p.strategy, 'fused': i in fused,
+                           'seconds': c['seconds'], 'rewrites': c['rewrites']})
+        return {'runs': self.runs, 'traversals': self.traversals,
+                'saved': self.runs * len(self.passes) - self.traversals, 'passes': passes}
+
+    def report(self):
+        """Returns the stats as a table, in pass order."""
+        stats = self.stats()
+        lines = ['{0} runs, {1} traversals, {2} saved by fusing'.format(
+                    stats['runs'], stats['traversals'], stats['saved']),
+                 '{0:>4} {1:<24} {2:<9} {3:<5} {4:>10} {5:>9}'.format(
+                    'pass', 'name', 'strategy', 'fused', 'seconds', 'rewrites')]
+        for i,p in enumerate(stats['passes']):
+            lines.append('{0:>4} {1:<24} {2:<9} {3:<5} {4:>10.6f} {5:>9}'.format(
+                    i, p['name'], p['strategy'], 'yes' if p['fused'] else 'no', p['seconds'], p['rewrites']))
+        return '\n'.join(lines) + '\n'
@@ -9,8 +9,16 @@ Pattern Matching makes it much easier to build compilers,
     programming languages, optimizers, and language transformers.
 """
 import copy
+import hashlib
+import marshal
+import os
 import string
+import sys
+import threading
+import time
 import types
+from bisect import bisect_right
+from collections import OrderedDict
 from itertools import izip
 
 
@@ -54,7 +62,24 @@ anynode = AnyNode('anynode')
 starargs = StarArgs('starargs')
 _ = PatternMatchVar('_')
 for asc in string.ascii_lowercase:
-    exec('{0} = PatternMatchVar("{0}")'.format(asc))
+    globals()[asc] = PatternMatchVar(asc)
+
+"""
+Types of AST nodes. Plain tuples always are;
+    other tuple-like classes (see pyintern) are added with register_node_type.
+"""
+_node_types = (tuple,)
+
+def register_node_type(cls):
+    """Accepts a class whose instances behave like tuples (len, indexing, slicing, iteration).
+        Afterwards its instances are treated as AST nodes everywhere, like tuples.
+    """
+    global _node_types
+    if cls not in _node_types:
+        _node_types = _node_types + (cls,)
+
+def is_node(ast):
+    return isinstance(ast, _node_types)
 
 class UnknownPattern(Exception):
     pass
@@ -109,14 +134,16 @@ def match_and_extract_matched_vars(pattern, ast, matched=None):
     else:
         # check that the guard returns true
         if guard:
-            def is_guard_correct(m, g):
-                v = g(*order_matched(m, g))
-                assert isinstance(v, bool), "Guard must return true or false"
-                return v
             if not is_guard_correct(matched, guard):
                 return None
         return matched
 
+def is_guard_correct(matched, guard):
+    """Accepts a matched dictionary and a guard. Returns the guard's verdict on the matched variables."""
+    v = guard(*order_matched(matched, guard))
+    assert isinstance(v, bool), "Guard must return true or false"
+    return v
+
 def order_matched(matched, function):
     """Accepts a matched dictionary from string variable name => AST, and a function.
         Looks at function, and figures out the order of the variable names.
@@ -173,19 +200,953 @@ def check_ast(ast):
     """Accepts an ast which is a recursive n-tuple.
         Ensures that it is or throws exceptions.
     """
-    if not isinstance(ast, tuple):
+    if not isinstance(ast, _node_types):
         raise ASTException('AST must be a recursive n-tuple: {0}'.format(ast))
 
+def split_guard(key):
+    """Accepts a pattern key, which is either a pattern or a (pattern, guard) 2-tuple.
+        Returns a (pattern, guard) 2-tuple, where guard is None if there is no guard.
+    """
+    if len(key) == 2 and isinstance(key[1], types.LambdaType):
+        return key
+    else:
+        return key, None
+
+
+"""
+Discrimination net.
+
+The pattern list is compiled once into a decision tree.
+Every switch in the tree looks at one position (a path of indices) in the AST,
+    and splits the rules still alive by what they need at that position:
+    a constant, a tuple of some length, or anything at all.
+Rules keep their relative order in every branch, so the first rule
+    that reaches a leaf is the same rule that trying every pattern in order would find.
+A failed guard falls through to a tree built from the rules after it.
+    Everything already tested is not tested again there, so rules which only differ
+    in their guards share one match, and just try their guards one after the other.
+
+The tree is plain tuples, dicts and lists:
+    (_SWITCH, path, consts, lengths, star_ks, star_trees, other)
+    (_LEAF, rule index, fallback tree or None)
+    (_FAIL,)
+"""
+_SWITCH, _LEAF, _FAIL = 0, 1, 2
+_NO_MATCH = (_FAIL,)
+
+def _is_wild(p):
+    return isinstance(p, PatternMatchVar) or isinstance(p, AnyNode)
+
+def _is_star(p):
+    return isinstance(p, tuple) and len(p) > 0 and isinstance(p[-1], StarArgs)
+
+def binding_paths(pattern, path=(), paths=None):
+    """Accepts a pattern (without a guard).
+        Returns a dictionary from variable name to (path, start).
+            path is the tuple of indices where the variable sits in a matching AST.
+            start is None, or for StarArgs, the index from which the node arguments are taken.
+    """
+    if paths is None:
+        paths = {}
+    for i,p in enumerate(pattern):
+        if isinstance(p, tuple):
+            binding_paths(p, path + (i,), paths)
+        elif isinstance(p, PatternVar):
+            assert p.label not in paths, ('Cannot reusing pattern match variables!: %s' % (pattern,))
+            if isinstance(p, StarArgs):
+                paths[p.label] = (path, i)
+            else:
+                paths[p.label] = (path + (i,), None)
+    return paths
+
+
+"""
+Generated matchers.
+
+Each pattern is turned into the source of a small Python function with the
+    pattern shape built in: the length and constant checks are written out
+    one by one, and the function returns the arguments of the lambda,
+    in the lambda's own order, as a tuple.
+match_and_extract_matched_vars and order_matched remain the reference
+    these functions must agree with.
+"""
+def _local(path):
+    return 'ast' + ''.join('_%d' % i for i in path)
+
+def _binding_expr(path, start, chained=False):
+    """Accepts a binding path.
+        Returns the source of an expression for the bound value,
+            using the locals of the checks, or indexing from ast itself if chained is True.
+    """
+    if chained:
+        name = 'ast' + ''.join('[%d]' % i for i in path)
+        return name if start is None else '%s[%d:]' % (name, start)
+    elif start is not None:
+        return '%s[%d:]' % (_local(path), start)
+    elif len(path) == 0:
+        return 'ast'
+    else:
+        return '%s[%d]' % (_local(path[:-1]), path[-1])
+
+def _codegen_checks(pattern, path, lines, consts, bound=None, exact=False):
+    """Appends the checks for pattern at path to lines, in pattern order.
+        bound, if given, is called with the label of every variable as soon as the checks so far bind it.
+        exact=True checks that every node has its pattern's length, not that it is at least as long.
+    """
+    name = _local(path)
+    if _is_star(pattern):
+        lines.append('if len(%s) < %d: return None' % (name, len(pattern) - 1))
+    elif exact:
+        lines.append('if len(%s) != %d: return None' % (name, len(pattern)))
+    else:
+        lines.append('if len(%s) < %d: return None' % (name, len(pattern)))
+    for i,p in enumerate(pattern):
+        if isinstance(p, tuple):
+            child = _local(path + (i,))
+            lines.append('%s = %s[%d]' % (child, name, i))
+            lines.append('if not isinstance(%s, _node_types): return None' % child)
+            _codegen_checks(p, path + (i,), lines, consts, bound, exact)
+        elif isinstance(p, PatternVar):
+            if bound is not None:
+                bound(p.label)
+        else:
+            k = '_k%d' % len(consts)
+            consts[k] = p
+            lines.append('if %s != %s[%d]: return None' % (k, name, i))
+
+def _codegen_args(paths, function, chained):
+    """Accepts binding_paths and a function.
+        Returns the source of a tuple expression of the function's arguments,
+            or None if the function uses a name the pattern does not bind.
+    """
+    exprs = []
+    for v in function.func_code.co_varnames:
+        if v not in paths:
+            return None
+        exprs.append(_binding_expr(paths[v][0], paths[v][1], chained))
+    return '(%s)' % ''.join(e + ', ' for e in exprs)
+
+def _codegen_call(paths, function, name, lines, chained):
+    args = _codegen_args(paths, function, chained)
+    if args is None:
+        missing = [v for v in function.func_code.co_varnames if v not in paths][0]
+        lines.append('raise Exception(%r)' % ('Function uses argument not used in pattern: %s' % missing))
+    else:
+        lines.append('%s = %s' % (name, args))
+
+def _codegen_guard(paths, guard, lines, chained):
+    _codegen_call(paths, guard, 'g', lines, chained)
+    lines.append('v = _guard(*g)')
+    lines.append('assert isinstance(v, bool), "Guard must return true or false"')
+
+def _define(name, lines, namespace):
+    """Accepts a function name, its body lines, and the constants it uses.
+        The constants are bound as default arguments, so they are fast locals,
+            while globals (like _node_types) are this module's.
+    """
+    names = sorted(namespace)
+    source = 'def %s(ast%s):\n%s\n' % (name, ''.join(', %s=%s' % (n, n) for n in names),
+                                        ''.join('    %s\n' % l for l in lines))
+    code = compile(source, '<pypm %s>' % name, 'exec')
+    exec code in namespace
+    f = namespace[name]
+    f = types.FunctionType(f.func_code, globals(), name, f.func_defaults)
+    f.source = source
+    return f
+
+def compile_pattern(key, function, exact=False):
+    """Accepts a pattern key (a pattern, or a (pattern, guard) 2-tuple), 
+            and the function which will be called on a match.
+        Returns a generated function which accepts an ast.
+            It returns the tuple of arguments for function, in the order of its arguments,
+            or None if the ast does not match the pattern (or the guard says no).
+        Equivalent to match_and_extract_matched_vars followed by order_matched,
+            except that a node shorter than its pattern does not match.
+        exact=True only matches nodes of the pattern's own length (or longer, if it ends in StarArgs).
+    """
+    pattern,guard = split_guard(key)
+    paths = binding_paths(pattern)
+    consts = {}
+    lines = ['if not isinstance(ast, _node_types): return None']
+    consts['_guard'] = guard
+
+    # the guard runs as soon as its variables are bound, before the checks on the rest of the pattern;
+    #   an error it raises is kept until the rest of the pattern matches, since on an ast which
+    #   does not match the guard would never have run
+    waiting = set(guard.func_code.co_varnames) if guard is not None else set()
+    def bound(label):
+        if waiting and label in waiting:
+            waiting.discard(label)
+            if not waiting:
+                lines.append('try:')
+                body = []
+                _codegen_guard(paths, guard, body, False)
+                lines.extend('    ' + l for l in body)
+                lines.append('except Exception:')
+                lines.append('    error = sys.exc_info()')
+                lines.append('    v = True')
+                lines.append('if not v: return None')
+    early = len(waiting) > 0 and waiting <= set(paths)
+    if early:
+        lines.append('error = None')
+    _codegen_checks(pattern, (), lines, consts, bound if early else None, exact)
+    if early:
+        lines.append('if error is not None: raise error[0], error[1], error[2]')
+    if guard is not None and not early:
+        _codegen_guard(paths, guard, lines, False)
+        lines.append('if not v: return None')
+    _codegen_call(paths, function, 'args', lines, False)
+    lines.append('return args')
+    return _define('match', lines, consts)
+
+def compile_extractor(key, function):
+    """Accepts a pattern key and a function, like compile_pattern.
+        Returns a generated function which accepts an ast already known to match the pattern
+            and returns the tuple of arguments for function, without checking anything.
+    """
+    pattern,guard = split_guard(key)
+    lines = []
+    _codegen_call(binding_paths(pattern), function, 'args', lines, True)
+    lines.append('return args')
+    return _define('extract', lines, {})
+
+def compile_guard(key):
+    """Accepts a pattern key.
+        Returns None if it has no guard, otherwise a generated function which accepts
+            an ast already known to match the pattern and returns the guard's verdict.
+    """
+    pattern,guard = split_guard(key)
+    if guard is None:
+        return None
+    lines = []
+    _codegen_guard(binding_paths(pattern), guard, lines, True)
+    lines.append('return v')
+    return _define('guard', lines, {'_guard': guard})
+
+def _expand(p, n, exact=True):
+    """Accepts the pattern fragment at a column and the length n of the tuple found there.
+        Returns the n fragments for the children, or None if the fragment cannot match.
+        If exact is False, the real length is only known to be at least n,
+            so only StarArgs patterns (and wildcards) survive.
+    """
+    if _is_wild(p):
+        return [_] * n
+    elif _is_star(p):
+        k = len(p) - 1
+        if k <= n:
+            return list(p[:k]) + [_] * (n - k)
+    elif isinstance(p, tuple):
+        if exact and len(p) == n:
+            return list(p)
+    return None
+
+def _compile_rows(rows, columns, guarded):
+    """Accepts rows of (fragments, rule index) and the AST paths of the fragment columns.
+        Returns a decision tree for the rows.
+    """
+    if len(rows) == 0:
+        return _NO_MATCH
+
+    frags,index = rows[0]
+    for col,p in enumerate(frags):
+        if not _is_wild(p):
+            return _compile_switch(rows, columns, col, guarded)
+    else:
+        # first rule matches whatever is left, it wins unless its guard says no
+        if guarded[index]:
+            return (_LEAF, index, _compile_rows(rows[1:], columns, guarded))
+        else:
+            return (_LEAF, index, None)
+
+def _compile_switch(rows, columns, col, guarded):
+    path = columns[col]
+    before,after = columns[:col], columns[col+1:]
+
+    def specialize(n, exact=True):
+        children = [path + (i,) for i in xrange(n)]
+        specialized = []
+        for frags,index in rows:
+            expanded = _expand(frags[col], n, exact)
+            if expanded is not None:
+                specialized.append((frags[:col] + expanded + frags[col+1:], index))
+        return _compile_rows(specialized, before + children + after, guarded)
+
+    def specialize_const(c, wild_only=False):
+        specialized = []
+        for frags,index in rows:
+            p = frags[col]
+            if _is_wild(p) or (not wild_only and not isinstance(p, tuple) and p == c):
+                specialized.append((frags[:col] + frags[col+1:], index))
+        return _compile_rows(specialized, before + after, guarded)
+
+    consts,lengths,star_ks = {}, {}, set()
+    for frags,index in rows:
+        p = frags[col]
+        if _is_star(p):
+            star_ks.add(len(p) - 1)
+        elif isinstance(p, tuple):
+            lengths[len(p)] = None
+        elif not _is_wild(p):
+            consts[p] = None
+
+    for c in consts:
+        consts[c] = specialize_const(c)
+    for n in lengths:
+        lengths[n] = specialize(n)
+    # tuples of any other length: only StarArgs rules with k <= length survive,
+    # bisect on the sorted k's picks the right subtree
+    other = specialize_const(None, wild_only=True)
+    star_ks = sorted(star_ks)
+    star_trees = [other] + [specialize(k, exact=False) for k in star_ks]
+    return (_SWITCH, path, consts, lengths, star_ks, star_trees, other)
+
+_rest = StarArgs('_rest')
+
+def _as_prefix(pattern):
+    """Accepts a pattern. Returns it with every tuple in it ending in StarArgs,
+        so it matches nodes at least as long, on their first elements, like match_and_extract_matched_vars.
+    """
+    if _is_star(pattern):
+        return tuple(_as_prefix(p) if isinstance(p, tuple) else p for p in pattern)
+    return tuple(_as_prefix(p) if isinstance(p, tuple) else p for p in pattern) + (_rest,)
+
+def compile_net(rules, exact=False):
+    """Accepts a list of (pattern, guard) pairs, guard may be None.
+        Returns the decision tree for them (see above).
+        A pattern matches the nodes at least as long as itself, on their first elements.
+            exact=True only matches nodes of the pattern's own length (or longer, if it ends in StarArgs).
+    """
+    if not exact:
+        rules = [(_as_prefix(pattern), guard) for pattern,guard in rules]
+    rows = [([pattern], i) for i,(pattern,guard) in enumerate(rules)]
+    guarded = [guard is not None for pattern,guard in rules]
+    return _compile_rows(rows, [()], guarded)
+
+def run_net(net, ast, guards):
+    """Accepts a decision tree, an ast,
+        and for every rule its compile_guard function (or None).
+        Returns the index of the first matching rule, or None if no rule matches.
+    """
+    node = net
+    while True:
+        tag = node[0]
+        if tag == _SWITCH:
+            v = ast
+            for i in node[1]:
+                v = v[i]
+            if isinstance(v, _node_types):
+                n = len(v)
+                if n in node[3]:
+                    node = node[3][n]
+                else:
+                    node = node[5][bisect_right(node[4], n)]
+            else:
+                try:
+                    node = node[2].get(v, node[6])
+                except TypeError:
+                    # unhashable leaf, cannot equal any pattern constant
+                    node = node[6]
+        elif tag == _LEAF:
+            index = node[1]
+            guard = guards[index]
+            if guard is None or guard(ast):
+                return index
+            node = node[2]
+        else:
+            return None
+
 def copyfunc(f, newglobals):
     """Accepts a function. Copies its code point but gives it different name/globals/etc.
-        Returns a new function.
+        Returns a new function, whose globals are f's updated with newglobals.
+            f's own globals are left alone, so copies can be made from any thread.
+    """
+    namespace = dict(f.func_globals)
+    namespace.update(newglobals)
+    return types.FunctionType(f.func_code, namespace, f.func_name, f.func_defaults, f.func_closure)
+
+class _NotMatched(object):
+    def __repr__(self):
+        return 'NOT_MATCHED'
+
+NOT_MATCHED = _NotMatched()
+
+def _fail_depth(pattern, ast, exact=True, depth=0):
+    """Accepts a pattern (without a guard) and an ast.
+        Returns None if the ast has the pattern's shape and constants,
+            otherwise the depth (0 for the node itself) of the first place it differs.
+        exact=True checks lengths like compile_net(..., exact=True),
+            exact=False only compares the first elements of a node at least as long, like compile_net.
     """
-    t = eval('lambda: None', globals().update(newglobals))
-    t.func_code = f.func_code
-    t.func_name = f.func_name
-    return t
+    if not isinstance(ast, _node_types):
+        return depth
+    if _is_star(pattern):
+        pattern = pattern[:-1]
+        if len(ast) < len(pattern):
+            return depth
+    elif len(ast) < len(pattern) or (exact and len(ast) != len(pattern)):
+        return depth
+    for p,a in izip(pattern, ast):
+        if isinstance(p, tuple):
+            d = _fail_depth(p, a, exact, depth + 1)
+            if d is not None:
+                return d
+        elif not isinstance(p, PatternVar) and p != a:
+            return depth
+    return None
+
+class RuleProfile(object):
+    """Per rule counters for a profiled rule set (see patternmatch(..., profile=True)).
+        For every rule: attempts, matches (the rule ran), guard_rejections,
+            seconds spent matching, in the guard and in the action
+            (the action's time includes any patternmatch calls it makes),
+            and failed_at, the number of failed attempts by the depth of the AST where they failed.
+    """
+    def __init__(self, keys):
+        self.keys = list(keys)
+        # counters are updated under the lock, so threads do not lose counts
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.calls = 0
+        self.unmatched = 0
+        self.rules = [{'attempts': 0, 'matches': 0, 'guard_rejections': 0,
+                       'match_time': 0.0, 'guard_time': 0.0, 'action_time': 0.0,
+                       'failed_at': {}} for k in self.keys]
+
+    def stats(self):
+        """Returns {'calls': ..., 'unmatched': ..., 'rules': [per rule counters, in rule order]}."""
+        rules = []
+        with self.lock:
+            for key,r in izip(self.keys, self.rules):
+                r = dict(r)
+                r['pattern'] = key
+                r['failed_at'] = dict(r['failed_at'])
+                rules.append(r)
+            return {'calls': self.calls, 'unmatched': self.unmatched, 'rules': rules}
+
+    def report(self):
+        """Returns the stats as a table, slowest rules first."""
+        rules = self.stats()['rules']
+        for i,r in enumerate(rules):
+            r['index'] = i
+        rules.sort(key=lambda r: -(r['match_time'] + r['guard_time'] + r['action_time']))
+        lines = ['{0} calls, {1} unmatched'.format(self.calls, self.unmatched),
+                 '{0:>4} {1:>9} {2:>9} {3:>9} {4:>10} {5:>10} {6:>10}  {7:<20} {8}'.format(
+                    'rule', 'attempts', 'matches', 'rejected', 'match s', 'guard s', 'action s',
+                    'failed at depth', 'pattern')]
+        for r in rules:
+            failed = ' '.join('{0}:{1}'.format(d, n) for d,n in sorted(r['failed_at'].items()))
+            lines.append('{0:>4} {1:>9} {2:>9} {3:>9} {4:>10.6f} {5:>10.6f} {6:>10.6f}  {7:<20} {8!r}'.format(
+                    r['index'], r['attempts'], r['matches'], r['guard_rejections'],
+                    r['match_time'], r['guard_time'], r['action_time'], failed, r['pattern']))
+        return '\n'.join(lines) + '\n'
+
+def _profiled_rules(keys, actions, compiled, profile, exact=False):
+    """Accepts the pattern keys, their functions, the matching mode, a RuleProfile, and exact (see compile_net).
+        Returns an apply_rules which tries the rules one at a time, in order, and counts everything.
+            It picks the same rule the unprofiled apply_rules would.
+    """
+    timer = time.time
+    rules = []
+    for key,tocall,counts in izip(keys, actions, profile.rules):
+        pattern,guard = split_guard(key)
+        if compiled:
+            rules.append((key, pattern, tocall, counts, compile_guard(key), compile_extractor(key, tocall)))
+        else:
+            rules.append((key, pattern, tocall, counts, guard, None))
+
+    lock = profile.lock
+
+    def apply_rules(ast):
+        with lock:
+            profile.calls += 1
+        for key,pattern,tocall,counts,guard,extract in rules:
+            start = timer()
+            if compiled:
+                depth = _fail_depth(pattern, ast, exact)
+                matched = depth is None
+            else:
+                matched = match_and_extract_matched_vars(pattern, ast)
+                depth = _fail_depth(pattern, ast, exact=False) if matched is None else None
+            now = timer()
+            match_time = now - start
+            if depth is not None:
+                with lock:
+                    counts['attempts'] += 1
+                    counts['match_time'] += match_time
+                    failed_at = counts['failed_at']
+                    failed_at[depth] = failed_at.get(depth, 0) + 1
+                continue
+
+            guard_time = 0.0
+            if guard is not None:
+                start = now
+                if compiled:
+                    v = guard(ast)
+                else:
+                    v = guard(*order_matched(matched, guard))
+                    assert isinstance(v, bool), "Guard must return true or false"
+                now = timer()
+                guard_time = now - start
+                if not v:
+                    with lock:
+                        counts['attempts'] += 1
+                        counts['match_time'] += match_time
+                        counts['guard_time'] += guard_time
+                        counts['guard_rejections'] += 1
+                    continue
+
+            start = now
+            try:
+                try:
+                    m = extract(ast) if compiled else order_matched(matched, tocall)
+                except Exception,e:
+                    raise Exception('pattern: {0} error: {1}'.format(key, e))
+                return tocall(*m)
+            finally:
+                action_time = timer() - start
+                with lock:
+                    counts['attempts'] += 1
+                    counts['matches'] += 1
+                    counts['match_time'] += match_time
+                    counts['guard_time'] += guard_time
+                    counts['action_time'] += action_time
+        with lock:
+            profile.unmatched += 1
+        return NOT_MATCHED
+    return apply_rules
+
+def may_overlap(p, q, exact=True):
+    """Accepts two patterns (without guards).
+        Returns False only if no AST can match both, judging by constants (like node names),
+            lengths, and where the PatternMatchVars, AnyNodes and StarArgs are.
+        exact=True uses the lengths like the discrimination net,
+            exact=False ignores them, like match_and_extract_matched_vars (which compares prefixes).
+    """
+    if _is_wild(p) or _is_wild(q):
+        return True
+    elif isinstance(p, tuple) and isinstance(q, tuple):
+        if exact:
+            m = len(p) - 1 if _is_star(p) else len(p)
+            n = len(q) - 1 if _is_star(q) else len(q)
+            if (m != n and not (_is_star(p) and n >= m) and not (_is_star(q) and m >= n)):
+                return False
+        for x,y in izip(p, q):
+            if isinstance(x, StarArgs) or isinstance(y, StarArgs):
+                break
+            if not may_overlap(x, y, exact):
+                return False
+        return True
+    elif isinstance(p, tuple) or isinstance(q, tuple):
+        return False
+    else:
+        return p == q
 
-def patternmatch(patterns, run_func=False):
+class RuleOrder(object):
+    """The order in which a sequential rule set tries its rules, learned from which rules match.
+        Rules that may match a common AST (see may_overlap) keep their relative order,
+            so whichever order this picks, the first rule to match any AST is the same.
+        Between those constraints, the rules that matched most go first.
+        The order is recomputed every interval calls, until freeze().
+    """
+    interval = 1000
+
+    def __init__(self, keys, exact=True, order=None):
+        self.keys = list(keys)
+        self.exact = exact
+        self.hits = [0] * len(self.keys)
+        self.calls = 0
+        self.frozen = False
+        self._before = None
+        self.lock = threading.Lock()
+        if order is None:
+            self.order = range(len(self.keys))
+        else:
+            self.order = self.check(order)
+
+    def before(self):
+        """Returns, for every rule, the earlier rules it may overlap, which must stay before it."""
+        if self._before is None:
+            patterns = [split_guard(k)[0] for k in self.keys]
+            self._before = [[i for i in xrange(j) if may_overlap(patterns[i], patterns[j], self.exact)]
+                            for j in xrange(len(patterns))]
+        return self._before
+
+    def check(self, order):
+        """Accepts an order (a list of rule indices).
+            Returns it as a list, or raises ValueError if it could change which rule matches.
+        """
+        order = list(order)
+        if sorted(order) != range(len(self.keys)):
+            raise ValueError('order must list every rule index once: {0}'.format(order))
+        position = dict((r, i) for i,r in enumerate(order))
+        for j,earlier in enumerate(self.before()):
+            for i in earlier:
+                if position[i] > position[j]:
+                    raise ValueError('rule {0} may overlap rule {1}, it must come first: {2}'.format(
+                                        i, j, self.keys[i]))
+        return order
+
+    def reorder(self):
+        """Recomputes the order from the hits: the most hit rule whose overlapping rules are placed goes next."""
+        before = self.before()
+        placed = [False] * len(self.keys)
+        order = []
+        while len(order) < len(self.keys):
+            best = None
+            for j in xrange(len(self.keys)):
+                if not placed[j] and all(placed[i] for i in before[j]):
+                    if best is None or self.hits[j] > self.hits[best]:
+                        best = j
+            placed[best] = True
+            order.append(best)
+        self.order = order
+        return order
+
+    def record(self, index):
+        # under the lock, so threads do not lose hits;
+        #   reorder replaces the order list, and threads still iterating the old one finish with it
+        with self.lock:
+            self.hits[index] += 1
+            self.calls += 1
+            if self.calls % self.interval == 0 and not self.frozen:
+                self.reorder()
+
+    def freeze(self):
+        """Stops learning. Returns the order, to pass as patternmatch(..., order=) later."""
+        self.frozen = True
+        return list(self.order)
+
+    def export(self):
+        """Returns the current order, a list of rule indices."""
+        return list(self.order)
+
+def _ordered_rules(keys, actions, compiled, rule_order, exact=False):
+    """Accepts the pattern keys, their functions, the matching mode, a RuleOrder, and exact (see compile_net).
+        Returns an apply_rules which tries the rules one at a time, in the RuleOrder's current order.
+    """
+    if compiled:
+        matchers = [compile_pattern(key, tocall, exact) for key,tocall in izip(keys, actions)]
+    else:
+        def interpreted(key, tocall):
+            def match(ast):
+                matched = match_and_extract_matched_vars(key, ast)
+                if matched is not None:
+                    return order_matched(matched, tocall)
+            return match
+        matchers = [interpreted(key, tocall) for key,tocall in izip(keys, actions)]
+
+    def apply_rules(ast):
+        for index in rule_order.order:
+            try:
+                m = matchers[index](ast)
+            except Exception,e:
+                raise Exception('pattern: {0} error: {1}'.format(keys[index], e))
+            if m is not None:
+                if not rule_order.frozen:
+                    rule_order.record(index)
+                return actions[index](*m)
+        return NOT_MATCHED
+    return apply_rules
+
+"""
+Compiled rule cache.
+
+Compiling a big rule set into a discrimination net takes a while,
+    so the net and the code of the generated extractors and guards can be kept in a directory,
+    one marshal file per rule set, named after rules_fingerprint.
+Later processes with the same rules load that instead of compiling.
+The functions of the rules themselves are never stored, they are taken from the live patterns.
+"""
+_CACHE_VERSION = 2
+
+def rules_fingerprint(keys, actions, exact=False):
+    """Accepts pattern keys, their functions, and exact (see compile_net).
+        Returns a hex digest of everything the compiled rules depend on:
+            the patterns, the argument names of the guards and functions, and exact.
+    """
+    def canonical(p):
+        if isinstance(p, tuple):
+            return ('tuple',) + tuple(canonical(x) for x in p)
+        elif isinstance(p, PatternVar):
+            return (type(p).__name__, p.label)
+        else:
+            return (type(p).__name__, repr(p))
+    rules = []
+    for key,tocall in izip(keys, actions):
+        pattern,guard = split_guard(key)
+        rules.append((canonical(pattern),
+                      None if guard is None else guard.func_code.co_varnames,
+                      tocall.func_code.co_varnames))
+    return hashlib.sha1(repr((_CACHE_VERSION, sys.version, exact, rules))).hexdigest()
+
+def _flatten_net(net):
+    """Accepts a decision tree. Returns it as a list of nodes which refer to earlier nodes by index,
+        children first and the root last, so shared subtrees are written once.
+    """
+    index = {}
+    table = []
+    stack = [(net, False)]
+    while stack:
+        node,ready = stack.pop()
+        if id(node) in index:
+            continue
+        if node[0] == _SWITCH:
+            tag,path,consts,lengths,star_ks,star_trees,other = node
+            children = consts.values() + lengths.values() + star_trees + [other]
+        elif node[0] == _LEAF and node[2] is not None:
+            children = [node[2]]
+        else:
+            children = []
+        if not ready:
+            stack.append((node, True))
+            stack.extend((c, False) for c in children if id(c) not in index)
+            continue
+        if node[0] == _SWITCH:
+            row = (tag, path,
+                   dict((c, index[id(t)]) for c,t in consts.iteritems()),
+                   dict((n, index[id(t)]) for n,t in lengths.iteritems()),
+                   star_ks, [index[id(t)] for t in star_trees], index[id(other)])
+        elif node[0] == _LEAF:
+            row = (_LEAF, node[1], None if node[2] is None else index[id(node[2])])
+        else:
+            row = _NO_MATCH
+        index[id(node)] = len(table)
+        table.append(row)
+    return table
+
+def _unflatten_net(table):
+    nodes = []
+    for row in table:
+        if row[0] == _SWITCH:
+            tag,path,consts,lengths,star_ks,star_trees,other = row
+            node = (tag, path,
+                    dict((c, nodes[i]) for c,i in consts.iteritems()),
+                    dict((n, nodes[i]) for n,i in lengths.iteritems()),
+                    star_ks, [nodes[i] for i in star_trees], nodes[other])
+        elif row[0] == _LEAF:
+            node = (_LEAF, row[1], None if row[2] is None else nodes[row[2]])
+        else:
+            node = _NO_MATCH
+        nodes.append(node)
+    return nodes[-1]
+
+def _load_compiled(path, keys):
+    """Returns (net, guards, extractors) from the cache file at path, or None if there is none."""
+    try:
+        with open(path, 'rb') as f:
+            table,guards,extractors = marshal.load(f)
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if len(guards) != len(keys) or len(extractors) != len(keys):
+        return None
+
+    def function(code, source, defaults):
+        f = types.FunctionType(code, globals(), code.co_name, defaults)
+        f.source = source
+        return f
+    guards = [None if g is None else function(g[0], g[1], (split_guard(key)[1],))
+              for key,g in izip(keys, guards)]
+    extractors = [function(code, source, None) for code,source in extractors]
+    return _unflatten_net(table), guards, extractors
+
+def _store_compiled(path, net, guards, extractors):
+    """Writes the compiled rules to the cache file at path, if it can."""
+    try:
+        data = marshal.dumps((_flatten_net(net),
+                              [None if g is None else (g.func_code, g.source) for g in guards],
+                              [(e.func_code, e.source) for e in extractors]))
+    except ValueError:
+        # a pattern constant marshal does not know
+        return
+    try:
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        # written under another name first, so readers never see half a file
+        temp = '{0}.{1}.tmp'.format(path, os.getpid())
+        with open(temp, 'wb') as f:
+            f.write(data)
+        os.rename(temp, path)
+    except (IOError, OSError):
+        pass
+
+def _compile_cached(keys, actions, cache_dir=None, exact=False):
+    """Accepts pattern keys, their functions, the cache directory (by default $PYPM_CACHE_DIR, if set),
+            and exact (see compile_net).
+        Returns (net, guards, extractors), loaded from the cache or compiled (and then stored).
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('PYPM_CACHE_DIR')
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, 'pypm-{0}.marshal'.format(rules_fingerprint(keys, actions, exact)))
+        loaded = _load_compiled(path, keys)
+        if loaded is not None:
+            return loaded
+    net = compile_net([split_guard(p) for p in keys], exact)
+    guards = [compile_guard(p) for p in keys]
+    extractors = [compile_extractor(p, tocall) for p,tocall in izip(keys, actions)]
+    if path is not None:
+        _store_compiled(path, net, guards, extractors)
+    return net, guards, extractors
+
+def guard_chains(keys, actions):
+    """Accepts pattern keys and their functions.
+        Returns a list of (pattern, chain), where chain is a list of (key, guard, function),
+            one for every run of consecutive rules with the same pattern (but different guards),
+            so the pattern is matched once and only the guards are tried one after the other.
+    """
+    chains = []
+    for key,tocall in izip(keys, actions):
+        pattern,guard = split_guard(key)
+        if chains and chains[-1][0] == pattern:
+            chains[-1][1].append((key, guard, tocall))
+        else:
+            chains.append((pattern, [(key, guard, tocall)]))
+    return chains
+
+def compile_rules(patterns, compiled=True, profile=False, adaptive=False, order=None, cache_dir=None,
+                  exact=False):
+    """Accepts patterns, like patternmatch.
+        Returns a function which accepts an AST and runs the function of the first matching pattern,
+            returning its result, or returns NOT_MATCHED if no pattern matches.
+        compiled=False tries every pattern in order with match_and_extract_matched_vars.
+        profile=True tries the patterns one at a time, counting into a RuleProfile, apply_rules.profile.
+        adaptive=True, or an order, tries the patterns one at a time in the order of a RuleOrder,
+            apply_rules.rule_order, which learns from the matches if adaptive is True.
+        cache_dir keeps the compiled net in that directory, and loads it from there next time
+            (see rules_fingerprint). It defaults to $PYPM_CACHE_DIR, and no cache if that is not set.
+        exact=True makes compiled patterns only match nodes of their own length (see compile_net).
+    """
+    check_patterns(patterns)
+    keys = [d.keys()[0] for d in patterns]
+    actions = [d.values()[0] for d in patterns]
+
+    if profile and (adaptive or order is not None):
+        raise ValueError('profile tries the patterns in list order, it cannot be adaptive or reordered')
+    if profile:
+        profile = RuleProfile(keys)
+        apply_rules = _profiled_rules(keys, actions, compiled, profile, exact)
+        apply_rules.profile = profile
+    elif adaptive or order is not None:
+        rule_order = RuleOrder(keys, compiled and exact, order)
+        rule_order.frozen = not adaptive
+        apply_rules = _ordered_rules(keys, actions, compiled, rule_order, exact)
+        apply_rules.rule_order = rule_order
+    elif compiled:
+        net,guards,extractors = _compile_cached(keys, actions, cache_dir, exact)
+
+        def apply_rules(ast):
+            index = run_net(net, ast, guards)
+            if index is None:
+                return NOT_MATCHED
+            try:
+                m = extractors[index](ast)
+            except Exception,e:
+                raise Exception('pattern: {0} error: {1}'.format(keys[index], e))
+            return actions[index](*m)
+    else:
+        chains = guard_chains(keys, actions)
+
+        def apply_rules(ast):
+            for pattern,chain in chains:
+                matched = match_and_extract_matched_vars(pattern, ast)
+                if matched is not None:
+                    for p,guard,tocall in chain:
+                        if guard is None or is_guard_correct(matched, guard):
+                            # we got a match!
+                            try:
+                                m = order_matched(matched, tocall)
+                            except Exception,e:
+                                raise Exception('pattern: {0} error: {1}'.format(p, e))
+                            return tocall(*m)
+            return NOT_MATCHED
+    apply_rules.apply_rules = apply_rules
+    return apply_rules
+
+class LazyRules(object):
+    """The rules of a @patternmatch function, checked and compiled (with compile_rules) on first use.
+        Calling it applies the rules; apply_rules is the compiled function itself.
+    """
+    def __init__(self, patterns, **options):
+        self.patterns = patterns
+        self.options = options
+        self.rules = None
+        self.lock = threading.Lock()
+
+    @property
+    def apply_rules(self):
+        if self.rules is None:
+            # threads calling for the first time at once compile once, and all get the same rules
+            with self.lock:
+                if self.rules is None:
+                    self.rules = compile_rules(self.patterns, **self.options)
+        return self.rules
+
+    def __call__(self, ast):
+        return self.apply_rules(ast)
+
+class LRUCache(object):
+    """A bounded memo table from AST to result, evicting the least recently used entry.
+        key='identity' keys on the AST object itself (id), which is O(1) 
+            but only helps when subtrees are shared objects, like fourteen = ("Sum", seven, seven).
+        key='structural' keys on the AST value, so equal subtrees share one entry,
+            at the price of hashing the subtree.
+        maxsize=None means unbounded.
+        It can be shared by threads: every operation holds a lock
+            (two threads missing the same AST both compute it, and the last result is kept).
+    """
+    def __init__(self, maxsize=1024, key='identity'):
+        if key not in ('identity', 'structural'):
+            raise ValueError('key must be "identity" or "structural": {0}'.format(key))
+        self.maxsize = maxsize
+        self.key = key
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.entries = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'maxsize': self.maxsize, 'currsize': len(self.entries)}
+
+    def lookup(self, ast):
+        """Returns (True, result) on a hit, (False, None) on a miss."""
+        k = id(ast) if self.key == 'identity' else ast
+        with self.lock:
+            try:
+                entry = self.entries.pop(k, None)
+            except TypeError:
+                # unhashable leaf somewhere in the subtree, never cached
+                entry = None
+            # the entry holds on to its ast, so its id cannot have been reused
+            if entry is not None and (self.key != 'identity' or entry[0] is ast):
+                self.entries[k] = entry
+                self.hits += 1
+                return True, entry[1]
+            else:
+                self.misses += 1
+                return False, None
+
+    def store(self, ast, result):
+        k = id(ast) if self.key == 'identity' else ast
+        with self.lock:
+            try:
+                self.entries[k] = (ast, result)
+            except TypeError:
+                return
+            if self.maxsize is not None and len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+def patternmatch(patterns, run_func=False, compiled=True, memoize=False, maxsize=1024, key='identity',
+                 profile=False, adaptive=False, order=None, lazy=True, cache_dir=None, exact=False):
     """Accepts a dictionary representing patterns.  
             The dictionary has keys which are n-tuples representing parts of ASTs.
             The dictionary has values which are lambda functions that 
@@ -194,47 +1155,191 @@ def patternmatch(patterns, run_func=False):
         If a pattern does match, it will execute the lambda function appropriately.  See Haskell.
         If no pattern matches, then by default this will raise an Exception.
             The function will only run if no pattern matched and run_func=True in the optional arguments.
+
+        By default the patterns are compiled once into a discrimination net (see compile_net),
+            so each AST position is tested once no matter how many patterns there are.
+            A pattern matches the first elements of a node at least as long as itself,
+            like match_and_extract_matched_vars (which, unlike the net, also tries nodes shorter than
+            the pattern, and leaves the variables past their end unbound).
+            The arguments and guards of each pattern are read by generated functions
+            (see compile_extractor and compile_guard).
+        compiled=False tries every pattern in order with match_and_extract_matched_vars instead.
+        exact=True makes a compiled pattern only match nodes of its own length (or longer, if it ends
+            in StarArgs), so ("Num", a) no longer matches ("Num", 3, 4). compiled=False ignores it.
+
+        memoize=True caches results per AST in an LRUCache(maxsize, key),
+            so shared subtrees are only rewritten once.
+            The patterns' functions must then be pure.
+            The decorated function gets cache_info() and cache_clear().
+
+        profile=True counts, for every pattern, attempts, matches, guard rejections,
+            the time spent matching, in guards and in actions, and the AST depth where matches failed
+            (see RuleProfile). The patterns are then tried one at a time, in order.
+            The decorated function gets stats() (a dict), report() (a printable table) and stats_clear().
+            With profile=False nothing is counted, and nothing is slower.
+
+        adaptive=True tries the patterns one at a time (each with its own generated matcher,
+            or match_and_extract_matched_vars if compiled=False), and moves the patterns that match most
+            ahead of the ones that cannot match the same ASTs (see RuleOrder),
+            so the same pattern wins for every AST as in list order.
+            The discrimination net (compiled=True, not adaptive) costs the same in any order,
+            so this pays off with compiled=False, or with generated matchers for long lists of hot rules.
+            The decorated function gets rule_order() (the order, a list of pattern indices)
+            and freeze(), which stops learning and returns the order.
+        order=, a list from rule_order() or freeze(), starts from that order
+            (and keeps it, unless adaptive=True). It is checked to pick the same patterns as list order.
+
+        The patterns are checked and compiled when the decorated function is first called
+            (its apply_rules is a LazyRules), so importing many rule sets stays cheap.
+            lazy=False does it right away instead.
+        cache_dir keeps the compiled rules on disk for later processes, see compile_rules.
+
+        The decorated function is reentrant and can be called from many threads at once:
+            matching only reads the compiled rules, and the state it does keep
+            (the first compile, the memo table, profile counters, the learned order) is updated under locks.
+            The patterns' functions must be thread-safe themselves.
+            traverse_ast and recurse_ast can rewrite the children of wide nodes on a pool (see executor=).
     """
-    check_patterns(patterns)
+    apply_rules = LazyRules(patterns, compiled=compiled, profile=profile, adaptive=adaptive,
+                            order=order, cache_dir=cache_dir, exact=exact)
+    if not lazy:
+        apply_rules.apply_rules
+
     def decorator(f):
         def recognize_and_run(ast):
+            if cache is not None:
+                hit,result = cache.lookup(ast)
+                if hit:
+                    return result
+                result = run(ast)
+                cache.store(ast, result)
+                return result
+            else:
+                return run(ast)
+
+        def run(ast):
             check_ast(ast)
-            for d in patterns:
-                p,tocall = d.keys()[0], d.values()[0]
-                matched = match_and_extract_matched_vars(p, ast)
-                if matched is not None:
-                    # we got a match!
-                    try:
-                        m = order_matched(matched, tocall)
-                    except Exception,e:
-                        raise Exception('pattern: {0} error: {1}'.format(p, e))
-                    return tocall(*m)
+            rules = apply_rules.rules
+            if rules is None:
+                rules = apply_rules.apply_rules
+            result = rules(ast)
+            if result is not NOT_MATCHED:
+                return result
+            elif run_func:
+                return f(ast)
             else:
-                # 
-                if run_func:
-                    return f(ast)
-                else:
-                    raise UnknownPattern(ast)
+                raise UnknownPattern(ast)
+
+        cache = LRUCache(maxsize, key) if memoize else None
+        if cache is not None:
+            recognize_and_run.cache_info = cache.info
+            recognize_and_run.cache_clear = cache.clear
+        if profile:
+            recognize_and_run.stats = lambda: apply_rules.apply_rules.profile.stats()
+            recognize_and_run.report = lambda: apply_rules.apply_rules.profile.report()
+            recognize_and_run.stats_clear = lambda: apply_rules.apply_rules.profile.clear()
+        if adaptive or order is not None:
+            recognize_and_run.rule_order = lambda: apply_rules.apply_rules.rule_order.export()
+            recognize_and_run.freeze = lambda: apply_rules.apply_rules.rule_order.freeze()
+        recognize_and_run.patterns = patterns
+        recognize_and_run.apply_rules = apply_rules
         return recognize_and_run
     return decorator
 
 
-def recurse_ast(f, anynode, starargs):
+_parallel = threading.local()
+
+class _InWorker(object):
+    """f, called on a pool: in the pool, traverse_ast and recurse_ast do not use a pool again,
+        so a worker never waits on tasks queued behind it.
+        A module level class, so it pickles (for process pools) whenever f does.
+    """
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, ast):
+        _parallel.active = True
+        try:
+            return self.f(ast)
+        finally:
+            _parallel.active = False
+
+def _map_subtrees(f, subtrees, executor, threshold):
+    """Returns [f(a) for a in subtrees], on the executor if there are at least threshold of them."""
+    if executor is None or len(subtrees) < threshold or getattr(_parallel, 'active', False):
+        return [f(a) for a in subtrees]
+    # map returns the results in order, for multiprocessing pools and concurrent.futures executors alike
+    return list(executor.map(_InWorker(f), subtrees))
+
+def recurse_ast(f, anynode, starargs, executor=None, threshold=32):
     """Accepts a function to recurse on, a node name and arguments.
         Recursively calls f on the arguments, returns newly processed node.
         Returns an AST.
+
+        The results of f are spliced into the node, and the node comes back wrapped in a 1-tuple,
+            so f is expected to return recurse_ast results itself.
+            New code should use traverse_ast.
+        executor and threshold are as for traverse_ast.
     """
-    processed = (anynode,)
+    if executor is not None:
+        subtrees = [a for a in starargs if isinstance(a, _node_types)]
+        if len(subtrees) >= threshold:
+            results = iter(_map_subtrees(f, subtrees, executor, threshold))
+            f = lambda a: next(results)
+    processed = [anynode]
     for a in starargs:
-        processed += (f(a) if isinstance(a, tuple) else (a,)) 
-    return (processed,)
+        if isinstance(a, _node_types):
+            processed.extend(f(a))
+        else:
+            processed.append(a)
+    return (tuple(processed),)
+
+def traverse_ast(f, ast, executor=None, threshold=32):
+    """Accepts a function and an AST node.
+        Calls f on every element of the node which is itself a node (a subtree),
+            and builds the new node from the results in one go.
+        Returns (node, changed).
+            If f returned every subtree unchanged (the same object), 
+            node is ast itself and changed is False, and nothing was allocated.
+
+        Typically used as the fallback of a pass:
+            @patternmatch(patterns, run_func=True)
+            def evalMinus(ast):
+                return traverse_ast(evalMinus, ast)[0]
+
+        executor, a thread or process pool (anything with an ordered map, like multiprocessing.Pool
+            or a concurrent.futures executor), rewrites the subtrees of nodes with at least threshold of them
+            in parallel, and the node is built from the results in their original order.
+            Only the widest level goes to the pool: calls made in the pool do not use it again.
+            A process pool needs a picklable f, like a module level function which calls the pass.
+    """
+    if executor is not None:
+        subtrees = [a for a in ast if isinstance(a, _node_types)]
+        if len(subtrees) >= threshold:
+            results = iter(_map_subtrees(f, subtrees, executor, threshold))
+            f = lambda a: next(results)
+    items = None
+    for i,a in enumerate(ast):
+        if isinstance(a, _node_types):
+            r = f(a)
+            if r is not a:
+                if items is None:
+                    items = list(ast[:i])
+                items.append(r)
+                continue
+        if items is not None:
+            items.append(a)
+    if items is None:
+        return ast, False
+    else:
+        return tuple(items), True
 
 # jperla: start with just tuple pattern matching, can add sugar later
 # jperla: add monads to make this easier
 # jperla: parentheses!
 # jperla: make a C compiler? Fortran?
 
-if __name__=='__main__':
+def demo():
     def extract_num(ast):
         assert ast[0] == 'Num'
         return ast[1]
@@ -288,12 +1393,10 @@ if __name__=='__main__':
     patterns = [
         {('OP', ('Num', a), '-', ('EXPR', ('Num', b))): 
                     lambda a,b: ('Num', a - b)},
-        {(anynode, starargs): 
-                    lambda anynode,starargs: recurse_ast(evalMinus, anynode, starargs)},
     ]
-    @patternmatch(patterns)
+    @patternmatch(patterns, run_func=True)
     def evalMinus(ast):
-        pass
+        return traverse_ast(evalMinus, ast)[0]
 
 
     try:
@@ -301,3 +1404,12 @@ if __name__=='__main__':
         print d
     except:
         import pdb;pdb.post_mortem()
+
+
+if __name__=='__main__':
+    if sys.argv[1:] == ['--demo']:
+        demo()
+    else:
+        # python -m pypm RULES [FILES...], see pybatch
+        import pybatch
+        sys.exit(pybatch.main(sys.argv[1:]))
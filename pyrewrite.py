@@ -0,0 +1,138 @@
+"""
+Rewriting to a fixpoint without recursion.
+
+A rule set is the usual pypm pattern list (or a @patternmatch function, which carries its compiled patterns),
+    but its functions return the rewritten node and do not call themselves on subtrees:
+    the driver takes care of visiting every node.
+
+    rules = [
+        {("Sum", ("Num", a), ("Num", b)):  lambda a,b: ("Num", a + b)},
+    ]
+    rewrite(rules, ("Sum", ("Num", 1), ("Sum", ("Num", 2), ("Num", 3))))
+    => ("Num", 6)
+
+The driver keeps its own work stack, so arbitrarily deep trees (like the right-nested
+    EXPR/OP chains from pyparse.simple_expression) never hit the recursion limit.
+"""
+import pypm
+
+
+class RewriteLimit(Exception):
+    pass
+
+def compile_rewrite_rules(rules):
+    """Accepts a pattern list, a @patternmatch function, or the result of pypm.compile_rules.
+        Returns the function which applies the first matching rule to one node, or returns pypm.NOT_MATCHED.
+    """
+    if hasattr(rules, 'apply_rules'):
+        # a @patternmatch function has a LazyRules, whose apply_rules compiles them
+        rules = rules.apply_rules
+        return getattr(rules, 'apply_rules', rules)
+    else:
+        return pypm.compile_rules(rules)
+
+def rewrite(rules, ast, strategy='bottomup', fixpoint=True, max_steps=None):
+    """Accepts rules, an ast, and a strategy.
+        Returns the ast rewritten with the rules.
+
+        strategy='bottomup' (innermost first): the children of a node are rewritten
+            before the rules are tried on the node itself.
+        strategy='topdown' (outermost first): the rules are tried on a node
+            before its children are rewritten, and again after any of its children changed.
+        fixpoint=True keeps rewriting the result of every rule until no rule applies anywhere.
+            fixpoint=False rewrites every node of the input at most once, and leaves the results alone
+            (so topdown does not descend into a node the rules rewrote).
+        max_steps bounds the number of rule applications, raising RewriteLimit,
+            to stop rule sets which never reach a fixpoint.
+    """
+    if strategy not in ('bottomup', 'topdown'):
+        raise ValueError('strategy must be "bottomup" or "topdown": {0}'.format(strategy))
+    pypm.check_ast(ast)
+    return _rewrite(compile_rewrite_rules(rules), ast, strategy == 'topdown', fixpoint, max_steps)[0]
+
+def _rewrite(apply_rules, ast, topdown, fixpoint, max_steps=None, memo=None):
+    """rewrite, on compiled rules. Returns (the rewritten ast, the number of rule applications).
+        memo, a dictionary from subtree id to (subtree, result), gives the results of subtrees
+            known already, which are not walked again; every subtree walked is added to it.
+    """
+    is_node = pypm.is_node
+    NOT_MATCHED = pypm.NOT_MATCHED
+
+    # ids of subtrees already in normal form (with the subtree, to keep the id from being reused)
+    normal = {}
+    steps = [0]
+
+    def fire(t):
+        r = apply_rules(t)
+        if r is not NOT_MATCHED:
+            steps[0] += 1
+            if max_steps is not None and steps[0] > max_steps:
+                raise RewriteLimit('no fixpoint after {0} rewrites'.format(max_steps))
+        return r
+
+    # a frame is [original subtree, current node, next child index, rebuilt items, changed]
+    results = []
+    stack = [[ast, ast, 0, [], False]]
+    while stack:
+        frame = stack[-1]
+        orig,node,i,items,changed = frame
+
+        if topdown and i == 0 and not items:
+            # entering the node: rewrite it as long as rules apply
+            if fixpoint and id(node) in normal:
+                i = frame[2] = len(node)
+            else:
+                r = fire(node)
+                if r is not NOT_MATCHED:
+                    if fixpoint and is_node(r):
+                        frame[1] = r
+                    else:
+                        stack.pop()
+                        _deliver(stack, results, orig, r)
+                    continue
+
+        if i < len(node):
+            frame[2] = i + 1
+            a = node[i]
+            if memo is not None and id(a) in memo:
+                r = memo[id(a)][1]
+                items.append(r)
+                if r is not a:
+                    frame[4] = True
+            elif is_node(a) and not (fixpoint and id(a) in normal):
+                stack.append([a, a, 0, [], False])
+            else:
+                items.append(a)
+            continue
+
+        # all children done
+        stack.pop()
+        rebuilt = tuple(items) if changed else node
+        if topdown and not (changed and fixpoint):
+            result = rebuilt
+        else:
+            r = fire(rebuilt)
+            if r is NOT_MATCHED:
+                result = rebuilt
+            elif fixpoint and is_node(r):
+                # the result is normalized like any other subtree
+                stack.append([orig, r, 0, [], False])
+                continue
+            else:
+                result = r
+        if fixpoint and is_node(result):
+            normal[id(result)] = result
+        if memo is not None:
+            memo[id(orig)] = (orig, result)
+        _deliver(stack, results, orig, result)
+    return results[0], steps[0]
+
+def _deliver(stack, results, orig, result):
+    """Hands the rewritten subtree to its parent frame (or to results, for the root)."""
+    if stack:
+        parent = stack[-1]
+        parent[3].append(result)
+        if result is not orig:
+            parent[4] = True
+    else:
+        results.append(result)
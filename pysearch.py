@@ -0,0 +1,122 @@
+"""
+Indexed subtree search.
+
+An ASTIndex walks a tree once and files every node under its name and arity.
+A query then only looks at the nodes a pattern could match,
+    and lazily yields the (path, bindings) of every match, in tree order:
+
+    index = ASTIndex(tree)
+    for path,bindings in index.query([("OP", a, "*", ("Num", b))]):
+        ...
+
+path is the tuple of indices from the root to the node (index.get(path) returns it),
+    and bindings the dictionary from variable name to value, like match_and_extract_matched_vars.
+Patterns match like patternmatch(..., exact=True) patterns: a node of the pattern's length,
+    or at least as long, if the pattern ends in StarArgs.
+A pattern may have a guard, as a (pattern, guard) key.
+"""
+import heapq
+
+import pypm
+
+
+class ASTIndex(object):
+    """Accepts an AST. Indexes its nodes by (name, arity), once, for any number of queries."""
+    def __init__(self, tree):
+        pypm.check_ast(tree)
+        self.tree = tree
+        # node number (in preorder) => node, => its parent's node number (-1 for the root),
+        #   and => its index in the parent, so paths are only built for matches
+        self.nodes = []
+        self.parents = []
+        self.positions = []
+        # name => arity => node numbers, and arity => node numbers
+        self.by_name = {}
+        self.by_arity = {}
+
+        stack = [(tree, -1, 0)]
+        while stack:
+            node,parent,position = stack.pop()
+            i = len(self.nodes)
+            self.nodes.append(node)
+            self.parents.append(parent)
+            self.positions.append(position)
+            n = len(node)
+            self.by_arity.setdefault(n, []).append(i)
+            if n > 0:
+                try:
+                    self.by_name.setdefault(node[0], {}).setdefault(n, []).append(i)
+                except TypeError:
+                    # unhashable name, only found by patterns with a variable name
+                    pass
+            for j in xrange(n - 1, -1, -1):
+                if pypm.is_node(node[j]):
+                    stack.append((node[j], i, j))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def path(self, i):
+        """Accepts a node number. Returns the path from the root to that node."""
+        path = []
+        while self.parents[i] >= 0:
+            path.append(self.positions[i])
+            i = self.parents[i]
+        path.reverse()
+        return tuple(path)
+
+    def get(self, path):
+        """Accepts a path. Returns the node at that path."""
+        node = self.tree
+        for i in path:
+            node = node[i]
+        return node
+
+    def candidates(self, pattern):
+        """Accepts a pattern (without a guard).
+            Returns the lists of node numbers which could match it, each in preorder.
+        """
+        star = pypm._is_star(pattern)
+        k = len(pattern) - 1 if star else len(pattern)
+        if k > 0 and not pypm._is_wild(pattern[0]):
+            try:
+                arities = self.by_name.get(pattern[0], {})
+            except TypeError:
+                return []
+        else:
+            arities = self.by_arity
+        if star:
+            return [numbers for n,numbers in arities.iteritems() if n >= k]
+        else:
+            return [arities[k]] if k in arities else []
+
+    def query(self, patterns):
+        """Accepts a list of pattern keys, patterns or (pattern, guard).
+            Yields (path, bindings) for every node which matches one of them, in tree order,
+                with the bindings of the first pattern that matches the node.
+        """
+        rules = []
+        lists = []
+        for key in patterns:
+            pattern,guard = pypm.split_guard(key)
+            rules.append((pattern, guard, pypm.binding_paths(pattern)))
+            lists.extend(self.candidates(pattern))
+
+        previous = None
+        for i in heapq.merge(*lists):
+            if i == previous:
+                continue
+            previous = i
+            node = self.nodes[i]
+            for pattern,guard,paths in rules:
+                if pypm._fail_depth(pattern, node) is not None:
+                    continue
+                bindings = {}
+                for label,(path,start) in paths.iteritems():
+                    v = node
+                    for j in path:
+                        v = v[j]
+                    bindings[label] = v if start is None else v[start:]
+                if guard is None or pypm.is_guard_correct(bindings, guard):
+                    yield self.path(i), bindings
+                    break
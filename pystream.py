@@ -0,0 +1,206 @@
+"""
+Pattern matching over a stream of events, without building the tree.
+
+A tree is a stream of (kind, value) events:
+    (ENTER, None) opens a node, (LEAF, x) is an element which is not a node, (EXIT, None) closes the node.
+    ("Num", 5) is ENTER, LEAF "Num", LEAF 5, EXIT.
+events_from_ast turns a tree into events, read_events reads them from a file,
+    and pyparse.parse(p, tokens, events=True) parses into them.
+    pyparse backtracks, so it cannot emit a node before the parse is done:
+    it still builds the tree, and reads the events off it. Reading them from a file builds nothing.
+
+match_events runs pypm patterns over the events bottom up.
+Every open node keeps, for every pattern fragment it could still match, the variables bound so far,
+    and passes the fragments it matched to its parent when it closes.
+So a match is yielded as soon as its node closes, and only the open nodes are kept,
+    plus the subtrees which variables bind, which are the only ones ever built as tuples.
+"""
+from ast import literal_eval
+
+import pypm
+
+
+ENTER, LEAF, EXIT = 'enter', 'leaf', 'exit'
+
+def events_from_ast(ast):
+    """Accepts an AST. Yields its events, without recursion."""
+    pypm.check_ast(ast)
+    stack = [(ast, 0)]
+    yield ENTER, None
+    while stack:
+        node,i = stack[-1]
+        if i == len(node):
+            stack.pop()
+            yield EXIT, None
+            continue
+        stack[-1] = (node, i + 1)
+        x = node[i]
+        if pypm.is_node(x):
+            stack.append((x, 0))
+            yield ENTER, None
+        else:
+            yield LEAF, x
+
+def write_events(events, f):
+    """Accepts events and a file. Writes one event per line: E, X, or L and the repr of the leaf."""
+    for kind,value in events:
+        if kind == ENTER:
+            f.write('E\n')
+        elif kind == EXIT:
+            f.write('X\n')
+        else:
+            f.write('L %r\n' % (value,))
+
+def read_events(f):
+    """Accepts a file written by write_events. Yields its events. Leaves must be Python literals."""
+    for line in f:
+        if line.startswith('E'):
+            yield ENTER, None
+        elif line.startswith('X'):
+            yield EXIT, None
+        elif line.startswith('L '):
+            yield LEAF, literal_eval(line[2:])
+        elif line.strip():
+            raise pypm.ASTException('not an event: {0!r}'.format(line))
+
+
+_CONST, _VAR, _FRAGMENT = 0, 1, 2
+
+def _fragments(pattern, fragments):
+    """Accepts a pattern and the list of fragments so far.
+        Appends the fragment of every tuple in the pattern, as (elements, length, StarArgs label or None),
+            where an element is (_CONST, constant), (_VAR, label) or (_FRAGMENT, fragment number).
+        Returns the number of the pattern's own fragment.
+    """
+    n = len(fragments)
+    fragments.append(None)
+    star = None
+    if pypm._is_star(pattern):
+        star = pattern[-1].label
+        pattern = pattern[:-1]
+    elements = []
+    for p in pattern:
+        if isinstance(p, tuple):
+            elements.append((_FRAGMENT, _fragments(p, fragments)))
+        elif isinstance(p, pypm.PatternVar):
+            elements.append((_VAR, p.label))
+        else:
+            elements.append((_CONST, p))
+    fragments[n] = (elements, len(elements), star)
+    return n
+
+class _Open(object):
+    """An open node: its index in its parent, the number of elements so far,
+        fragment number => bindings for the fragments it can still match,
+        and its elements, if it is being built.
+    """
+    __slots__ = ('index', 'count', 'alive', 'items')
+
+    def __init__(self, index, alive, items):
+        self.index = index
+        self.count = 0
+        self.alive = alive
+        self.items = items
+
+def _advance(fragments, node, value, matched):
+    """Accepts an open node and its next element: a leaf (matched is None),
+        or a closed child and the fragments it matched.
+    """
+    i = node.count
+    node.count = i + 1
+    dead = []
+    for f,bindings in node.alive.iteritems():
+        elements,k,star = fragments[f]
+        if i < k:
+            tag,x = elements[i]
+            if tag == _VAR:
+                bindings[x] = value
+            elif tag == _CONST:
+                if matched is not None or value != x:
+                    dead.append(f)
+            elif matched is None or x not in matched:
+                dead.append(f)
+            else:
+                bindings.update(matched[x])
+        elif star is not None:
+            bindings.setdefault(star, []).append(value)
+        else:
+            dead.append(f)
+    for f in dead:
+        del node.alive[f]
+
+def match_events(patterns, events):
+    """Accepts a list of pattern keys (patterns, or (pattern, guard)) and events.
+        Yields (path, bindings) for every node which matches one of the patterns, as soon as it closes
+            (so children before their parents), with the bindings of the first pattern that matches it.
+        Patterns match like patternmatch(..., exact=True) patterns, AnyNode and StarArgs included.
+    """
+    fragments = []
+    roots = []
+    for key in patterns:
+        pattern,guard = pypm.split_guard(key)
+        # checks that no variable is used twice
+        pypm.binding_paths(pattern)
+        roots.append((_fragments(pattern, fragments), guard))
+
+    stack = []
+    for kind,value in events:
+        if kind == ENTER:
+            # every node may match any pattern, and whatever its parent needs at its position
+            alive = dict((f, {}) for f,guard in roots)
+            if stack:
+                parent = stack[-1]
+                i = parent.count
+                build = parent.items is not None
+                for f in parent.alive:
+                    elements,k,star = fragments[f]
+                    if i < k:
+                        tag,x = elements[i]
+                        if tag == _FRAGMENT:
+                            alive[x] = {}
+                        elif tag == _VAR:
+                            build = True
+                    elif star is not None:
+                        build = True
+            else:
+                i = None
+                build = False
+            stack.append(_Open(i, alive, [] if build else None))
+
+        elif kind == LEAF:
+            if not stack:
+                raise pypm.ASTException('leaf outside of a node: {0!r}'.format(value))
+            node = stack[-1]
+            _advance(fragments, node, value, None)
+            if node.items is not None:
+                node.items.append(value)
+
+        elif kind == EXIT:
+            if not stack:
+                raise pypm.ASTException('more nodes closed than opened')
+            node = stack.pop()
+            matched = {}
+            for f,bindings in node.alive.iteritems():
+                elements,k,star = fragments[f]
+                if node.count == k or (star is not None and node.count > k):
+                    if star is not None:
+                        bindings[star] = tuple(bindings.get(star, ()))
+                    matched[f] = bindings
+            for f,guard in roots:
+                if f in matched and (guard is None or pypm.is_guard_correct(matched[f], guard)):
+                    # the path is only put together for a match, open nodes just know their index
+                    path = tuple(n.index for n in stack[1:])
+                    if stack:
+                        path += (node.index,)
+                    yield path, dict(matched[f])
+                    break
+            if stack:
+                value = tuple(node.items) if node.items is not None else None
+                parent = stack[-1]
+                _advance(fragments, parent, value, matched)
+                if parent.items is not None:
+                    parent.items.append(value)
+        else:
+            raise pypm.ASTException('unknown event: {0!r}'.format(kind))
+    if stack:
+        raise pypm.ASTException('{0} nodes still open at the end of the events'.format(len(stack)))
@@ -0,0 +1,199 @@
+"""
+Streaming tokenizer front end for pyparse.
+
+A TokenSpec is a declarative list of (kind, regular expression) pairs, tried in order.
+    It tokenizes strings, memory-mapped files and chunked streams (anything with read(n)),
+    without ever holding more than a chunk of the source text,
+    and emits Tokens: strings which also know their kind and source offsets.
+
+A TokenBuffer hands the tokens to pyparse as they are needed,
+    so parsing starts before the whole input has been tokenized:
+
+    tokens = TokenBuffer(tokenize_file('big.expr', CHARACTERS))
+    ast,remaining = pyparse.parse(pyparse.simple_expression, tokens, whole=True)
+
+Single-character grammars (everything in pyparse but Kind) use CHARACTERS,
+    which gives the same tokens as pyparse.whitespace_tokenize.
+Multi-character token specs are matched with pyparse.Kind.
+"""
+import mmap
+import os
+import re
+
+
+class TokenizeError(Exception):
+    pass
+
+
+class Token(str):
+    """The text of a token, with its kind and [start, end) offsets in the source."""
+    def __new__(cls, text, kind, start):
+        t = str.__new__(cls, text)
+        t.kind = kind
+        t.start = start
+        t.end = start + len(text)
+        return t
+
+    def __repr__(self):
+        return 'Token(%s, %r, %d)' % (str.__repr__(self), self.kind, self.start)
+
+
+class TokenSpec(object):
+    """Accepts a list of (kind, regular expression) pairs, and the kinds to drop (like whitespace).
+        At every position the first expression that matches wins.
+        lookahead is how many characters past the end of a token may decide it,
+            like the '.5' which makes '12' part of FLOAT '12.5' rather than an INT.
+            A chunked stream only gives out the tokens which end at least that far before
+            the text read so far, so the tokens are the same wherever the chunks split.
+    """
+    def __init__(self, rules, skip=(), lookahead=32):
+        if lookahead < 1:
+            raise ValueError('lookahead must be at least 1: {0}'.format(lookahead))
+        self.rules = list(rules)
+        self.skip = frozenset(skip)
+        self.lookahead = lookahead
+        self.regex = re.compile('|'.join('(?P<%s>%s)' % (kind, rx) for kind,rx in self.rules), re.DOTALL)
+
+    def _scan(self, text, pos, base, final):
+        """Accepts text, where it starts in the source (base), and whether the source ends with it.
+            Yields the tokens, then (as a plain int) the position where the unscanned rest starts.
+        """
+        match = self.regex.match
+        n = len(text)
+        # tokens must end before this, unless the text is the end of the source
+        last = n - self.lookahead
+        while pos < n:
+            m = match(text, pos)
+            if m is None or m.end() == pos:
+                if final:
+                    raise TokenizeError('no token matches at offset {0}: {1!r}'.format(base + pos, text[pos:pos+20]))
+                break
+            if m.end() > last and not final:
+                # the token may go on in the next chunk, or a longer expression may match there
+                break
+            kind = m.lastgroup
+            if kind not in self.skip:
+                yield Token(m.group(), kind, base + pos)
+            pos = m.end()
+        yield pos
+
+    def tokenize(self, source, chunksize=1 << 16):
+        """Accepts a string or mmap (scanned in place), or a stream with read(n) (read in chunks).
+            Yields Tokens.
+        """
+        if isinstance(source, (basestring, mmap.mmap)):
+            for t in self._scan(source, 0, 0, True):
+                if isinstance(t, Token):
+                    yield t
+            return
+
+        text,base,final = '', 0, False
+        while not final:
+            chunk = source.read(chunksize)
+            final = len(chunk) == 0
+            text += chunk
+            for t in self._scan(text, 0, base, final):
+                if isinstance(t, Token):
+                    yield t
+                else:
+                    text,base = text[t:], base + t
+
+CHARACTERS = TokenSpec([('WS', r'[ \r\n]+'), ('CHAR', r'.')], skip=['WS'])
+
+def tokenize_file(path, spec, chunksize=1 << 16):
+    """Accepts a path and a TokenSpec.
+        Yields the file's Tokens, scanning a memory map of the file in place.
+    """
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            # empty files cannot be mapped
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for t in spec.tokenize(m, chunksize):
+                yield t
+        finally:
+            m.close()
+
+
+class TokenBuffer(object):
+    """A list of tokens which fills itself from an iterator as parsers look further ahead.
+        Tokens are kept once pulled, since parsers backtrack.
+        len() pulls everything; parsers use lazy_end instead.
+    """
+    def __init__(self, tokens):
+        self.tokens = []
+        self.iterator = iter(tokens)
+        self.done = False
+        self.lazy_end = _LazyEnd(self)
+
+    def has(self, i):
+        """Returns whether there is a token at index i, pulling tokens up to it if needed."""
+        tokens = self.tokens
+        while len(tokens) <= i and not self.done:
+            try:
+                tokens.append(next(self.iterator))
+            except StopIteration:
+                self.done = True
+        return i < len(tokens)
+
+    def __len__(self):
+        while not self.done:
+            self.has(len(self.tokens))
+        return len(self.tokens)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            if i.stop is None or i.stop < 0 or (i.start is not None and i.start < 0):
+                len(self)
+            else:
+                self.has(i.stop - 1)
+            return self.tokens[i]
+        if i < 0:
+            len(self)
+        else:
+            self.has(i)
+        return self.tokens[i]
+
+    def __iter__(self):
+        i = 0
+        while self.has(i):
+            yield self.tokens[i]
+            i += 1
+
+class _LazyEnd(object):
+    """Stands in for len(buffer) as the end position while a TokenBuffer is still filling.
+        Comparing a position against it pulls only the tokens needed to answer.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+
+    def _within(self, pos):
+        # pos <= len(buf)
+        return pos == 0 or self.buf.has(pos - 1)
+
+    def __gt__(self, pos):
+        return self.buf.has(pos)
+
+    def __le__(self, pos):
+        return not self.buf.has(pos)
+
+    def __ge__(self, pos):
+        return self._within(pos)
+
+    def __lt__(self, pos):
+        return not self._within(pos)
+
+    def __eq__(self, pos):
+        if isinstance(pos, _LazyEnd):
+            return pos is self
+        return self._within(pos) and not self.buf.has(pos)
+
+    def __ne__(self, pos):
+        return not self.__eq__(pos)
+
+    def __hash__(self):
+        return id(self)
+
+    def __repr__(self):
+        return '<end of %d+ tokens>' % len(self.buf.tokens)
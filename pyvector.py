@@ -0,0 +1,208 @@
+"""
+Batch evaluation of a rule set over many ASTs, vectorized with NumPy by shape.
+
+    results = pyvector.batch_apply(evalNumeric, asts)    # == [evalNumeric(ast) for ast in asts]
+
+The ASTs are grouped by shape: the tree with its numeric leaves left out.
+For every shape with enough ASTs, the numeric leaves at each position are gathered into one array,
+    and the function runs once on the shape with the arrays as leaves,
+    so matching and dispatch happen once per shape, and arithmetic in the actions on whole arrays.
+The result is split back into one result per AST.
+
+Anything the arrays cannot stand in for falls back to calling the function on every AST of the shape:
+    an exception (including a guard which did not return a bool, since a guard comparing arrays
+    returns an array), or a result which is not one value per AST, or has a leaf which is neither
+    an array nor a constant of the shape (like a string computed from the leaves).
+Patterns only have string constants, so the leaves only matter to matching through guards.
+Actions must treat numeric leaves as numbers (arithmetic and comparisons), not look at their type or length.
+
+Integers go into arrays of Python ints (dtype object) by default, so they never overflow;
+    int_dtype=numpy.int64 is faster, for values known to fit. Floats go into float64 arrays.
+Without NumPy, batch_apply is the plain loop.
+"""
+from itertools import repeat
+
+import pypm
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+# the slots of int and float leaves, and of child nodes
+_INT, _FLOAT, _NODE = object(), object(), object()
+
+class _Fallback(Exception):
+    pass
+
+def shape(ast):
+    """Accepts an AST.
+        Returns (key, leaves): the key of its shape, and its int and float leaves.
+        The key lists the nodes breadth first, each as its length and its elements,
+            with slots for child nodes and for int and float leaves,
+            and other leaves than strings and None as (type, leaf), so no two shapes have the same key.
+    """
+    key = []
+    leaves = []
+    queue = [ast]
+    # the loop sees the nodes appended to the queue
+    for node in queue:
+        key.append(len(node))
+        for x in node:
+            t = type(x)
+            if t is str or x is None:
+                key.append(x)
+            elif t is int or t is long:
+                key.append(_INT)
+                leaves.append(x)
+            elif t is float:
+                key.append(_FLOAT)
+                leaves.append(x)
+            elif t is tuple or pypm.is_node(x):
+                key.append(_NODE)
+                queue.append(x)
+            else:
+                key.append((t, x))
+    return tuple(key), leaves
+
+def _fill(key, columns):
+    """Accepts a shape's key and one value per slot. Returns the shape as an AST, the slots filled in."""
+    columns = iter(columns)
+    # the nodes breadth first, as lists of elements, and the (position, node number) of their children
+    nodes = []
+    children = []
+    count = 1
+    pos = 0
+    while pos < len(key):
+        n = key[pos]
+        elements = list(key[pos + 1:pos + 1 + n])
+        kids = []
+        for j,x in enumerate(elements):
+            if x is _INT or x is _FLOAT:
+                elements[j] = next(columns)
+            elif x is _NODE:
+                kids.append((j, count))
+                count += 1
+            elif isinstance(x, tuple):
+                elements[j] = x[1]
+        nodes.append(elements)
+        children.append(kids)
+        pos += 1 + n
+    # children come after their parents
+    built = [None] * len(nodes)
+    for i in xrange(len(nodes) - 1, -1, -1):
+        elements = nodes[i]
+        for j,c in children[i]:
+            elements[j] = built[c]
+        built[i] = tuple(elements)
+    return built[0]
+
+def _constants(key):
+    """Accepts a shape's key. Returns the set of (type, leaf) of the leaves which are the same in all its ASTs."""
+    constants = set()
+    for x in key:
+        if x is _INT or x is _FLOAT or x is _NODE or type(x) is int:
+            continue
+        elif isinstance(x, tuple):
+            constants.add(x)
+        else:
+            constants.add((type(x), x))
+    return constants
+
+def _unstack(result, n, constants):
+    """Accepts a result computed on arrays of n values, and the constants of the shape.
+        Returns the list of the results for every AST, or (None, result) if it is the same for all.
+    """
+    def one(x):
+        if isinstance(x, numpy.ndarray):
+            if x.shape != (n,):
+                raise _Fallback()
+            return x.tolist()
+        # any other leaf may have been computed from the arrays (like len, sum or str),
+        #   rather than copied through, unless it is one of the shape's own constants
+        try:
+            if (type(x), x) in constants:
+                return None, x
+        except TypeError:
+            pass
+        raise _Fallback()
+
+    if not pypm.is_node(result):
+        return one(result)
+    # (node, per item columns of its elements so far)
+    stack = [(result, [])]
+    while True:
+        t,columns = stack[-1]
+        if len(columns) == len(t):
+            stack.pop()
+            if all(isinstance(c, tuple) for c in columns):
+                built = None, tuple(c[1] for c in columns)
+            else:
+                built = zip(*[repeat(c[1], n) if isinstance(c, tuple) else c for c in columns])
+            if not stack:
+                return built
+            stack[-1][1].append(built)
+            continue
+        x = t[len(columns)]
+        if pypm.is_node(x):
+            stack.append((x, []))
+        else:
+            columns.append(one(x))
+
+def batch_apply(f, asts, min_batch=2, int_dtype=object, stats=None):
+    """Accepts a @patternmatch function and a list of ASTs.
+        Returns [f(ast) for ast in asts], running f once per shape of at least min_batch ASTs where it can.
+        stats, a dictionary, gets the number of ASTs done 'vectorized' and by 'fallback', and of 'shapes'.
+    """
+    asts = list(asts)
+    results = [None] * len(asts)
+    counts = {'vectorized': 0, 'fallback': 0, 'shapes': 0}
+    if numpy is None:
+        groups = {None: range(len(asts))}
+        keys = {}
+    else:
+        groups = {}
+        keys = {}
+        for i,ast in enumerate(asts):
+            try:
+                key,leaves = shape(ast)
+                groups.setdefault(key, []).append(i)
+            except TypeError:
+                # an unhashable leaf
+                groups.setdefault(None, []).append(i)
+                continue
+            keys[i] = leaves
+
+    for key,members in groups.iteritems():
+        counts['shapes'] += 1
+        if key is not None and len(members) >= min_batch:
+            try:
+                columns = []
+                for j in xrange(len(keys[members[0]])):
+                    values = [keys[i][j] for i in members]
+                    if isinstance(values[0], float):
+                        columns.append(numpy.array(values, dtype=numpy.float64))
+                    else:
+                        column = numpy.empty(len(values), dtype=int_dtype)
+                        column[:] = values
+                        columns.append(column)
+                with numpy.errstate(all='raise'):
+                    result = f(_fill(key, columns))
+                picked = _unstack(result, len(members), _constants(key))
+                if isinstance(picked, tuple):
+                    picked = [picked[1]] * len(members)
+            except Exception:
+                pass
+            else:
+                for i,r in zip(members, picked):
+                    results[i] = r
+                counts['vectorized'] += len(members)
+                continue
+        for i in members:
+            results[i] = f(asts[i])
+        counts['fallback'] += len(members)
+
+    if stats is not None:
+        stats.update(counts)
+    return results
@@ -0,0 +1,31 @@
+import json
+from StringIO import StringIO
+
+import benchmarks
+
+
+def test_generators():
+    ast = benchmarks.make_ast(2, 3)
+    assert ast[1] == ast[2] and ast[1] is not ast[2]
+    shared = benchmarks.make_ast(2, 3, shared=True)
+    assert shared == ast and shared[1] is shared[2]
+    assert len(benchmarks.make_rules(5)) == 6
+    assert ''.join(benchmarks.make_tokens(4)) == '1+2*3-4'
+
+def test_run_and_compare(tmpdir):
+    results = benchmarks.run(quick=True, repeat=1, mintime=0)
+    assert set(results['benchmarks']) == set(name for name,bench,params in benchmarks.suite())
+    assert all(r['seconds'] >= 0 for r in results['benchmarks'].values())
+
+    old = {'benchmarks': {'x': {'seconds': 1.0}, 'y': {'seconds': 1.0}, 'z': {'seconds': 1.0}}}
+    new = {'benchmarks': {'x': {'seconds': 1.05}, 'y': {'seconds': 2.0}}}
+    rows = benchmarks.compare(old, new)
+    assert [(name, regressed) for name,o,n,ratio,regressed in rows] == [('x', False), ('y', True)]
+
+    before,after = tmpdir.join('before.json'), tmpdir.join('after.json')
+    before.write(json.dumps(old))
+    after.write(json.dumps(new))
+    out = StringIO()
+    assert benchmarks.main(['--compare', str(before), str(after)], out) == 1
+    assert 'REGRESSION' in out.getvalue()
+    assert benchmarks.main(['--compare', str(before), str(before)], StringIO()) == 0
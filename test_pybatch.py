@@ -0,0 +1,83 @@
+import os
+import subprocess
+import sys
+import time
+from StringIO import StringIO
+
+import pybatch
+from pypm import patternmatch,a,b
+
+def num(ast):
+    return evalExpression(ast)[1]
+
+@patternmatch([
+    {('EXPR', a):           lambda a: evalExpression(a)},
+    {('OP', a, '+', b):     lambda a,b: ('Num', num(a) + num(b))},
+    {('OP', a, '-', b):     lambda a,b: ('Num', num(a) - num(b))},
+    {('OP', a, '*', b):     lambda a,b: ('Num', num(a) * num(b))},
+    {('Num', a):            lambda a: ('Num', a)},
+])
+def evalExpression(ast):
+    pass
+
+def write_files(tmpdir, texts):
+    paths = []
+    for i,text in enumerate(texts):
+        p = tmpdir.join('%d.expr' % i)
+        p.write(text)
+        paths.append(str(p))
+    return paths
+
+def test_run_batch_in_order(tmpdir):
+    texts = ['%d + %d' % (i, i) for i in xrange(40)]
+    paths = write_files(tmpdir, texts)
+    for workers in (1, 2):
+        results = list(pybatch.run_batch(paths, 'test_pybatch:evalExpression', workers=workers, chunksize=3))
+        assert [r[0] for r in results] == paths
+        assert [r[2] for r in results] == [repr(('Num', 2 * i)) for i in xrange(40)]
+
+def test_main_reports_failures(tmpdir):
+    paths = write_files(tmpdir, ['1 + 2', '1 +', '3 * 4'])
+    paths.insert(1, str(tmpdir.join('missing.expr')))
+    stdout,stderr = StringIO(), StringIO()
+    status = pybatch.main(['--workers', '1', 'test_pybatch:evalExpression'] + paths, stdout=stdout, stderr=stderr)
+    assert status == 1
+    assert stdout.getvalue().splitlines() == ['%s\t%r' % (paths[0], ('Num', 3)), '%s\t%r' % (paths[3], ('Num', 12))]
+    errors = stderr.getvalue().splitlines()
+    assert errors[0].startswith(paths[1] + '\tERROR IOError')
+    assert errors[1].startswith(paths[2] + '\tERROR ParseException')
+    assert errors[2].startswith('4 files, 2 failed')
+
+def test_pattern_list_rules(tmpdir):
+    paths = write_files(tmpdir, ['2 * 3'])
+    stdout,stderr = StringIO(), StringIO()
+    stdin = StringIO(paths[0] + '\n')
+    assert pybatch.main(['test_pyrewrite:arithmetic', '--workers', '1'], stdin=stdin, stdout=stdout, stderr=stderr) == 0
+    assert stdout.getvalue() == '%s\t%r\n' % (paths[0], ('Num', 6))
+
+def test_bad_spec_exits(tmpdir):
+    paths = write_files(tmpdir, ['1 + 2'])
+    stdout,stderr = StringIO(), StringIO()
+    assert pybatch.main(['nosuch:thing'] + paths, stdout=stdout, stderr=stderr) == 2
+    assert stderr.getvalue().startswith('error: cannot load rules nosuch:thing')
+    assert stdout.getvalue() == ''
+
+    # with a pool, the program stops at once rather than restarting workers which cannot load
+    here = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen([sys.executable, '-m', 'pypm', 'nosuch:thing'] + paths, cwd=here,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    deadline = time.time() + 30
+    while process.poll() is None and time.time() < deadline:
+        time.sleep(0.05)
+    if process.poll() is None:
+        process.kill()
+        raise AssertionError('python -m pypm did not stop on a bad rules spec')
+    assert process.returncode == 2
+    assert 'cannot load rules nosuch:thing' in process.stderr.read()
+
+def test_worker_reports_load_errors(monkeypatch):
+    monkeypatch.setattr(pybatch, '_pipeline', None)
+    monkeypatch.setattr(pybatch, '_pipeline_error', None)
+    pybatch._init_worker('nosuch:thing', 'pyparse:simple_expression')
+    path,ok,out,n = pybatch.process_file('x.expr')
+    assert not ok and out.startswith('cannot load the pipeline: ImportError')
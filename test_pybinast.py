@@ -0,0 +1,57 @@
+import pybinast
+import pypm
+from pypm import patternmatch,a,starargs
+from test_pypm import patterns,seven,fourteen,ninetyeight,ninety,big
+
+def test_roundtrip(tmpdir):
+    leaves = ('Leaves', 'x', u'\xe9', 0, -5, 1 << 62, 1 << 70, -(1 << 70), 2.5, None, True, False, ())
+    for ast in [big, leaves, fourteen, ('Empty',)]:
+        view = pybinast.loads(pybinast.dumps(ast))
+        assert isinstance(view, pybinast.NodeView)
+        assert pybinast.to_tuple(view) == ast
+        assert view == ast and ast == view
+        assert hash(view) == hash(ast)
+        assert len(view) == len(ast) and view[-1] == ast[-1] and view[1:] == ast[1:]
+
+    path = str(tmpdir.join('big.bin'))
+    pybinast.dump(big, path)
+    assert pybinast.load(path) == big
+
+    # shared subtrees are written once
+    unshared = ('Sum', ('Sum', ('Num', 3), ('Num', 4)), ('Sum', ('Num', 3), ('Num', 4)))
+    assert len(pybinast.dumps(fourteen)) < len(pybinast.dumps(unshared))
+
+    try:
+        pybinast.loads('XXXX' + pybinast.dumps(big)[4:])
+    except pybinast.FormatError:
+        pass
+    else:
+        raise AssertionError('no FormatError')
+
+    # leaves of other types are refused, not pickled
+    try:
+        pybinast.dumps(('Set', frozenset([1])))
+    except pybinast.FormatError:
+        pass
+    else:
+        raise AssertionError('no FormatError')
+
+def test_match_views():
+    for compiled in (True, False):
+        @patternmatch(patterns, compiled=compiled)
+        def evaluate(ast):
+            pass
+        for ast in [seven, fourteen, ninetyeight, ninety]:
+            view = pybinast.loads(pybinast.dumps(ast))
+            assert evaluate(view) == evaluate(ast)
+        m = pypm.match_and_extract_matched_vars(('EXPR', ('OP', a, starargs)), pybinast.loads(pybinast.dumps(big)))
+        assert m['a'] == ('Num', 5) and m['starargs'] == big[1][2:]
+
+def test_lazy():
+    view = pybinast.loads(pybinast.dumps(big))
+    @patternmatch([{('Num', a): lambda a: a}, {('EXPR', a): lambda a: 'expr'}])
+    def f(ast):
+        pass
+    assert f(view) == 'expr'
+    # only the root's name was decoded
+    assert view.strings.cache.values() == ['EXPR']
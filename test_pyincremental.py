@@ -0,0 +1,96 @@
+import random
+
+import pyincremental
+import pyparse
+
+
+def tokens(s):
+    return pyparse.whitespace_tokenize(s)
+
+def test_edit_same_as_parse():
+    random.seed(3)
+    parenthesized = pyparse.Recursive()
+    term = pyparse.Any(pyparse.Nested('(', ')', parenthesized), pyparse.Int())
+    parenthesized.update('P', pyparse.Precedence(term, [('*', 20, 'left'), ('+', 10, 'left')]))
+    grammars = [pyparse.simple_expression, pyparse.arith_expression, parenthesized]
+    for grammar in grammars:
+        w = tokens('1 + (2 * 3) + 45 * (6 + (7)) * 8')
+        doc = pyincremental.IncrementalParse(grammar, w, whole=True)
+        assert doc.parse() == pyparse.parse(grammar, w, whole=True)
+        for n in xrange(200):
+            start = random.randint(0, len(w))
+            stop = random.randint(start, min(len(w), start + 3))
+            new = [random.choice('12+*()') for i in xrange(random.randint(0, 3))]
+            w[start:stop] = new
+            assert doc.edit(start, stop, new) == pyparse.parse(grammar, w, whole=True)
+            assert doc.tokens == w
+
+def test_reuses_subtrees():
+    w = tokens('+'.join('(%d*%d)' % (i, i) for i in xrange(200)))
+    term = pyparse.Nested('(', ')', pyparse.arith_expression)
+    grammar = pyparse.Precedence(term, [('+', 10, 'left')])
+    doc = pyincremental.IncrementalParse(grammar, w, whole=True)
+    before,remaining = doc.parse()
+    assert remaining == []
+    full = doc.stats()['misses']
+
+    # change the 2 in (2*2) to a 9
+    i = w.index('2')
+    after,remaining = doc.edit(i, i + 1, ['9'])
+    assert after == pyparse.parse(grammar, w[:i] + ['9'] + w[i+1:], whole=True)[0]
+    assert doc.stats()['misses'] - full < full / 10
+
+    def operands(ast):
+        while ast[2] == '+':
+            yield ast[3]
+            ast = ast[1]
+        yield ast
+    old,new = list(operands(before)), list(operands(after))
+    changed = [j for j in xrange(len(old)) if old[j] is not new[j]]
+    assert changed == [len(old) - 3]
+    assert new[-3] == ('OP', ('Num', 9), '*', ('Num', 2))
+    # the span of the parenthesized group, which has the same value
+    assert doc.span(new[-3]) == (i - 1, i + 4)
+
+def test_append_at_end():
+    w = tokens('1 + 2')
+    doc = pyincremental.IncrementalParse(pyparse.arith_expression, w, whole=True)
+    assert doc.parse()[0] == ('OP', ('Num', 1), '+', ('Num', 2))
+    assert doc.edit(3, 3, ['3'])[0] == ('OP', ('Num', 1), '+', ('Num', 23))
+    assert doc.edit(0, 0, ['4', '*'])[0] == ('OP', ('OP', ('Num', 4), '*', ('Num', 1)), '+', ('Num', 23))
+    assert doc.edit(6, 6, ['+']) == (None, ['4', '*', '1', '+', '2', '3', '+'])
+
+def test_edit_scales_with_the_edit():
+    term = pyparse.Nested('(', ')', pyparse.arith_expression)
+    grammar = pyparse.Any(pyparse.Nested('[', ']', pyparse.Precedence(term, [('+', 10, 'left')])), term)
+    def work(n):
+        # n groups, each of them nested in the next, so every group encloses the edit in the middle
+        w = tokens(' '.join(['[ ( 1 * 2 ) +'] * n + ['( 3 * 4 )'] + [']'] * n))
+        doc = pyincremental.IncrementalParse(grammar, w, whole=True)
+        doc.parse()
+        i = w.index('3')
+        before = doc.stats()
+        after = doc.edit(i, i + 1, ['5'])
+        assert after == pyparse.parse(grammar, w[:i] + ['5'] + w[i+1:], whole=True)
+        done = doc.stats()
+        return dict((k, done[k] - before[k]) for k in ('examined', 'invalidated', 'misses'))
+    # what an edit forgets and reparses grows with the nodes enclosing it, not with the rest of the document
+    small,large = work(20), work(40)
+    assert large['examined'] <= 2 * small['examined'] + 2
+    assert large['misses'] <= 2 * small['misses'] + 2
+
+    def flat(n):
+        w = tokens(' + '.join('( %d * %d )' % (i, i) for i in xrange(n)))
+        doc = pyincremental.IncrementalParse(pyparse.Precedence(term, [('+', 10, 'left')]), w, whole=True)
+        doc.parse()
+        i = len(w) // 2
+        i = w.index('*', i) - 1
+        before = doc.stats()
+        doc.edit(i, i + 1, ['7'])
+        done = doc.stats()
+        return dict((k, done[k] - before[k]) for k in ('examined', 'invalidated', 'misses'))
+    # in one long chain, only the chain itself encloses the edit
+    small,large = flat(500), flat(8000)
+    assert large['examined'] <= small['examined'] + 4
+    assert large['invalidated'] <= small['invalidated'] + 4
+    assert large['misses'] <= small['misses'] + 4
@@ -0,0 +1,80 @@
+import pyintern
+from pyintern import NodeStore,hashcons,to_tuple
+from pypm import patternmatch,a,b
+
+seven = ("Sum", ("Num", 3), ("Num", 4))
+fourteen = ("Sum", seven, ("Sum", ("Num", 3), ("Num", 4)))
+
+def test_sharing():
+    store = NodeStore()
+    n = store.hashcons(fourteen)
+    assert n[1] is n[2]
+    assert store.hashcons(seven) is n[1]
+    assert len(store) == 4
+    assert n.size == 7
+    assert n.depth == 3
+
+def test_tuple_compatible():
+    store = NodeStore()
+    n = store.hashcons(fourteen)
+    assert n == fourteen
+    assert fourteen == n
+    assert hash(n) == hash(fourteen)
+    assert n[0] == "Sum"
+    assert len(n) == 3
+    assert n[1:] == (seven, seven)
+    assert list(n[1]) == ["Sum", ("Num", 3), ("Num", 4)]
+    assert to_tuple(n) == fourteen
+    assert type(to_tuple(n)) is tuple
+    assert n != seven
+    assert {fourteen: 1}[n] == 1
+
+def test_patterns_match_nodes():
+    @patternmatch([
+        {("Sum", a, b):     lambda a,b: evalNumeric(a) + evalNumeric(b)},
+        {("Num", a):        lambda a: a},
+    ])
+    def evalNumeric(ast):
+        pass
+
+    @patternmatch([
+        {("Sum", a, b):     lambda a,b: evalNumeric(a) + evalNumeric(b)},
+        {("Num", a):        lambda a: a},
+    ], compiled=False)
+    def evalInterpreted(ast):
+        pass
+
+    n = hashcons(fourteen)
+    assert evalNumeric(n) == 14
+    assert evalInterpreted(n) == 14
+
+def test_equal_leaves_of_other_types():
+    store = NodeStore()
+    leaves = [1, 1.0, True, 1L, 'x', u'x']
+    nodes = [store.hashcons(('Num', x)) for x in leaves]
+    for x,n in zip(leaves, nodes):
+        assert type(n[1]) is type(x)
+    assert len(set(map(id, nodes))) == len(leaves)
+    store.hashcons(('Sum', ('Num', 1), ('Num', 1)))
+    assert type(store.hashcons(('Sum', ('Num', 1), ('Num', 1.0)))[2][1]) is float
+    assert type(store.hashcons(('Flag', True))[1]) is bool
+
+def test_default_store_is_weak():
+    n = hashcons(("Sum", ("Num", 12345), ("Num", 54321)))
+    assert hashcons(("Num", 12345)) is n[1]
+    count = len(pyintern.default_store)
+    del n
+    # the store alone keeps none of the three nodes alive
+    assert len(pyintern.default_store) == count - 3
+
+    store = NodeStore()
+    store.hashcons(("Num", 1))
+    assert len(store) == 1
+
+def test_deep():
+    ast = ("Num", 0)
+    for i in xrange(10000):
+        ast = ("Neg", ast)
+    n = hashcons(ast, NodeStore())
+    assert n.depth == 10001
+    assert to_tuple(n)[1][1][0] == "Neg"
@@ -5,3 +5,159 @@ def test_simple():
     w = pyparse.whitespace_tokenize(s)
     ast,remaining = pyparse.parse(pyparse.simple_expression, w, whole=True)
     assert remaining == []
+
+def test_symbol():
+    # a Symbol matches the first token, with more tokens after it
+    assert pyparse.parse(pyparse.Symbol('+'), ['+', '1']) == ('+', ['1'])
+    assert pyparse.parse(pyparse.Symbol('+'), ['+']) == ('+', [])
+    assert pyparse.parse(pyparse.Symbol('+'), ['-', '+']) == (None, ['-', '+'])
+    assert pyparse.parse(pyparse.Symbol('+'), []) == (None, [])
+
+def test_packrat_same_result():
+    for s in ['5 + 323 - 12 * 18', '7', '1 + ', '']:
+        w = pyparse.whitespace_tokenize(s)
+        assert (pyparse.parse(pyparse.simple_expression, w, whole=True) ==
+                pyparse.parse(pyparse.simple_expression, w, whole=True, packrat=True))
+
+def test_packrat_stats():
+    w = pyparse.whitespace_tokenize('5 + 323 - 12 * 18')
+    memo = pyparse.Packrat()
+    ast,remaining = pyparse.parse(pyparse.simple_expression, w, whole=True, packrat=memo)
+    assert remaining == []
+    stats = memo.stats()
+    # the Int() of the last operand is parsed once by OP and again by the Int() alternative
+    assert stats['hits'] > 0
+    assert stats['misses'] > 0
+    assert stats['evictions'] == 0
+
+    small = pyparse.Packrat(maxsize=2)
+    assert pyparse.parse(pyparse.simple_expression, w, whole=True, packrat=small) == (ast, [])
+    assert small.stats()['evictions'] > 0
+
+def test_packrat_nested():
+    inner = pyparse.Join('PAIR', pyparse.Int(), pyparse.Symbol(','), pyparse.Int())
+    p = pyparse.Any(pyparse.Join('CALL', pyparse.AlphaWord(), pyparse.Nested('(', ')', inner)),
+                    pyparse.Join('NAME', pyparse.AlphaWord()))
+    w = pyparse.whitespace_tokenize('f(1,2)')
+    assert pyparse.parse(p, w, whole=True, packrat=True) == (('CALL', 'f', ('PAIR', ('Num', 1), ',', ('Num', 2))), [])
+    assert pyparse.parse(p, w, whole=True) == (('CALL', 'f', ('PAIR', ('Num', 1), ',', ('Num', 2))), [])
+
+def test_long_input_is_linear():
+    # slicing the remaining input at every token would copy 10**10 elements here
+    w = ['a'] * 100000 + ['b']
+    parsed,remaining = pyparse.parse(pyparse.Repeat(pyparse.Symbol('a')), w)
+    assert len(parsed) == 100000
+    assert remaining == ['b']
+
+def test_old_style_parser():
+    class Digit(pyparse.ASTNode):
+        def parse(self, s, whole=False):
+            if len(s) > 0 and s[0].isdigit():
+                return ('Digit', s[0]), s[1:]
+            else:
+                return None, s
+
+    p = pyparse.Join('PAIR', Digit(), pyparse.Symbol(','), Digit())
+    assert pyparse.parse(p, list('1,2x')) == (('PAIR', ('Digit', '1'), ',', ('Digit', '2')), ['x'])
+    assert pyparse.parse(p, list('1,x')) == (None, list('1,x'))
+
+def test_first_sets():
+    first = pyparse.first_sets(pyparse.simple_expression)
+    tokens,nullable = first[id(pyparse.simple_expression)]
+    assert tokens == frozenset('0123456789')
+    assert not nullable
+    assert first[id(pyparse.opsymbol)] == (frozenset('*+-'), False)
+
+def test_compiled_grammar_same_asts():
+    statement = pyparse.Recursive()
+    call = pyparse.Join('CALL', pyparse.AlphaWord(), pyparse.Nested('(', ')', pyparse.Repeat(statement)))
+    let = pyparse.Join('LET', pyparse.Keyword('let'), pyparse.AlphaWord(), pyparse.Symbol('='),
+                       pyparse.simple_expression, pyparse.Symbol(';'))
+    statement.update(None, pyparse.Any(let, call, pyparse.Join('EXPR', pyparse.simple_expression, pyparse.Symbol(';'))))
+    program = pyparse.Repeat(statement)
+
+    inputs = [
+        '5 + 323 - 12 * 18;',
+        'let x = 1 + 2; f(let y = 3; 4;) 7;',
+        'g(h(1;) 2;)',
+        'let = 1;',
+        'f(1;',
+        '',
+    ]
+    for grammar in (program, pyparse.simple_expression):
+        compiled = pyparse.compile_grammar(grammar)
+        for s in inputs:
+            w = pyparse.whitespace_tokenize(s)
+            for whole in (False, True):
+                assert pyparse.parse(compiled, w, whole) == pyparse.parse(grammar, w, whole)
+
+def test_precedence():
+    def p(s, grammar=pyparse.arith_expression):
+        return pyparse.parse(grammar, pyparse.whitespace_tokenize(s), whole=True)
+
+    assert p('5 + 323 - 12 * 18') == (('OP', ('OP', ('Num', 5), '+', ('Num', 323)), '-',
+                                              ('OP', ('Num', 12), '*', ('Num', 18))), [])
+    assert p('7') == (('Num', 7), [])
+    assert p('1 +') == (None, ['1', '+'])
+    assert pyparse.parse(pyparse.arith_expression, pyparse.whitespace_tokenize('1 + 2 +')) == \
+                (('OP', ('Num', 1), '+', ('Num', 2)), ['+'])
+
+    power = pyparse.Precedence(pyparse.Int(), [('^', 30, 'right'), ('*', 20, 'left')])
+    assert p('2 ^ 3 ^ 4 * 5', power) == (('OP', ('OP', ('Num', 2), '^', ('OP', ('Num', 3), '^', ('Num', 4))),
+                                                '*', ('Num', 5)), [])
+
+def test_precedence_long_chain():
+    n = 20000
+    w = pyparse.whitespace_tokenize('+'.join(['1'] * n) + '*2')
+    for grammar in (pyparse.arith_expression, pyparse.compile_grammar(pyparse.arith_expression)):
+        ast,remaining = pyparse.parse(grammar, w, whole=True)
+        assert remaining == []
+        assert ast[3] == ('OP', ('Num', 1), '*', ('Num', 2))
+
+def test_bracket_table():
+    tokens = list('(a[b)(c])]') + [['unhashable'], ')']
+    assert pyparse.bracket_table(tokens) == {0: 4, 5: 8}
+    # every pair nests on its own
+    assert pyparse.bracket_table(tokens, [('(', ')'), ('[', ']')]) == {0: 4, 5: 8, 2: 7}
+    assert pyparse.bracket_table(list('((')) == {}
+    try:
+        pyparse.bracket_table(tokens, [('(', ')'), ('(', ']')])
+    except ValueError:
+        pass
+    else:
+        assert False
+
+def test_nested_brackets():
+    # the table and the scan agree, also inside a shorter end
+    group = pyparse.Recursive()
+    group.update('G', pyparse.Any(pyparse.Nested('(', ')', pyparse.Repeat(group)), pyparse.Int()))
+    for s in ['(1(2)3)', '((1)', '(1))', '()', '(((4))(5))']:
+        w = pyparse.whitespace_tokenize(s)
+        scanned = group.parse_at(w, 0, len(w))
+        assert group.parse(w) == (scanned[0], w[scanned[1]:])
+        assert pyparse.parse(pyparse.compile_grammar(group), w) == group.parse(w)
+    w = list('(1)')
+    assert pyparse.Nested('(', ')').parse(w) == (['1'], [])
+    assert pyparse.Nested('(', ')').parse_at(w, 0, 2) == (None, 0)
+
+class CountingTokens(list):
+    reads = 0
+    def __getitem__(self, i):
+        CountingTokens.reads += 1
+        return list.__getitem__(self, i)
+
+def test_deep_nesting_is_linear():
+    import sys
+    depth = 2000
+    w = CountingTokens(['('] * depth + ['1'] + [')'] * depth)
+    group = pyparse.Recursive()
+    group.update(None, pyparse.Any(pyparse.Nested('(', ')', group), pyparse.Int()))
+    limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(limit, 20000))
+    try:
+        CountingTokens.reads = 0
+        assert group.parse(w) == (('Num', 1), [])
+        # rescanning every level would read depth ** 2 tokens
+        assert CountingTokens.reads < 10 * len(w)
+    finally:
+        sys.setrecursionlimit(limit)
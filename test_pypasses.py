@@ -0,0 +1,78 @@
+import sys
+
+import pyrewrite
+from pypasses import Pass,PassManager
+from pypm import patternmatch,a,b
+
+fold = [
+    {('Sum', ('Num', a), ('Num', b)):   lambda a,b: ('Num', a + b)},
+    {('Mult', ('Num', a), ('Num', b)):  lambda a,b: ('Num', a * b)},
+]
+# makes up new subtrees, which the later passes must walk into
+expand = [
+    {('Double', a):                     lambda a: ('Sum', a, ('Mult', a, ('Num', 1)))},
+]
+unit = [
+    {('Mult', a, ('Num', 1)):           lambda a: a},
+]
+@patternmatch([
+    {('Sum', a, ('Num', 0)):            lambda a: a},
+])
+def zero(ast):
+    pass
+# a top down pass, which does not look inside what it rewrote
+neg = [
+    {('Neg', ('Num', a)):               lambda a: ('Num', -a)},
+    {('Neg', a):                        lambda a: ('Neg', ('Checked', a))},
+]
+
+def sequential(passes, ast):
+    for rules,strategy in passes:
+        ast = pyrewrite.rewrite(rules, ast, strategy, fixpoint=False)
+    return ast
+
+seven = ('Sum', ('Num', 3), ('Num', 4))
+tree = ('Program', ('Double', seven), ('Sum', ('Mult', seven, ('Num', 1)), ('Num', 0)),
+        ('Neg', ('Sum', ('Num', 1), ('Num', 1))), ('Neg', ('Double', ('Num', 2))), 'leaf')
+
+def test_fused_matches_sequential():
+    manager = PassManager([fold, Pass(expand, name='expand'), unit, zero, fold])
+    assert [p.name for p in manager.passes] == ['pass0', 'expand', 'pass2', 'pass3', 'pass4']
+    assert manager.groups() == [[0, 1, 2, 3, 4]]
+    expected = sequential([(fold, 'bottomup'), (expand, 'bottomup'), (unit, 'bottomup'),
+                           (zero, 'bottomup'), (fold, 'bottomup')], tree)
+    assert manager.run(tree) == expected
+    assert manager.run(tree) == expected
+    stats = manager.stats()
+    assert stats['runs'] == 2 and stats['traversals'] == 2 and stats['saved'] == 8
+    assert all(p['fused'] for p in stats['passes'])
+    assert stats['passes'][1]['rewrites'] == 4
+    assert 'saved by fusing' in manager.report()
+
+def test_unfused_passes():
+    manager = PassManager([fold, Pass(neg, strategy='topdown'), expand, Pass(unit, fusible=False), zero, fold])
+    assert manager.groups() == [[0], [1], [2], [3], [4, 5]]
+    expected = sequential([(fold, 'bottomup'), (neg, 'topdown'), (expand, 'bottomup'),
+                           (unit, 'bottomup'), (zero, 'bottomup'), (fold, 'bottomup')], tree)
+    assert manager.run(tree) == expected
+    stats = manager.stats()
+    assert stats['traversals'] == 5 and stats['saved'] == 1
+    assert [p['fused'] for p in stats['passes']] == [False, False, False, False, True, True]
+
+def test_shared_and_deep():
+    shared = ('Sum', seven, seven)
+    manager = PassManager([fold, fold])
+    assert manager.run(('Sum', shared, shared)) == ('Num', 28)
+    # leaves made by a pass
+    to_leaf = PassManager([[{('Num', a): lambda a: a}], fold])
+    assert to_leaf.run(('Sum', ('Num', 1), ('Num', 2))) == ('Sum', 1, 2)
+    assert to_leaf.run(('Num', 1)) == 1
+    # a leaf root, from an unfused pass, goes through the rest of the passes as it is
+    root_to_leaf = PassManager([Pass([{('Num', a): lambda a: a}], strategy='topdown'), fold, unit])
+    assert root_to_leaf.run(('Num', 5)) == 5
+    assert root_to_leaf.stats()['runs'] == 1
+
+    deep = ('Num', 1)
+    for i in xrange(sys.getrecursionlimit() * 2):
+        deep = ('Sum', ('Num', 1), deep)
+    assert PassManager([fold, unit]).run(deep) == ('Num', sys.getrecursionlimit() * 2 + 1)
@@ -1,6 +1,6 @@
 import pypm
-from pypm import patternmatch,a,b,_
-from pypm import anynode,starargs,recurse_ast
+from pypm import patternmatch,a,b,c,_
+from pypm import anynode,starargs,recurse_ast,traverse_ast
 
 def extract_num(ast):
     assert ast[0] == 'Num'
@@ -127,3 +127,479 @@ def test_errors():
         raise NoProperExceptionRaised()
     else:
         assert t == 25 
+
+def test_net_matches_interpreter():
+    rules = [
+        {(("AbsSub", ("Num", a), ("Num", b),),
+                            lambda a,b: a > b): lambda a,b: ('first', a, b)},
+        {("AbsSub", ("Num", a), b):     lambda a,b: ('second', a, b)},
+        {("Sum", ("Num", a), ("Sum", b, c)):   lambda a,b,c: ('third', a, b, c)},
+        {("Sum", a, b):                 lambda a,b: ('fourth', a, b)},
+        {("Call", a, starargs):         lambda a,starargs: ('fifth', a, starargs)},
+        {(anynode, ("Num", a)):         lambda anynode,a: ('sixth', anynode, a)},
+        {(anynode, starargs):           lambda anynode,starargs: ('seventh', anynode, starargs)},
+    ]
+
+    @patternmatch(rules)
+    def compiled(ast):
+        pass
+
+    @patternmatch(rules, compiled=False)
+    def interpreted(ast):
+        pass
+
+    asts = [
+        ninety,
+        ("AbsSub", ("Num", 200), ("Num", 112)),
+        ("AbsSub", ("Num", 2), ("Sum", seven, seven)),
+        ("Sum", ("Num", 1), ("Sum", ("Num", 2), ("Num", 3))),
+        ("Sum", ("Num", 1), ("Mult", ("Num", 2), ("Num", 3))),
+        seven,
+        ("Call", "f", ("Num", 1), ("Num", 2)),
+        ("Neg", ("Num", 5)),
+        ("Neg", seven),
+        ("Anything", "x", "y"),
+    ]
+    for ast in asts:
+        assert compiled(ast) == interpreted(ast)
+
+def test_net_first_match_wins():
+    @patternmatch([
+        {("Word", "zero"):  lambda: 'zero'},
+        {("Word", a):       lambda a: 'word'},
+        {("Word", "one"):   lambda: 'unreachable'},
+    ])
+    def kind(ast):
+        pass
+
+    assert kind(("Word", "zero")) == 'zero'
+    assert kind(("Word", "one")) == 'word'
+
+def test_net_arity():
+    @patternmatch([
+        {("Num", a):                lambda a: 'one'},
+        {("Num", a, b):             lambda a,b: 'two'},
+        {("Num", a, b, starargs):   lambda a,b,starargs: ('more', starargs)},
+    ], run_func=True, exact=True)
+    def arity(ast):
+        return 'none'
+
+    assert arity(("Num", 1)) == 'one'
+    assert arity(("Num", 1, 2)) == 'two'
+    assert arity(("Num", 1, 2, 3, 4)) == ('more', (3, 4))
+    assert arity(("Num",)) == 'none'
+    assert arity(("Num", 1, 2, 3)) == ('more', (3,))
+
+def test_net_prefix():
+    rules = [
+        {("Num", a):                lambda a: ('one', a)},
+        {("Neg", ("Num", a)):       lambda a: ('neg', a)},
+        {("Num", a, b):             lambda a,b: 'two'},
+    ]
+    asts = [("Num", 3, 4), ("Num", 3), ("Neg", ("Num", 5, 6), 7), ("Neg", ("Sum", 5))]
+    expected = [('one', 3), ('one', 3), ('neg', 5), None]
+    # by default, compiled patterns compare the first elements of longer nodes, like the interpreter
+    for options in [dict(compiled=False), dict(), dict(adaptive=True), dict(order=[0, 1, 2]), dict(profile=True)]:
+        @patternmatch(rules, run_func=True, **options)
+        def f(ast):
+            return None
+        assert [f(ast) for ast in asts] == expected
+    @patternmatch(rules, run_func=True, exact=True)
+    def g(ast):
+        return None
+    assert [g(ast) for ast in asts] == ['two', ('one', 3), None, None]
+    assert pypm.compile_pattern(("Num", a), lambda a: a)(("Num", 3, 4)) == (3,)
+    assert pypm.compile_pattern(("Num", a), lambda a: a, exact=True)(("Num", 3, 4)) is None
+
+def test_compile_pattern_matches_interpreter():
+    keys = [
+        ("Sum", a, b),
+        ("Sum", ("Num", a), ("Num", b)),
+        (("AbsSub", ("Num", a), ("Num", b),), lambda a,b: b > a),
+        (anynode, starargs),
+        ("Mult", a, starargs),
+        ("Num", _),
+    ]
+    asts = [seven, fourteen, ninetyeight, ninety, ("Num", 3), ("Mult", ("Num", 2), ("Num", 5)),
+            ("AbsSub", ("Num", 5), ("Num", 1))]
+    for key in keys:
+        pattern,guard = pypm.split_guard(key)
+        names = sorted(pypm.binding_paths(pattern))
+        function = eval('lambda %s: None' % ','.join(names))
+        matcher = pypm.compile_pattern(key, function)
+        for ast in asts:
+            matched = pypm.match_and_extract_matched_vars(key, ast)
+            if matched is None:
+                assert matcher(ast) is None
+            else:
+                assert matcher(ast) == tuple(pypm.order_matched(matched, function))
+
+def test_compile_pattern_argument_order():
+    matcher = pypm.compile_pattern(("Sum", a, ("Num", b)), lambda b,a: None)
+    assert matcher(("Sum", "x", ("Num", 3))) == (3, "x")
+    assert matcher(("Sum", "x", ("Mult", 3))) is None
+    assert matcher(("Sum", "x", 3)) is None
+    assert matcher("Sum") is None
+
+def test_memoize():
+    calls = []
+    def count(n):
+        calls.append(n)
+        return n
+
+    rules = [
+        {("Sum", a, b):     lambda a,b: ("Num", count(extract_num(evalShared(a)) + extract_num(evalShared(b))))},
+        {("Num", a):        lambda a: ("Num", a)},
+    ]
+
+    @patternmatch(rules, memoize=True)
+    def evalShared(ast):
+        pass
+
+    # 2 ** 30 leaves if evaluated as a tree
+    dag = seven
+    for i in xrange(30):
+        dag = ("Sum", dag, dag)
+    assert extract_num(evalShared(dag)) == 7 * 2 ** 30
+    assert len(calls) == 31
+    info = evalShared.cache_info()
+    assert info['misses'] == 33
+    assert info['hits'] == 30
+
+    evalShared.cache_clear()
+    assert evalShared.cache_info()['currsize'] == 0
+
+def test_memoize_structural_lru():
+    @patternmatch([{("Num", a): lambda a: ("Num", a + 1)}], memoize=True, maxsize=2, key='structural')
+    def inc(ast):
+        pass
+
+    inc(("Num", 1))
+    inc(("Num", 1))
+    assert inc.cache_info()['hits'] == 1
+    inc(("Num", 2))
+    inc(("Num", 3))
+    assert inc.cache_info()['currsize'] == 2
+    inc(("Num", 1))
+    assert inc.cache_info()['hits'] == 1
+
+def test_traverse_ast():
+    @patternmatch([
+        {('OP', ('Num', a), '*', ('EXPR', ('Num', b))): 
+                    lambda a,b: ('Num', a * b)},
+    ], run_func=True)
+    def evalMult(ast):
+        return traverse_ast(evalMult, ast)[0]
+
+    answer = evalMult(big)
+    assert answer == ('EXPR', ('OP', ('Num', 5), '+',
+                        ('EXPR', ('OP', ('Num', 323), '-', ('EXPR', ('Num', 216))))))
+    assert answer[1][1] is big[1][1]
+
+    assert evalMult(seven) is seven
+    assert traverse_ast(evalMult, fourteen) == (fourteen, False)
+    assert traverse_ast(lambda a: ('Num', 0), seven) == (('Sum', ('Num', 0), ('Num', 0)), True)
+
+def test_profile():
+    for compiled in (True, False):
+        @patternmatch(patterns, compiled=compiled, profile=True)
+        def evalNumeric(ast):
+            pass
+
+        assert 98 == extract_num(evalNumeric(ninetyeight))
+        assert 90 == extract_num(evalNumeric(ninety))
+        stats = evalNumeric.stats()
+        rules = stats['rules']
+        assert [r['pattern'] for r in rules] == [d.keys()[0] for d in patterns]
+        # the actions call the module's evalNumeric, so only the two calls here are counted
+        mult,add,num,abs1,abs2 = rules
+        assert (mult['attempts'], mult['matches']) == (2, 1)
+        assert (add['attempts'], add['matches']) == (1, 0)
+        # ninety is AbsSub 22 112: the first guard says no, the second rule runs
+        assert abs1['attempts'] == 1 and abs1['guard_rejections'] == 1 and abs1['matches'] == 0
+        assert abs2['matches'] == 1
+        # AbsSub fails the Mult pattern on the name, at the top
+        assert mult['failed_at'] == {0: 1}
+        assert stats['calls'] == 2 and stats['unmatched'] == 0
+        assert mult['action_time'] >= 0
+        assert 'AbsSub' in evalNumeric.report()
+
+        evalNumeric.stats_clear()
+        assert evalNumeric.stats()['calls'] == 0
+
+    @patternmatch([{('Sum', ('Num', a), ('Num', 0)): lambda a: a}], run_func=True, profile=True)
+    def deep(ast):
+        return None
+    deep(('Sum', ('Num', 1), ('Num', 1)))
+    deep(('Sum', ('Num', 1), ('Mult', 1)))
+    deep(('Sum', ('Num', 1)))
+    assert deep.stats()['rules'][0]['failed_at'] == {0: 1, 1: 2}
+    assert deep.stats()['unmatched'] == 3
+
+def test_profile_off():
+    @patternmatch(patterns)
+    def evalNumeric(ast):
+        pass
+    assert not hasattr(evalNumeric, 'stats')
+    assert not hasattr(evalNumeric.apply_rules, 'profile')
+
+def test_may_overlap():
+    from pypm import may_overlap
+    assert not may_overlap(('Sum', a, b), ('Mult', a, b))
+    assert not may_overlap(('Sum', a, b), ('Sum', a))
+    assert may_overlap(('Sum', a, b), ('Sum', a), exact=False)
+    assert may_overlap(('Sum', a, b), (anynode, a, b))
+    assert may_overlap(('Sum', ('Num', a), b), ('Sum', starargs))
+    assert not may_overlap(('Sum', ('Num', a), b), ('Sum', ('Mult', a, b), starargs))
+    assert may_overlap(('Sum', a, b, c), ('Sum', a, b, c, starargs))
+    assert not may_overlap(('Sum', a, b), ('Sum', a, b, c, starargs))
+    assert not may_overlap(('Num', ('Num', a)), ('Num', '1'))
+
+def test_adaptive():
+    rules = [{('R%d' % i, a): (lambda i: lambda a: i)(i)} for i in xrange(10)]
+    rules.append({(anynode, a): lambda anynode,a: 'any'})
+    rules.append({('R9', a, b): lambda a,b: 'two'})
+
+    for compiled in (True, False):
+        @patternmatch(rules, compiled=compiled, adaptive=True)
+        def f(ast):
+            pass
+
+        @patternmatch(rules, compiled=compiled)
+        def reference(ast):
+            pass
+        tests = [('R9', 0), ('R3', 0), ('X', 0), ('R9', 0, 0), ('R0', 1)]
+
+        assert f.rule_order() == range(12)
+        for i in xrange(pypm.RuleOrder.interval):
+            assert f(('R9', 0)) == 9
+        assert f(('R3', 0)) == 3
+        order = f.rule_order()
+        # R9 moves to the front, the catch-all stays after every rule it overlaps
+        assert order[0] == 9
+        assert order.index(10) > max(order.index(i) for i in xrange(10))
+        for t in tests:
+            assert f(t) == reference(t)
+
+        assert f.freeze() == order
+        for i in xrange(2 * pypm.RuleOrder.interval):
+            assert f(('R1', 0)) == 1
+        assert f.rule_order() == order
+
+        @patternmatch(rules, compiled=compiled, order=order)
+        def g(ast):
+            pass
+        assert g.rule_order() == order
+        for t in tests:
+            assert g(t) == reference(t)
+
+    @patternmatch(rules, order=[10] + range(10) + [11])
+    def h(ast):
+        pass
+    try:
+        # the order is checked when the rules are compiled, on the first call
+        h(('R0', 0))
+    except ValueError:
+        pass
+    else:
+        raise NoProperExceptionRaised
+
+def test_guard_chains():
+    keys = [d.keys()[0] for d in patterns]
+    actions = [d.values()[0] for d in patterns]
+    chains = pypm.guard_chains(keys, actions)
+    assert [len(chain) for pattern,chain in chains] == [1, 1, 1, 2]
+    assert chains[3][0] == ('AbsSub', ('Num', a), ('Num', b))
+
+    @patternmatch(patterns, compiled=False)
+    def evalNumeric(ast):
+        pass
+    assert evalNumeric(("AbsSub", ("Num", 22), ("Num", 112))) == ("Num", 90)
+    assert evalNumeric(("AbsSub", ("Num", 112), ("Num", 22))) == ("Num", 90)
+    try:
+        evalNumeric(("AbsSub", ("Num", 1), ("Num", 1)))
+    except pypm.UnknownPattern:
+        pass
+    else:
+        raise NoProperExceptionRaised
+
+def test_guard_runs_early():
+    seen = []
+    def positive(a):
+        seen.append(a)
+        return a > 0
+    match = pypm.compile_pattern((('P', a, ('Q', b, ('R', c))), positive), lambda a,b,c: (a, b, c))
+    # the guard only needs a, so it runs before the ('Q', ...) subtree is looked at
+    assert match.source.index('_guard(') < match.source.index('ast_2 = ')
+    assert match(('P', 0, ('Q', 1, ('R', 2)))) is None
+    assert match(('P', 1, ('Q', 1, ('R', 2)))) == (1, 1, 2)
+    assert match(('P', 1, ('Q', 1, ('S', 2)))) is None
+    assert seen == [0, 1, 1]
+
+    # a guard which raises on an ast the rest of the pattern rejects only fails a full match
+    def num(a):
+        return a[0] == 'Num'
+    match = pypm.compile_pattern((('F', a, 'x'), num), lambda a: a)
+    assert match(('F', 5, 'y')) is None
+    assert match(('F', ('Num', 1), 'x')) == (('Num', 1),)
+    try:
+        match(('F', 5, 'x'))
+    except TypeError:
+        pass
+    else:
+        raise NoProperExceptionRaised
+    rules = [
+        {(('F', a, 'x'), num):  lambda a: 'num'},
+        {('F', a, b):           lambda a,b: 'other'},
+    ]
+    for options in [dict(adaptive=True), dict(order=[0, 1])]:
+        @patternmatch(rules, **options)
+        def f(ast):
+            pass
+        assert f(('F', 5, 'y')) == 'other'
+        assert f(('F', ('Num', 1), 'x')) == 'num'
+
+def test_lazy():
+    bad = [{'Sum': lambda: 0}]
+    @patternmatch(bad)
+    def f(ast):
+        pass
+    assert f.apply_rules.rules is None
+    try:
+        f(('Sum',))
+    except Exception,e:
+        assert 'Pattern should be a tuple' in str(e)
+    else:
+        raise NoProperExceptionRaised
+
+    try:
+        @patternmatch(bad, lazy=False)
+        def g(ast):
+            pass
+    except Exception,e:
+        assert 'Pattern should be a tuple' in str(e)
+    else:
+        raise NoProperExceptionRaised
+
+    @patternmatch(patterns)
+    def evalNumeric(ast):
+        pass
+    assert evalNumeric.apply_rules.rules is None
+    assert evalNumeric(ninety) == ('Num', 90)
+    assert evalNumeric.apply_rules.rules is not None
+
+def test_compiled_cache(tmpdir, monkeypatch):
+    keys = [d.keys()[0] for d in patterns]
+    actions = [d.values()[0] for d in patterns]
+    directory = str(tmpdir.join('cache'))
+    tests = [ninetyeight, ninety, ("AbsSub", ("Num", 112), ("Num", 22)), ("Num", 1)]
+
+    first = pypm.compile_rules(patterns, cache_dir=directory)
+    files = tmpdir.join('cache').listdir()
+    assert [f.basename for f in files] == ['pypm-%s.marshal' % pypm.rules_fingerprint(keys, actions)]
+
+    def fail(rules):
+        raise AssertionError('compiled again')
+    monkeypatch.setattr(pypm, 'compile_net', fail)
+    monkeypatch.setenv('PYPM_CACHE_DIR', directory)
+    @patternmatch(patterns)
+    def evalNumeric(ast):
+        pass
+    for t in tests:
+        assert evalNumeric(t) == first(t)
+
+    # other rules, other file
+    monkeypatch.undo()
+    other = patterns + [{("Neg", a): lambda a: a}]
+    pypm.compile_rules(other, cache_dir=directory)
+    assert len(tmpdir.join('cache').listdir()) == 2
+    assert pypm.rules_fingerprint(keys, actions) == pypm.rules_fingerprint(keys, actions)
+
+def test_flatten_net():
+    keys = [d.keys()[0] for d in patterns]
+    net = pypm.compile_net([pypm.split_guard(k) for k in keys])
+    assert pypm._unflatten_net(pypm._flatten_net(net)) == net
+
+def test_copyfunc():
+    def g():
+        return copied_value
+    h = pypm.copyfunc(g, {'copied_value': 5})
+    assert h() == 5
+    assert 'copied_value' not in vars(pypm) and 'copied_value' not in g.func_globals
+
+def test_threads():
+    import threading
+    wide = ('Sum',) + tuple(('Sum', ('Num', i), ('Num', i)) for i in xrange(20))
+    @patternmatch([
+        {('Num', a):            lambda a: ('Num', a)},
+        {(anynode, starargs):   lambda anynode,starargs: ('Num', sum(count(x)[1] for x in starargs))},
+    ], memoize=True, adaptive=True)
+    def count(ast):
+        pass
+    pypm.RuleOrder.interval, interval = 7, pypm.RuleOrder.interval
+    try:
+        results = []
+        def work():
+            for i in xrange(50):
+                results.append(count(wide))
+                count.cache_clear()
+        threads = [threading.Thread(target=work) for i in xrange(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        pypm.RuleOrder.interval = interval
+    assert results == [('Num', 380)] * 400
+    assert count.rule_order() == [0, 1]
+
+    @patternmatch([{('Num', a): lambda a: a}], profile=True)
+    def profiled(ast):
+        pass
+    def calls():
+        for i in xrange(200):
+            profiled(('Num', i))
+    threads = [threading.Thread(target=calls) for i in xrange(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # no count lost
+    assert profiled.stats()['calls'] == 1600
+    assert profiled.stats()['rules'][0]['matches'] == 1600
+
+@patternmatch([{('Num', a): lambda a: ('Num', a * 2)}], run_func=True)
+def double(ast):
+    return traverse_ast(double, ast, executor=pool, threshold=4)[0]
+
+pool = None
+
+def double_child(ast):
+    # a module level function pickles, a decorated one does not
+    return double(ast)
+
+def test_traverse_ast_executor():
+    from multiprocessing.pool import ThreadPool
+    global pool
+    # nested wide nodes, and fewer workers than tasks: calls in the pool must not wait on the pool
+    wide = ('List',) + tuple(('List',) + tuple(('Num', i * 10 + j) for j in xrange(10)) for i in xrange(10))
+    expected = ('List',) + tuple(('List',) + tuple(('Num', (i * 10 + j) * 2) for j in xrange(10)) for i in xrange(10))
+    pool = ThreadPool(2)
+    try:
+        assert double(wide) == expected
+        assert double(('List', ('Num', 1), 'x')) == ('List', ('Num', 2), 'x')
+        r = recurse_ast(lambda x: (double(x),), 'List', wide[1:], executor=pool, threshold=4)
+        assert r == (expected,)
+    finally:
+        pool.close()
+        pool = None
+
+def test_traverse_ast_process_pool():
+    import multiprocessing
+    wide = ('List',) + tuple(('Num', i) for i in xrange(40))
+    p = multiprocessing.Pool(2)
+    try:
+        assert traverse_ast(double_child, wide, executor=p, threshold=4)[0] == ('List',) + tuple(('Num', i * 2) for i in xrange(40))
+    finally:
+        p.close()
+        p.join()
@@ -0,0 +1,55 @@
+import sys
+
+from pyrewrite import rewrite,RewriteLimit
+from pypm import patternmatch,a,b
+from test_pypm import big
+
+arithmetic = [
+    {('EXPR', a):                           lambda a: a},
+    {('OP', ('Num', a), '+', ('Num', b)):   lambda a,b: ('Num', a + b)},
+    {('OP', ('Num', a), '-', ('Num', b)):   lambda a,b: ('Num', a - b)},
+    {('OP', ('Num', a), '*', ('Num', b)):   lambda a,b: ('Num', a * b)},
+]
+
+def chain(n):
+    # the shape pyparse.simple_expression gives 1+1+...+1
+    ast = ('EXPR', ('Num', 1))
+    for i in xrange(n):
+        ast = ('EXPR', ('OP', ('Num', 1), '+', ast))
+    return ast
+
+def test_bottomup():
+    assert rewrite(arithmetic, big) == ('Num', 5 + (323 - (12 * 18)))
+
+def test_topdown():
+    assert rewrite(arithmetic, big, strategy='topdown') == ('Num', 5 + (323 - (12 * 18)))
+
+def test_deep():
+    n = sys.getrecursionlimit() * 5
+    assert rewrite(arithmetic, chain(n)) == ('Num', n + 1)
+    assert rewrite(arithmetic, chain(n), strategy='topdown') == ('Num', n + 1)
+
+def test_decorated_rules():
+    @patternmatch(arithmetic, run_func=True)
+    def step(ast):
+        return ast
+    assert rewrite(step, big) == ('Num', 5 + (323 - (12 * 18)))
+
+def test_single_pass():
+    rules = [{('EXPR', a): lambda a: ('EXPR', ('EXPR', a))}]
+    assert rewrite(rules, ('EXPR', ('Num', 1)), fixpoint=False) == ('EXPR', ('EXPR', ('Num', 1)))
+    assert rewrite(rules, ('EXPR', ('Num', 1)), strategy='topdown', fixpoint=False) == ('EXPR', ('EXPR', ('Num', 1)))
+    try:
+        rewrite(rules, ('EXPR', ('Num', 1)), max_steps=100)
+    except RewriteLimit:
+        pass
+    else:
+        raise Exception('no proper exception raised')
+
+def test_unchanged_subtrees_are_shared():
+    left = ('Call', 'f', ('Var', 'x'))
+    ast = ('Seq', left, ('OP', ('Num', 1), '+', ('Num', 2)))
+    result = rewrite(arithmetic, ast)
+    assert result == ('Seq', left, ('Num', 3))
+    assert result[1] is left
+    assert rewrite(arithmetic, left) is left
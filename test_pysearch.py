@@ -0,0 +1,62 @@
+import pypm
+import pysearch
+from pypm import a,b,c,anynode,starargs
+from test_pypm import big
+
+def test_query():
+    index = pysearch.ASTIndex(big)
+    assert len(index) == 11
+
+    found = list(index.query([('Num', a)]))
+    assert [bindings['a'] for path,bindings in found] == [5, 323, 12, 18]
+    for path,bindings in found:
+        assert index.get(path) == ('Num', bindings['a'])
+
+    ops = list(index.query([('OP', ('Num', a), b, c)]))
+    assert [(bindings['a'], bindings['b']) for path,bindings in ops] == [(5, '+'), (323, '-'), (12, '*')]
+    assert ops[0][0] == (1,)
+
+    # a guard, and the first matching pattern of each node
+    guarded = ((('Num', a), lambda a: a > 100))
+    found = list(index.query([guarded, ('EXPR', ('Num', b))]))
+    assert found == [((1, 3, 1, 1), {'a': 323}), ((1, 3, 1, 3, 1, 3), {'b': 18})]
+
+    # variable names and StarArgs look at every candidate arity
+    anything = list(index.query([(anynode, starargs)]))
+    assert [index.get(p) for p,bindings in anything][:2] == [big, big[1]]
+    assert len(anything) == len(index)
+    assert list(index.query([('OP', a, starargs)]))[0][1] == {'a': ('Num', 5), 'starargs': big[1][2:]}
+
+    assert list(index.query([('Nothing', a)])) == []
+    assert list(index.query([])) == []
+
+def test_query_same_as_walk():
+    tree = ('Sum', ('Num', 1), ('Sum', ('Num', 2), ('Mult', ('Num', 1), ('Num', 1), 'x')), ('Num', 1))
+    index = pysearch.ASTIndex(tree)
+    patterns = [('Sum', a, b), ('Mult', ('Num', a), starargs), (anynode, ('Num', 1))]
+
+    def walk(node, path):
+        yield node, path
+        for i,x in enumerate(node):
+            if pypm.is_node(x):
+                for r in walk(x, path + (i,)):
+                    yield r
+    expected = []
+    for node,path in walk(tree, ()):
+        for p in patterns:
+            if pypm._fail_depth(p, node) is None:
+                expected.append(path)
+                break
+    assert [path for path,bindings in index.query(patterns)] == expected
+
+def test_deep_chain():
+    tree = ('Num', 1)
+    for i in xrange(3000):
+        tree = ('EXPR', tree)
+    index = pysearch.ASTIndex(tree)
+    # one parent and one position per node, the paths are only built for matches
+    assert len(index.parents) == len(index.positions) == 3001
+    [(path, bindings)] = index.query([('Num', a)])
+    assert path == (1,) * 3000
+    assert index.get(path) == ('Num', 1) and bindings == {'a': 1}
+    assert index.path(0) == ()
@@ -0,0 +1,63 @@
+from StringIO import StringIO
+
+import pyparse
+import pysearch
+import pystream
+from pypm import a,b,c,anynode,starargs
+from pystream import ENTER,LEAF,EXIT
+from test_pypm import big
+
+def test_events():
+    assert list(pystream.events_from_ast(('Num', 5))) == [(ENTER, None), (LEAF, 'Num'), (LEAF, 5), (EXIT, None)]
+    f = StringIO()
+    pystream.write_events(pystream.events_from_ast(big), f)
+    f.seek(0)
+    assert list(pystream.read_events(f)) == list(pystream.events_from_ast(big))
+
+def test_same_as_index():
+    index = pysearch.ASTIndex(big)
+    queries = [
+        [('Num', a)],
+        [('OP', ('Num', a), b, c)],
+        [(('Num', a), lambda a: a > 100), ('EXPR', ('Num', b))],
+        [(anynode, starargs)],
+        [('OP', a, starargs)],
+        [('EXPR', ('OP', ('Num', a), '-', b))],
+        [('OP', ('Num', a), '*', ('EXPR', ('Num', b)))],
+        [(anynode, ('Num', a), '+', starargs), ('EXPR', a)],
+    ]
+    for patterns in queries:
+        streamed = list(pystream.match_events(patterns, pystream.events_from_ast(big)))
+        assert sorted(streamed) == sorted(index.query(patterns))
+
+def test_children_first():
+    found = list(pystream.match_events([('EXPR', a)], pystream.events_from_ast(big)))
+    assert [path for path,bindings in found] == [(1, 3, 1, 3, 1, 3), (1, 3, 1, 3), (1, 3), ()]
+
+def test_deep_stream():
+    # a chain far deeper than the recursion limit, which is never built as tuples
+    n = 20000
+    def events():
+        for i in xrange(n):
+            yield ENTER, None
+            yield LEAF, 'EXPR'
+        yield ENTER, None
+        yield LEAF, 'Num'
+        yield LEAF, 7
+        yield EXIT, None
+        for i in xrange(n):
+            yield EXIT, None
+    found = list(pystream.match_events([('EXPR', ('Num', a))], events()))
+    assert found == [((1,) * (n - 1), {'a': 7})]
+
+def test_parse_events():
+    tokens = pyparse.whitespace_tokenize('12 + 3 * 4 - 5')
+    events,remaining = pyparse.parse(pyparse.simple_expression, tokens, whole=True, events=True)
+    assert remaining == []
+    found = list(pystream.match_events([('OP', ('Num', a), b, c)], events))
+    assert found == [((1, 3, 1, 3, 1), {'a': 4, 'b': '-', 'c': ('EXPR', ('Num', 5))}),
+                     ((1, 3, 1), {'a': 3, 'b': '*', 'c': ('EXPR', ('OP', ('Num', 4), '-', ('EXPR', ('Num', 5))))}),
+                     ((1,), {'a': 12, 'b': '+', 'c': ('EXPR', ('OP', ('Num', 3), '*', ('EXPR', ('OP', ('Num', 4), '-', ('EXPR', ('Num', 5))))))})]
+    ast = pyparse.parse(pyparse.simple_expression, tokens, whole=True)[0]
+    assert found == list(pystream.match_events([('OP', ('Num', a), b, c)], pystream.events_from_ast(ast)))
+    assert pyparse.parse(pyparse.simple_expression, ['1', '+'], whole=True, packrat=True, events=True) == (None, ['1', '+'])
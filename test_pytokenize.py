@@ -0,0 +1,68 @@
+from StringIO import StringIO
+
+import pyparse
+from pytokenize import CHARACTERS,TokenSpec,TokenBuffer,TokenizeError,tokenize_file
+
+ARITHMETIC = TokenSpec([
+    ('WS',      r'\s+'),
+    ('NUM',     r'[0-9]+'),
+    ('OP',      r'[-+*]'),
+], skip=['WS'])
+
+def test_characters_like_whitespace_tokenize():
+    s = '5 + 323 -\r\n 12 * 18'
+    assert list(CHARACTERS.tokenize(s)) == pyparse.whitespace_tokenize(s)
+
+def test_chunked_stream():
+    s = '12 + 345 * 6789 - 0 ' * 50
+    whole = list(ARITHMETIC.tokenize(s))
+    chunked = list(ARITHMETIC.tokenize(StringIO(s), chunksize=3))
+    assert chunked == whole
+    assert [(t.kind, t.start, t.end) for t in chunked] == [(t.kind, t.start, t.end) for t in whole]
+    assert whole[2] == '345' and whole[2].kind == 'NUM' and s[whole[2].start:whole[2].end] == '345'
+
+def test_chunk_boundaries():
+    spec = TokenSpec([
+        ('WS',      r'\s+'),
+        ('FLOAT',   r'[0-9]+\.[0-9]+(e-?[0-9]+)?'),
+        ('INT',     r'[0-9]+'),
+        ('OP',      r'\*\*|->|<=|[-+*<.e]'),
+    ], skip=['WS'])
+    for s in ['12.5 + 3', '1.25e-10**2 -> 4 <= 3.', '7 ** 2.5e3 <= 10.']:
+        whole = [(t, t.kind, t.start) for t in spec.tokenize(s)]
+        # every chunk size splits somewhere inside a float or a two character operator
+        for chunksize in xrange(1, len(s) + 1):
+            chunked = [(t, t.kind, t.start) for t in spec.tokenize(StringIO(s), chunksize=chunksize)]
+            assert chunked == whole, chunksize
+    assert [t.kind for t in spec.tokenize(StringIO('12.5 + 3'), chunksize=3)] == ['FLOAT', 'OP', 'INT']
+
+def test_errors():
+    try:
+        list(ARITHMETIC.tokenize(StringIO('1 + x'), chunksize=2))
+    except TokenizeError,e:
+        assert 'offset 4' in str(e)
+    else:
+        raise Exception('no proper exception raised')
+
+def test_mmap_file(tmpdir):
+    p = tmpdir.join('e.expr')
+    p.write('5 + 323 - 12 * 18')
+    tokens = TokenBuffer(tokenize_file(str(p), CHARACTERS))
+    ast,remaining = pyparse.parse(pyparse.simple_expression, tokens, whole=True)
+    assert remaining == []
+    assert ast == pyparse.parse(pyparse.simple_expression, pyparse.whitespace_tokenize('5 + 323 - 12 * 18'))[0]
+
+    empty = tmpdir.join('empty.expr')
+    empty.write('')
+    assert list(tokenize_file(str(empty), CHARACTERS)) == []
+
+def test_parsers_pull_tokens_lazily():
+    tokens = TokenBuffer(ARITHMETIC.tokenize('1 + 2 ' * 10000))
+    p = pyparse.Join('OP', pyparse.Kind('NUM', 'Num', int), pyparse.Kind('OP'), pyparse.Kind('NUM', 'Num', int))
+    ast,i = p.parse_at(tokens, 0, tokens.lazy_end)
+    assert ast == ('OP', ('Num', 1), '+', ('Num', 2))
+    assert i == 3
+    assert len(tokens.tokens) < 10
+
+    whole = TokenBuffer(ARITHMETIC.tokenize('1 + 2'))
+    assert pyparse.parse(p, whole, whole=True) == (('OP', ('Num', 1), '+', ('Num', 2)), [])
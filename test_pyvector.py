@@ -0,0 +1,115 @@
+import pytest
+
+import pyvector
+from pypm import patternmatch,a,b
+
+numpy = pytest.importorskip('numpy')
+
+def extract_num(ast):
+    assert ast[0] == 'Num'
+    return ast[1]
+
+@patternmatch([
+    {("Mult", a, b):    lambda a,b: ("Num", (extract_num(evalNumeric(a)) * extract_num(evalNumeric(b))))},
+    {("Sum", a, b):     lambda a,b: ("Num", (extract_num(evalNumeric(a)) + extract_num(evalNumeric(b))))},
+    {("Num", a):        lambda a: ("Num", a)},
+    {(("Sub", a, b), lambda a,b: a > b):   lambda a,b: ("Num", a - b)},
+    {(("Sub", a, b), lambda a,b: a <= b):  lambda a,b: ("Num", b - a)},
+])
+def evalNumeric(ast):
+    pass
+
+def make_asts(n):
+    asts = []
+    for i in xrange(n):
+        asts.append(("Sum", ("Num", i), ("Mult", ("Num", i + 1), ("Num", 3))))
+        asts.append(("Mult", ("Num", i * 0.5), ("Num", 2.0)))
+        asts.append(("Sub", i, 10))
+    asts.append(("Num", 7))
+    return asts
+
+def test_shape():
+    ast = ("A", (), ("B", 1, None, True, ()), 2.5, ("C", ("D", 2 ** 70)))
+    key,leaves = pyvector.shape(ast)
+    assert leaves == [2.5, 1, 2 ** 70]
+    assert pyvector._fill(key, leaves) == ast
+    assert pyvector.shape(("A", (), ("B", 7, None, True, ()), 0.0, ("C", ("D", 3))))[0] == key
+    assert pyvector.shape(("A", (), ("B", 7, None, False, ()), 0.0, ("C", ("D", 3))))[0] != key
+    assert pyvector.shape(("A", (), ("B", 7.0, None, True, ()), 0.0, ("C", ("D", 3))))[0] != key
+
+def test_batch_apply_matches_per_item():
+    asts = make_asts(50)
+    stats = {}
+    results = pyvector.batch_apply(evalNumeric, asts, stats=stats)
+    assert results == [evalNumeric(ast) for ast in asts]
+    assert all(type(r[1]) == type(e[1]) for r,e in zip(results, [evalNumeric(ast) for ast in asts]))
+    # the Sum and Mult shapes run once each, Sub's guards compare arrays and fall back
+    assert stats == {'vectorized': 100, 'fallback': 51, 'shapes': 4}
+
+def test_batch_apply_int64_and_overflow():
+    big = 2 ** 62
+    asts = [("Mult", ("Num", big), ("Num", 4)), ("Mult", ("Num", 1), ("Num", 4))]
+    # Python ints by default, exact
+    assert pyvector.batch_apply(evalNumeric, asts) == [("Num", big * 4), ("Num", 4)]
+    stats = {}
+    small = [("Sum", ("Num", i), ("Num", 1)) for i in xrange(10)]
+    results = pyvector.batch_apply(evalNumeric, small, int_dtype=numpy.int64, stats=stats)
+    assert results == [("Num", i + 1) for i in xrange(10)]
+    assert stats['vectorized'] == 10
+
+def test_batch_apply_falls_back():
+    @patternmatch([
+        {(("Num", a), lambda a: a == 0):    lambda a: "zero"},
+        {("Num", a):                        lambda a: ("Num", a)},
+    ])
+    def f(ast):
+        pass
+    asts = [("Num", 0), ("Num", 1), ("Num", 0)]
+    stats = {}
+    # the guard returns an array
+    assert pyvector.batch_apply(f, asts, stats=stats) == ["zero", ("Num", 1), "zero"]
+    assert stats['vectorized'] == 0
+
+    @patternmatch([{("Num", a): lambda a: sum(a)}])
+    def total(ast):
+        pass
+    # not one value per AST
+    with pytest.raises(TypeError):
+        pyvector.batch_apply(total, [("Num", 1), ("Num", 2)])
+
+    @patternmatch([{("Div", a, b): lambda a,b: a / b}])
+    def div(ast):
+        pass
+    # the division by zero is raised by the per-item call
+    with pytest.raises(ZeroDivisionError):
+        pyvector.batch_apply(div, [("Div", 1, 2), ("Div", 1, 0)])
+    assert pyvector.batch_apply(div, [("Div", 6, 2), ("Div", 8, 4)]) == [3, 2]
+
+def test_batch_apply_computed_leaves():
+    @patternmatch([{("Num", a): lambda a: ("Str", str(a))}])
+    def show(ast):
+        pass
+    @patternmatch([{("Num", a): lambda a: "{0}!".format(a)}])
+    def shout(ast):
+        pass
+    asts = [("Num", 1), ("Num", 2), ("Num", 3)]
+    stats = {}
+    # the strings are made from the arrays, so every AST gets its own
+    assert pyvector.batch_apply(show, asts, stats=stats) == [("Str", "1"), ("Str", "2"), ("Str", "3")]
+    assert stats['vectorized'] == 0
+    assert pyvector.batch_apply(shout, asts) == ["1!", "2!", "3!"]
+
+    @patternmatch([{("Neg", ("Num", a), b): lambda a,b: ("Num", -a, b)}])
+    def neg(ast):
+        pass
+    # the strings copied through are constants of the shape
+    stats = {}
+    assert pyvector.batch_apply(neg, [("Neg", ("Num", 1), "x"), ("Neg", ("Num", 2), "x")], stats=stats) == [("Num", -1, "x"), ("Num", -2, "x")]
+    assert stats['vectorized'] == 2
+
+def test_batch_apply_without_numpy(monkeypatch):
+    monkeypatch.setattr(pyvector, 'numpy', None)
+    asts = make_asts(5)
+    stats = {}
+    assert pyvector.batch_apply(evalNumeric, asts, stats=stats) == [evalNumeric(ast) for ast in asts]
+    assert stats['vectorized'] == 0